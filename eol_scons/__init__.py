@@ -32,6 +32,7 @@ import os
 import sys
 import traceback
 
+import SCons.Node
 import SCons.Tool
 import SCons.Defaults
 
@@ -64,6 +65,34 @@ def InstallDefaultHook():
     "Add the hooks dir to the tool path to override the default tool."
     SCons.Tool.DefaultToolpath.insert(0, hooks_dir)
 
+def InstallSConscriptRecorder():
+    """
+    Record the SConstruct and SConscript files read by scons, so the ninja
+    tool can regenerate its build file when any of them change.  The
+    SConstruct file is already on the SConscript call stack when eol_scons
+    is imported from it.
+    """
+    # SCons.Script.SConscript is also the name of the SConscript()
+    # function, so the module has to be found in sys.modules.
+    import SCons.Script
+    sconscript = sys.modules['SCons.Script.SConscript']
+    for frame in sconscript.call_stack:
+        if frame.sconscript:
+            _sconscript_files.append(frame.sconscript.srcnode())
+    read_sconscripts = sconscript._SConscript
+    def _SConscript(fs, *files, **kw):
+        for fn in files:
+            if isinstance(fn, SCons.Node.Node):
+                _sconscript_files.append(fn.srcnode())
+            elif fn != '-':
+                _sconscript_files.append(fs.File(str(fn)).srcnode())
+        return read_sconscripts(fs, *files, **kw)
+    sconscript._SConscript = _SConscript
+
+def SConscriptFiles():
+    "Return the File nodes of the SConstruct and SConscript files read."
+    return _sconscript_files[:]
+
 def RemoveDefaultHook():
     """
     Remove the path to the default override, for cases where eol_scons will
@@ -84,10 +113,12 @@ try:
 
 except NameError:
     _eolsconsdir = os.path.abspath(os.path.dirname(__file__))
+    _sconscript_files = []
     tools_dir = os.path.normpath(os.path.join(_eolsconsdir, "tools"))
     hooks_dir = os.path.normpath(os.path.join(_eolsconsdir, "hooks"))
 
     InstallToolsPath()
+    InstallSConscriptRecorder()
     DefineQt4Tools()
 
     # Create the DefaultEnvironment which is used for SCons.Script
@@ -49,14 +49,359 @@ the downloaded data files as #/DataCache.  Otherwise there is no default,
 so a local path must be inserted into cachepaths before registering data
 files.  It might be nice to share a single DataCache across projects, but
 using the local source directory has the advantage that the data files go
-away when the source tree is removed.  Other possibilities are to use a
-common directory like $HOME/.datafilecache, something more obvious or
-conventional like $HOME/Data/cache, or at least allow the cache directory
-to be overridden with an environment variable.
+away when the source tree is removed.
+
+When several source trees on one host use the same data files, such as the
+checkouts on a build server, they can share a single copy of each file in
+a shared cache directory, set with setSharedCache() or with the
+EOL_SCONS_DATACACHE environment variable when using the datafilecache
+tool.  Files are then downloaded only into the shared cache, and each tree
+gets a hard link to the shared copy in its own cache directory, or a
+reflink or plain copy if the file cannot be linked.  Scons processes
+sharing the cache lock it with flock(), and a file being downloaded is
+locked so it is only downloaded once.  The shared cache can be limited to a
+maximum size, with EOL_SCONS_DATACACHE_SIZE like '50G'.  The shared cache
+records when each file was last used, and when the files exceed the
+maximum size the least recently used files are removed.  Removing a file
+from the shared cache does not remove the links to it in source trees.
+
+Each cache directory keeps a manifest of the files downloaded into it, in
+the file .datafilecache.json, recording the size, modification time, and
+md5 hash of each file by its relative path.  The hash of a cached file is
+only computed again when its size or modification time no longer match the
+manifest, so checking a large cache which has not changed costs one stat()
+per file.  With verification enabled (see enableVerify()), download() with
+downloads disabled checks that the cached file still matches the hash
+recorded when it was downloaded, rather than just checking that it exists,
+so a truncated or modified copy is caught.
+
+The remote location can also provide a manifest of its own, in the format
+written by md5sum, named with setRemoteManifest().  For example, on the
+data host:
+
+   cd /scr/raf_data && find . -name '*.nc' | xargs md5sum > MANIFEST.md5
+
+The remote manifest is fetched once per process.  Then files whose cached
+copy already matches the remote hash are not synchronized at all, and
+files whose hash differs are verified against the remote hash after they
+are downloaded.
 """
 
 import subprocess as sp
 import os
+import time
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_manifest_file = ".datafilecache.json"
+_manifest_version = 1
+
+_index_file = ".datafilecache-index.json"
+_index_version = 1
+
+# Files are hashed in blocks of this size.
+_hash_block_size = 4 * 1024 * 1024
+
+
+def _file_hash(path):
+    "Return the md5 hex digest of the file at @p path."
+    md5 = hashlib.md5()
+    hfile = open(path, 'rb')
+    try:
+        block = hfile.read(_hash_block_size)
+        while block:
+            md5.update(block)
+            block = hfile.read(_hash_block_size)
+    finally:
+        hfile.close()
+    return md5.hexdigest()
+
+
+def _parse_md5sum(text):
+    """
+    Parse the lines written by md5sum and return a dictionary which maps
+    each relative path to its hash.
+    """
+    hashes = {}
+    for line in text.splitlines():
+        (md5, sep, path) = line.strip().partition(' ')
+        # md5sum marks files read in binary mode with an asterisk.
+        path = path.lstrip(' ')
+        if path.startswith('*'):
+            path = path[1:]
+        if path.startswith('./'):
+            path = path[2:]
+        if len(md5) == 32 and path:
+            hashes[path] = md5.lower()
+    return hashes
+
+
+def _parse_size(size):
+    "Convert a size like 500M or 50G to a number of bytes."
+    if size is None or isinstance(size, int):
+        return size
+    size = str(size).strip().upper()
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    scale = 1
+    if size[-1:] in units:
+        scale = units[size[-1]]
+        size = size[:-1]
+    try:
+        return int(float(size) * scale)
+    except ValueError:
+        raise ValueError("Invalid data cache size: %s" % (size))
+
+
+def _materialize(sharedpath, destpath):
+    """
+    Replace @p destpath with a hard link to @p sharedpath, or else with a
+    reflink copy or a plain copy if the file cannot be linked.  If the
+    shared copy is a symbolic link to a local source file, then so is
+    @p destpath.
+    """
+    destdir = os.path.dirname(destpath)
+    if not os.path.isdir(destdir):
+        os.makedirs(destdir)
+    tmppath = "%s.%d" % (destpath, os.getpid())
+    if os.path.islink(sharedpath):
+        os.symlink(os.path.realpath(sharedpath), tmppath)
+        os.rename(tmppath, destpath)
+        return
+    try:
+        os.link(sharedpath, tmppath)
+    except OSError:
+        devnull = open(os.devnull, 'w')
+        try:
+            retcode = sp.call(['cp', '--reflink=always', '-p',
+                               sharedpath, tmppath], shell=False,
+                              stdout=devnull, stderr=devnull)
+        except OSError:
+            retcode = 1
+        devnull.close()
+        if retcode != 0:
+            shutil.copy2(sharedpath, tmppath)
+    os.rename(tmppath, destpath)
+
+
+class _FileLock(object):
+    """
+    An exclusive flock() on a lock file, held in a with statement.  The
+    lock excludes other processes and also other threads in this process,
+    since each holder opens the lock file separately.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lfile = None
+
+    def __enter__(self):
+        self.lfile = open(self.path, 'a')
+        if fcntl:
+            fcntl.flock(self.lfile.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self.lfile.fileno(), fcntl.LOCK_UN)
+        self.lfile.close()
+        self.lfile = None
+        return False
+
+
+class _SharedStore(object):
+    """
+    The index of the files in a shared cache directory, recording the size
+    and last access time of each file by relative path, and the lock files
+    which serialize changes to the directory.
+    """
+
+    def __init__(self, root, maxsize=None):
+        self.root = root
+        self.maxsize = _parse_size(maxsize)
+        self.path = os.path.join(root, _index_file)
+        self.lockdir = os.path.join(root, '.locks')
+        # The files used by this process, which it never evicts.
+        self.used = set()
+        if not os.path.isdir(self.lockdir):
+            os.makedirs(self.lockdir)
+
+    def lock(self):
+        "Return a lock on the whole shared cache."
+        return _FileLock(os.path.join(self.root, '.lock'))
+
+    def fileLock(self, filepath):
+        "Return a lock on downloading @p filepath into the shared cache."
+        name = hashlib.md5(filepath.encode('utf-8')).hexdigest()
+        return _FileLock(os.path.join(self.lockdir, name))
+
+    def _load(self):
+        try:
+            ifile = open(self.path)
+        except IOError:
+            return {}
+        try:
+            try:
+                data = json.load(ifile)
+            except ValueError:
+                print("Ignoring unreadable data cache index: %s" % (self.path))
+                return {}
+        finally:
+            ifile.close()
+        if data.get('version') != _index_version:
+            return {}
+        return data['files']
+
+    def _save(self, files):
+        tmppath = "%s.%d" % (self.path, os.getpid())
+        try:
+            ifile = open(tmppath, 'w')
+            try:
+                json.dump({'version': _index_version, 'files': files}, ifile,
+                          indent=1, sort_keys=True)
+            finally:
+                ifile.close()
+            os.rename(tmppath, self.path)
+        except (IOError, OSError) as ex:
+            print("Failed to write data cache index %s: %s" %
+                  (self.path, str(ex)))
+
+    def _evict(self, files):
+        "Remove the least recently used files until under the maximum size."
+        total = sum([entry['size'] for entry in files.values()])
+        if not self.maxsize or total <= self.maxsize:
+            return
+        lru = sorted([(entry['atime'], filepath)
+                      for filepath, entry in files.items()])
+        for (atime, filepath) in lru:
+            if total <= self.maxsize:
+                break
+            if filepath in self.used:
+                continue
+            path = os.path.join(self.root, filepath)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= files[filepath]['size']
+            del files[filepath]
+            print("Evicted from shared data cache: %s" % (path))
+        if total > self.maxsize:
+            print("*** Shared data cache %s exceeds %d bytes with the files "
+                  "in use by this build." % (self.root, self.maxsize))
+
+    def materialize(self, links):
+        """
+        For each (filepath, sharedpath, destpath) tuple in @p links, link
+        the shared copy into @p destpath and record that the file was used.
+        Then evict files if the shared cache is too large.  Return the list
+        of filepaths which could not be materialized because their shared
+        copy is gone.
+        """
+        missing = []
+        with self.lock():
+            files = self._load()
+            now = time.time()
+            for (filepath, sharedpath, destpath) in links:
+                try:
+                    st = os.stat(sharedpath)
+                except OSError:
+                    files.pop(filepath, None)
+                    missing.append(filepath)
+                    continue
+                if not (os.path.exists(destpath) and
+                        os.path.samefile(sharedpath, destpath)):
+                    _materialize(sharedpath, destpath)
+                files[filepath] = {'size': st.st_size, 'atime': now}
+                self.used.add(filepath)
+            self._evict(files)
+            self._save(files)
+        return missing
+
+
+class _Manifest(object):
+    """
+    The size, modification time, and md5 hash of the files in one cache
+    directory, keyed by relative data file path.
+    """
+
+    def __init__(self, cachedir):
+        self.path = os.path.join(cachedir, _manifest_file)
+        self.files = {}
+        self.changed = False
+        self.hashed = 0
+        self._load()
+
+    def _load(self):
+        try:
+            mfile = open(self.path)
+        except IOError:
+            return
+        try:
+            try:
+                data = json.load(mfile)
+            except ValueError:
+                print("Ignoring unreadable data file manifest: %s" %
+                      (self.path))
+                return
+        finally:
+            mfile.close()
+        if data.get('version') == _manifest_version:
+            self.files = data['files']
+
+    def save(self):
+        if not self.changed or not os.path.isdir(os.path.dirname(self.path)):
+            return
+        tmppath = "%s.%d" % (self.path, os.getpid())
+        try:
+            mfile = open(tmppath, 'w')
+            try:
+                json.dump({'version': _manifest_version,
+                           'files': self.files}, mfile,
+                          indent=1, sort_keys=True)
+            finally:
+                mfile.close()
+            os.rename(tmppath, self.path)
+            self.changed = False
+        except (IOError, OSError) as ex:
+            print("Failed to write data file manifest %s: %s" %
+                  (self.path, str(ex)))
+
+    def recorded(self, filepath):
+        "Return the hash recorded for @p filepath, or None."
+        entry = self.files.get(filepath)
+        return entry and entry['md5']
+
+    def hash(self, filepath, destpath, expected=None):
+        """
+        Return the md5 hash of @p destpath, the cached copy of @p filepath,
+        or None if it does not exist.  The file is only hashed if its size
+        or modification time differ from the manifest, and then the new
+        hash is recorded unless it differs from @p expected.
+        """
+        try:
+            st = os.stat(destpath)
+        except OSError:
+            return None
+        entry = self.files.get(filepath)
+        if (entry and entry['size'] == st.st_size and
+            entry['mtime'] == st.st_mtime):
+            return entry['md5']
+        md5 = _file_hash(destpath)
+        self.hashed += 1
+        if not expected or md5 == expected:
+            self.files[filepath] = {'size': st.st_size,
+                                    'mtime': st.st_mtime, 'md5': md5}
+            self.changed = True
+        return md5
+
 
 class DataFileCache(object):
     """
@@ -71,6 +416,19 @@ class DataFileCache(object):
             self._cachepaths = [cachepath]
         self._cached_paths = {}
         self._enable_download = True
+        # The relative paths of the files synchronized by this process.
+        self._synced = set()
+        self._sync_workers = 4
+        self._verify = False
+        # Map cache directory to its _Manifest.
+        self._manifests = {}
+        self._manifest_lock = threading.Lock()
+        self._remote_manifest = None
+        self._remote_hashes = None
+        self._remote_lock = threading.Lock()
+        self._store = None
+        self._shared = None
+        self._force_shared = False
 
     def getCachePath(self):
         "Return the current cache path list."
@@ -106,20 +464,376 @@ class DataFileCache(object):
     # Backwards compatible but deprecated method.
     setPrefix = setRemotePrefix
 
-    def sync(self):
+    def setSyncWorkers(self, workers):
+        "Set the number of rsync processes sync() runs for each host."
+        self._sync_workers = max(1, workers)
+
+    def setRemoteManifest(self, name):
+        """
+        Set the path, relative to the remote prefix, of a manifest of the
+        remote data files in md5sum format.  Files whose cached copy
+        matches the remote hash are not synchronized again.
+        """
+        self._remote_manifest = name
+        self._remote_hashes = None
+
+    def setSharedCache(self, root, maxsize=None):
+        """
+        Download files into the shared cache directory @p root, and link
+        them from there into this cache.  If @p maxsize is given, as bytes
+        or a string like '50G', the least recently used files are removed
+        from the shared cache when its files exceed that size.
+        """
+        root = os.path.expandvars(os.path.expanduser(root))
+        self._store = _SharedStore(root, maxsize)
+        self._shared = DataFileCache(root)
+
+    def forceSharedSync(self, enable):
+        """
+        Synchronize files which already exist in the shared cache when they
+        are downloaded, rather than just linking the shared copy.
+        """
+        self._force_shared = enable
+
+    def _sharedCache(self):
+        "Return the DataFileCache of the shared cache directory."
+        shared = self._shared
+        shared._remote_prefix = self._remote_prefix
+        shared._sync_workers = self._sync_workers
+        shared._enable_download = self._enable_download
+        if shared._remote_manifest != self._remote_manifest:
+            shared.setRemoteManifest(self._remote_manifest)
+        return shared
+
+    def _linkShared(self, links):
+        "Link shared files into this cache, see _SharedStore.materialize()."
+        # None of the files registered by this build should be evicted.
+        # Copy the keys, since background downloads can run while the
+        # SConscript files are still registering files.
+        self._store.used.update(list(self._cached_paths.keys()))
+        return self._store.materialize(links)
+
+    def _downloadShared(self, filepath, destpath):
+        """
+        Download @p filepath into the shared cache unless it is already
+        there, then link it into this cache at @p destpath.
+        """
+        shared = self._sharedCache()
+        sharedpath = shared.getFile(filepath)
+        with self._store.fileLock(filepath):
+            if (self._force_shared or not os.path.exists(sharedpath) or
+                shared._remoteHashes()):
+                sharedpath = shared.download(filepath)
+        if not sharedpath:
+            return None
+        if self._linkShared([(filepath, sharedpath, destpath)]):
+            # Evicted by another process before it could be linked.
+            with self._store.fileLock(filepath):
+                sharedpath = shared.download(filepath)
+            if (not sharedpath or
+                self._linkShared([(filepath, sharedpath, destpath)])):
+                return None
+        self._synced.add(filepath)
+        return destpath
+
+    def _syncShared(self, filepaths):
+        """
+        Synchronize @p filepaths into the shared cache all at once, then
+        link them into this cache.
+        """
+        shared = self._sharedCache()
+        ok = shared.sync(filepaths)
+        links = []
+        for filepath in filepaths:
+            sharedpath = shared.getFile(filepath)
+            if os.path.exists(sharedpath):
+                links.append((filepath, sharedpath, self.getFile(filepath)))
+        missing = self._linkShared(links)
+        linked = set([link[0] for link in links]) - set(missing)
+        self._synced.update(linked)
+        return ok and len(linked) == len(filepaths)
+
+    def enableVerify(self, enable):
+        """
+        Enable checking the content of cached files against the manifest
+        when downloads are disabled, rather than just their existence.
+        """
+        self._verify = enable
+
+    def _remoteHashes(self):
+        """
+        Return the dictionary of remote hashes keyed by relative path,
+        fetching the remote manifest the first time.  The dictionary is
+        empty if there is no remote manifest.
+        """
+        self._remote_lock.acquire()
+        try:
+            if self._remote_hashes is None:
+                self._remote_hashes = {}
+                if self._remote_manifest and self._remote_prefix:
+                    self._remote_hashes = self._fetchRemoteManifest()
+            return self._remote_hashes
+        finally:
+            self._remote_lock.release()
+
+    def _fetchRemoteManifest(self):
+        remote = os.path.join(self._remote_prefix, self._remote_manifest)
+        (host, colon, lpath) = remote.partition(':')
+        if not colon or os.path.exists(lpath):
+            path = lpath if colon else remote
+            tmppath = None
+        else:
+            (fd, tmppath) = tempfile.mkstemp(prefix='datafilecache')
+            os.close(fd)
+            args = ['rsync', '-q', remote, tmppath]
+            print(" ".join(args))
+            if sp.call(args, shell=False) != 0:
+                print("*** Could not fetch remote manifest %s, "
+                      "data files will be synchronized with rsync." % (remote))
+                os.remove(tmppath)
+                return {}
+            path = tmppath
+        try:
+            try:
+                mfile = open(path)
+                try:
+                    hashes = _parse_md5sum(mfile.read())
+                finally:
+                    mfile.close()
+            except IOError as ex:
+                print("*** Could not read remote manifest %s: %s" %
+                      (remote, str(ex)))
+                hashes = {}
+        finally:
+            if tmppath:
+                os.remove(tmppath)
+        print("Remote manifest %s lists %d files." % (remote, len(hashes)))
+        return hashes
+
+    def _manifest(self, filepath, destpath):
+        "Return the _Manifest of the cache directory containing @p destpath."
+        cachedir = destpath[:len(destpath)-len(filepath)]
+        manifest = self._manifests.get(cachedir)
+        if manifest is None:
+            manifest = _Manifest(cachedir)
+            self._manifests[cachedir] = manifest
+        return manifest
+
+    def _hash(self, filepath, destpath, expected=None, recorded=False):
+        """
+        Return the hash of @p destpath from the manifest of its cache
+        directory, hashing the file if it changed.  A new hash is only
+        recorded if it matches @p expected, which defaults to the hash
+        recorded before.  If @p recorded is true, return a tuple of the
+        hash and the hash recorded before.
+        """
+        self._manifest_lock.acquire()
+        try:
+            manifest = self._manifest(filepath, destpath)
+            previous = manifest.recorded(filepath)
+            if expected is None:
+                expected = previous
+            md5 = manifest.hash(filepath, destpath, expected)
+        finally:
+            self._manifest_lock.release()
+        if recorded:
+            return (md5, previous)
+        return md5
+
+    def _saveManifests(self):
+        self._manifest_lock.acquire()
+        try:
+            for manifest in self._manifests.values():
+                manifest.save()
+        finally:
+            self._manifest_lock.release()
+
+    def _isCurrent(self, filepath, destpath):
         """
-        Sync all the files known about in the cache map.  Since this is
-        typically called as a SCons target, all the data files an
-        Environment uses should already have been registered with getFile()
-        and added to the map.  So a sync just requires iterating through
-        the map and calling rsync on each file.
+        Return true if the cached copy of @p filepath matches its hash in
+        the remote manifest.
+        """
+        expected = self._remoteHashes().get(filepath)
+        return bool(expected) and \
+            self._hash(filepath, destpath, expected) == expected
+
+    def _checkDownload(self, filepath, destpath):
         """
+        Record the hash of a file just downloaded to @p destpath, and
+        return false if it does not match the remote manifest.
+        """
+        expected = self._remoteHashes().get(filepath)
+        md5 = self._hash(filepath, destpath, expected or '')
+        if expected and md5 != expected:
+            print("*** Downloaded file %s does not match remote manifest: "
+                  "md5 %s, expected %s" % (destpath, md5, expected))
+            return False
+        return md5 is not None
+
+    def _verifyFile(self, filepath):
+        destpath = self.getFile(filepath)
+        if not os.path.exists(destpath):
+            print("*** Cached data file is missing: %s" % (destpath))
+            return False
+        expected = self._remoteHashes().get(filepath)
+        (md5, previous) = self._hash(filepath, destpath, expected,
+                                     recorded=True)
+        if expected and md5 != expected:
+            print("*** Cached data file does not match remote manifest: %s"
+                  % (destpath))
+            return False
+        if not expected and previous and md5 != previous:
+            print("*** Cached data file changed since it was downloaded: %s"
+                  % (destpath))
+            return False
+        return True
+
+    def verify(self, filepaths=None):
+        """
+        Verify the cached copies of all the registered files, or just the
+        relative paths in @p filepaths, and return true if all of them are
+        correct.  A file is correct if it matches its hash in the remote
+        manifest, if any, or else the hash recorded when it was downloaded.
+        Only the files whose size or modification time changed are hashed.
+        """
+        if filepaths is None:
+            filepaths = list(self._cached_paths.keys())
+        bad = [f for f in sorted(filepaths) if not self._verifyFile(f)]
+        self._saveManifests()
+        return not bad
+
+    def sync(self, filepaths=None):
+        """
+        Sync all the files known about in the cache map, or just the
+        relative paths in @p filepaths.  Since this is typically called as
+        a SCons target, all the data files an Environment uses should
+        already have been registered with getFile() and added to the map.
+
+        Rather than running rsync for each file, the files are grouped by
+        remote host and local cache directory, and each group is split
+        among a few rsync processes, each of which transfers its share of
+        the files with --files-from.  The rsync processes share one ssh
+        master connection to the host.  Files which are available locally
+        are linked with download() as usual.  Once a file is synchronized,
+        download() does not synchronize it again in the same process.
+        """
+        if filepaths is None:
+            filepaths = list(self._cached_paths.keys())
+        if not self._enable_download:
+            if self._verify:
+                return self.verify(filepaths)
+            missing = [f for f in filepaths
+                       if not os.path.exists(self.getFile(f))]
+            return not missing
+        if not self._remote_prefix:
+            raise Exception("Need a remote prefix to download data file.")
+        if self._store:
+            return self._syncShared(filepaths)
         ok = True
-        for filepath in self._cached_paths.keys():
-            if not self.download(filepath):
-                ok = False
+        groups = {}
+        current = 0
+        for filepath in sorted(filepaths):
+            destpath = self.getFile(filepath)
+            if self._isCurrent(filepath, destpath):
+                self._synced.add(filepath)
+                current += 1
+                continue
+            remote = os.path.join(self._remote_prefix, filepath)
+            (host, colon, lpath) = remote.partition(':')
+            if not colon or os.path.exists(lpath):
+                if self.download(filepath):
+                    self._synced.add(filepath)
+                else:
+                    ok = False
+                continue
+            cachedir = destpath[:len(destpath)-len(filepath)]
+            remotedir = remote[:len(remote)-len(filepath)]
+            groups.setdefault((host, remotedir, cachedir), []).append(filepath)
+        start = time.time()
+        nbytes = 0
+        nfiles = 0
+        for (host, remotedir, cachedir), files in sorted(groups.items()):
+            (gok, gbytes) = self._rsyncFiles(host, remotedir, cachedir, files)
+            ok = ok and gok
+            nbytes += gbytes
+            nfiles += len(files)
+        self._saveManifests()
+        if current:
+            print("%d data files already match the remote manifest." %
+                  (current))
+        if nfiles:
+            elapsed = max(time.time() - start, 0.001)
+            print("Synchronized %d files from %d hosts, transferred %.1f MB "
+                  "in %.1f s (%.2f MB/s)" %
+                  (nfiles, len(set([g[0] for g in groups])), nbytes / 1e6,
+                   elapsed, nbytes / 1e6 / elapsed))
         return ok
 
+    def _sshCommand(self, host):
+        """
+        Return the ssh command for rsync to use with a master connection to
+        @p host, after starting the master connection if possible.
+        """
+        control = os.path.join(tempfile.gettempdir(),
+                               "datafilecache-%d-%%r@%%h:%%p" % (os.getpid()))
+        ssh = ['ssh', '-o', 'ControlPath=%s' % (control)]
+        master = ssh + ['-o', 'ControlMaster=auto', '-o', 'ControlPersist=60',
+                        '-f', '-N', host]
+        print(" ".join(master))
+        if sp.call(master, shell=False) != 0:
+            print("*** Could not start ssh master connection to %s." % (host))
+        return " ".join(ssh)
+
+    def _rsyncFiles(self, host, remotedir, cachedir, files):
+        """
+        Synchronize the relative @p files from @p remotedir into
+        @p cachedir with up to the configured number of rsync processes.
+        Return the tuple of whether all the files were synchronized and
+        the number of bytes transferred.
+        """
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        ssh = self._sshCommand(host)
+        nworkers = min(self._sync_workers, len(files))
+        workers = []
+        for i in range(nworkers):
+            listfile = tempfile.NamedTemporaryFile(mode='w', delete=False,
+                                                   prefix='datafilecache')
+            listfile.write("\n".join(files[i::nworkers]) + "\n")
+            listfile.close()
+            args = ['rsync', '-t', '-e', ssh, '--out-format=%b %n',
+                    '--files-from=%s' % (listfile.name), remotedir, cachedir]
+            print(" ".join(args))
+            workers.append((sp.Popen(args, stdout=sp.PIPE,
+                                     universal_newlines=True, shell=False),
+                            listfile.name))
+        ok = True
+        nbytes = 0
+        for (pipe, listname) in workers:
+            for line in pipe.stdout:
+                (transferred, sep, name) = line.strip().partition(' ')
+                if transferred.isdigit():
+                    nbytes += int(transferred)
+                    if name and not name.endswith('/'):
+                        print(name)
+            if pipe.wait() != 0:
+                ok = False
+            os.remove(listname)
+        for filepath in files:
+            destpath = os.path.join(cachedir, filepath)
+            if not os.path.isfile(destpath):
+                print("*** rsync failed to download: %s" %
+                      (os.path.join(remotedir, filepath)))
+                ok = False
+            elif self._checkDownload(filepath, destpath):
+                self._synced.add(filepath)
+            else:
+                ok = False
+        if not ok:
+            print("*** Check that host %s is configured in ssh/config."
+                  % (host))
+        return (ok, nbytes)
+
     def enableDownload(self, enable):
         self._enable_download = enable
 
@@ -131,7 +845,17 @@ class DataFileCache(object):
         Run rsync to download the canonical filepath into the cache.
 
         If downloading is disabled, then just return true if the file
-        already exists, false otherwise.
+        already exists, false otherwise.  If verification is enabled, the
+        file must also match its hash in the manifest.
+
+        With a shared cache, the file is downloaded into the shared cache
+        only if it is not there already, unless forceSharedSync() is
+        enabled or there is a remote manifest to check it against.  Then it
+        is linked into this cache.
+
+        If the cached copy already matches the remote manifest, it is not
+        synchronized again.  A downloaded file is hashed and recorded in
+        the manifest, and fails if it does not match the remote manifest.
 
         If the file exists locally at the master path (ie, with any
         hostname specifier stripped), assume that's the source data file
@@ -149,7 +873,25 @@ class DataFileCache(object):
         destpath = self.getFile(filepath)
         destdir = os.path.dirname(destpath)
         if not self._enable_download:
+            if self._store and not os.path.exists(destpath):
+                # Linking a file already in the shared cache is not a
+                # download.
+                sharedpath = self._sharedCache().getFile(filepath)
+                self._linkShared([(filepath, sharedpath, destpath)])
+            if self._verify:
+                return self.verify([filepath])
             return os.path.exists(destpath)
+        if filepath in self._synced and os.path.exists(destpath):
+            return destpath
+        if self._store:
+            if not self._remote_prefix:
+                raise Exception("Need a remote prefix to download data file.")
+            return self._downloadShared(filepath, destpath)
+        if self._isCurrent(filepath, destpath):
+            self._synced.add(filepath)
+            self._saveManifests()
+            return destpath
+        relpath = filepath
         # The prefix is still needed, esp if it specifies the remote host.
         if not self._remote_prefix:
             raise Exception("Need a remote prefix to download data file.")
@@ -173,6 +915,9 @@ class DataFileCache(object):
             destpath = None
         else:
             destpath = self._link(filepath, destpath)
+        if destpath and not self._checkDownload(relpath, destpath):
+            destpath = None
+        self._saveManifests()
         if not destpath and colon:
             print("*** Check that host %s is configured in ssh/config."
                   % (host))
@@ -314,3 +1059,122 @@ def test_cachepaths():
     assert(dfcache.localDownloadPath() == os.getenv('HOME'))
 
 
+def test_manifest(tmpdir):
+    remote = tmpdir.mkdir('remote')
+    remote.join('A').mkdir()
+    remote.join('A', 'f1.nc').write('one' * 1000)
+    remote.join('A', 'f2.nc').write('two' * 1000)
+    cache = tmpdir.mkdir('cache')
+    dfcache = DataFileCache(str(cache))
+    dfcache.setPrefix(str(remote))
+    assert(dfcache.download('A/f1.nc'))
+    assert(dfcache.download('A/f2.nc'))
+    manifest = _Manifest(str(cache))
+    assert(manifest.recorded('A/f1.nc') ==
+           _file_hash(str(remote.join('A', 'f1.nc'))))
+
+    # Nothing is hashed again while the files do not change.
+    dfcache = DataFileCache(str(cache))
+    dfcache.setPrefix(str(remote))
+    dfcache.enableDownload(False)
+    dfcache.enableVerify(True)
+    assert(dfcache.verify(['A/f1.nc', 'A/f2.nc']))
+    assert(sum([m.hashed for m in dfcache._manifests.values()]) == 0)
+
+    # A truncated file fails verification and is not recorded.
+    remote.join('A', 'f2.nc').write('two')
+    assert(not dfcache.download('A/f2.nc'))
+    assert(not dfcache.download('A/f2.nc'))
+
+    # The remote manifest overrides the recorded hash.
+    remote.join('MANIFEST.md5').write(
+        "%s  ./A/f1.nc\n%s *A/f2.nc\n" %
+        (_file_hash(str(remote.join('A', 'f1.nc'))),
+         _file_hash(str(remote.join('A', 'f2.nc')))))
+    dfcache.setRemoteManifest('MANIFEST.md5')
+    assert(dfcache.verify())
+    assert(len(dfcache._remoteHashes()) == 2)
+
+
+def test_shared_cache(tmpdir):
+    remote = tmpdir.mkdir('remote')
+    remote.mkdir('A')
+    for i in range(1, 5):
+        remote.join('A', 'f%d.nc' % i).write('x' * 2000 * i)
+    shared = str(tmpdir.join('shared'))
+    trees = []
+    for tree in ['tree1', 'tree2']:
+        dfcache = DataFileCache(str(tmpdir.join(tree)))
+        dfcache.setPrefix(str(remote))
+        dfcache.setSharedCache(shared, '10K')
+        trees.append(dfcache)
+    assert(trees[0].download('A/f1.nc'))
+    assert(trees[1].download('A/f1.nc'))
+    assert(os.path.samefile(trees[0].getFile('A/f1.nc'),
+                            os.path.join(shared, 'A/f1.nc')))
+    assert(os.path.samefile(trees[1].getFile('A/f1.nc'),
+                            os.path.join(shared, 'A/f1.nc')))
+
+    # Adding f2 and f3 to the shared cache exceeds 10K, so the least
+    # recently used file not registered by the tree is evicted.
+    assert(trees[1].sync(['A/f2.nc']))
+    dfcache = DataFileCache(str(tmpdir.join('tree3')))
+    dfcache.setPrefix(str(remote))
+    dfcache.setSharedCache(shared, '10K')
+    assert(dfcache.download('A/f3.nc'))
+    index = _SharedStore(shared)._load()
+    assert(sorted(index.keys()) == ['A/f2.nc', 'A/f3.nc'])
+    assert(not os.path.exists(os.path.join(shared, 'A/f1.nc')))
+    assert(os.path.exists(trees[0].getFile('A/f1.nc')))
+
+
+def test_shared_cache_copy(tmpdir, monkeypatch):
+    # Shared copies which cannot be hard linked or reflinked are copied.
+    shared = tmpdir.mkdir('shared')
+    shared.mkdir('A')
+    for i in range(1, 4):
+        shared.join('A', 'f%d.nc' % i).write('x' * 2000 * i)
+    def nolink(src, dst):
+        raise OSError("links not supported")
+    commands = []
+    def call(cmd, **kw):
+        commands.append(cmd[:2])
+        return 1
+    clock = [1000.0]
+    def now():
+        clock[0] += 1
+        return clock[0]
+    monkeypatch.setattr(os, 'link', nolink)
+    monkeypatch.setattr(sp, 'call', call)
+    monkeypatch.setattr(time, 'time', now)
+
+    def link(store, tree, filepath):
+        destpath = str(tmpdir.join(tree, filepath))
+        assert(not store.materialize([(filepath, str(shared.join(filepath)),
+                                       destpath)]))
+        return destpath
+
+    store1 = _SharedStore(str(shared), '10K')
+    f1 = link(store1, 'tree1', 'A/f1.nc')
+    assert(commands == [['cp', '--reflink=always']])
+    assert(not os.path.islink(f1))
+    assert(not os.path.samefile(f1, str(shared.join('A/f1.nc'))))
+    assert(open(f1).read() == 'x' * 2000)
+    link(store1, 'tree1', 'A/f2.nc')
+    # Using f1 again makes f2 the least recently used file.
+    link(store1, 'tree1', 'A/f1.nc')
+
+    # Adding f3 from another tree exceeds 10K, so the least recently used
+    # file is evicted, while the copy in tree1 stays.
+    store2 = _SharedStore(str(shared), '10K')
+    link(store2, 'tree2', 'A/f3.nc')
+    index = store2._load()
+    assert(sorted(index.keys()) == ['A/f1.nc', 'A/f3.nc'])
+    assert(index['A/f3.nc']['size'] == 6000)
+    assert(not shared.join('A', 'f2.nc').exists())
+    assert(tmpdir.join('tree1', 'A', 'f2.nc').exists())
+    # Files used by this process are never evicted, even over the limit.
+    link(store2, 'tree2', 'A/f1.nc')
+    shared.join('A', 'f4.nc').write('x' * 8000)
+    link(store2, 'tree2', 'A/f4.nc')
+    assert(sorted(store2._load().keys()) == ['A/f1.nc', 'A/f3.nc', 'A/f4.nc'])
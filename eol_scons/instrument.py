@@ -0,0 +1,259 @@
+# -*- python -*-
+# Copyright 2007 UCAR, NCAR, All Rights Reserved
+
+"""
+Opt-in instrumentation of the eol_scons startup, to find which tools and
+SConscript directories dominate the time it takes scons to read the
+SConscript files.
+
+Instrumentation is enabled by the eolsconsprofile variable, set on the
+scons command line or in config.py like the other eol_scons settings, or by
+setting EOL_SCONS_PROFILE=1 in the process environment.  Then eol_scons
+records a span for every tool application (_Tool), every Require() call,
+every config script query, every FindPackagePath() glob, and every Update()
+of the global variables.  Each span records its wall time, the number of
+config script and git processes run while it was open, and the time spent
+waiting on those processes.  Spans nest, and each span is attributed to the
+directory of the Environment it was applied to.
+
+At exit a report is printed with the spans aggregated by category and
+name, sorted by total time, followed by the time attributed to each
+Environment directory.  A trace of every span is also written in the
+Chrome trace event format to eolscons_trace.json in the top directory,
+where it can be loaded in chrome://tracing or https://ui.perfetto.dev.
+Each Environment appears as a separate thread in the trace.
+
+Code which wants to be instrumented opens a span with a with statement:
+
+    with instrument.Span('tool', name, env):
+        tool(env)
+
+Code which runs a subprocess wraps it the same way, so the process is
+counted in the open spans:
+
+    with instrument.Process():
+        output = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()
+
+When instrumentation is disabled, Span() and Process() return a shared
+no-op object.
+"""
+
+import os
+import time
+import json
+import atexit
+import threading
+
+import eol_scons.debug
+
+_enabled = None
+_trace_file = "eolscons_trace.json"
+
+_lock = threading.Lock()
+_stack = []
+_spans = []
+_envs = {}
+_topdir = None
+_t0 = time.time()
+
+
+class _Span(object):
+
+    def __init__(self, category, name, env):
+        self.category = category
+        self.name = name
+        self.env = _env_label(env)
+        self.start = None
+        self.end = None
+        self.nproc = 0
+        self.proctime = 0.0
+        self.depth = 0
+
+    def __enter__(self):
+        _lock.acquire()
+        try:
+            self.depth = len(_stack)
+            _stack.append(self)
+        finally:
+            _lock.release()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.end = time.time()
+        _lock.acquire()
+        try:
+            if self in _stack:
+                _stack.remove(self)
+            _spans.append(self)
+        finally:
+            _lock.release()
+        return False
+
+
+class _NoSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_nospan = _NoSpan()
+
+
+def _env_label(env):
+    """
+    Return the (index, subdir) label for @p env, where the index
+    distinguishes Environments created in the same directory.
+    """
+    global _topdir
+    if env is None:
+        return (0, 'global')
+    label = _envs.get(id(env))
+    if label is None:
+        if _topdir is None:
+            _topdir = env.Dir('#').get_abspath()
+        label = (len(_envs) + 1, eol_scons.debug.GetSubdir(env))
+        _envs[id(env)] = label
+    return label
+
+
+class _Process(object):
+
+    def __init__(self):
+        self.start = None
+        self.spans = []
+
+    def __enter__(self):
+        self.start = time.time()
+        _lock.acquire()
+        try:
+            self.spans = list(_stack)
+            for span in self.spans:
+                span.nproc += 1
+        finally:
+            _lock.release()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.time() - self.start
+        _lock.acquire()
+        try:
+            for span in self.spans:
+                span.proctime += elapsed
+        finally:
+            _lock.release()
+        return False
+
+
+def Enabled(env=None):
+    """
+    Return True if instrumentation is enabled.  The first time it is found
+    to be enabled, register the report to be written at exit.  The setting
+    is looked up in @p env if given, and until it is known it is not
+    enabled.
+    """
+    global _enabled
+    if _enabled is not None:
+        return _enabled
+    import SCons.Script
+    import eol_scons.variables
+    setting = os.environ.get('EOL_SCONS_PROFILE')
+    if setting is not None:
+        enabled = setting.lower() in ('y', 'yes', 't', 'true', '1', 'on')
+    elif ((env is not None and env.has_key('eolsconsprofile')) or
+          'eolsconsprofile' in SCons.Script.ARGUMENTS):
+        enabled = eol_scons.variables._bool_setting(
+            env if env is not None else {}, 'eolsconsprofile', False)
+    else:
+        # Too early to know, so check again next time.
+        return False
+    _enabled = enabled
+    if _enabled:
+        atexit.register(_write_results)
+    return _enabled
+
+
+def Span(category, name, env=None):
+    "Return a context manager which records a span if enabled."
+    if not Enabled(env):
+        return _nospan
+    return _Span(category, name, env)
+
+
+def Process():
+    """
+    Return a context manager which counts the subprocess run inside it in
+    the open spans, if enabled.
+    """
+    if not Enabled():
+        return _nospan
+    return _Process()
+
+
+def Report():
+    """
+    Return the report text of the spans aggregated by category and name,
+    and of the top-level time spent in each Environment directory.
+    """
+    totals = {}
+    for span in _spans:
+        key = (span.category, span.name)
+        t = totals.setdefault(key, [0, 0.0, 0, 0.0])
+        t[0] += 1
+        t[1] += span.end - span.start
+        t[2] += span.nproc
+        t[3] += span.proctime
+    rows = sorted(totals.items(), key=lambda item: -item[1][1])
+    lines = ["eol_scons startup profile: %d spans, %.3f s since import" %
+             (len(_spans), time.time() - _t0),
+             "%-10s %-40s %6s %9s %6s %9s" %
+             ("category", "name", "calls", "total(s)", "procs", "proc(s)")]
+    for ((category, name), t) in rows:
+        lines.append("%-10s %-40s %6d %9.3f %6d %9.3f" %
+                     (category, name[:40], t[0], t[1], t[2], t[3]))
+    # Only the outermost spans count towards each directory, so nested
+    # spans are not counted twice.
+    dirs = {}
+    for span in _spans:
+        if span.depth == 0:
+            dirs[span.env[1]] = dirs.get(span.env[1], 0.0) + \
+                                span.end - span.start
+    lines.append("")
+    lines.append("%-51s %9s" % ("environment directory", "total(s)"))
+    for (subdir, total) in sorted(dirs.items(), key=lambda item: -item[1]):
+        lines.append("%-51s %9.3f" % (subdir[:51], total))
+    return "\n".join(lines)
+
+
+def TraceEvents():
+    "Return the list of spans as Chrome trace events."
+    pid = os.getpid()
+    events = []
+    for (index, subdir) in sorted(set(_envs.values()) | set([(0, 'global')])):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': index, 'args': {'name': subdir}})
+    for span in _spans:
+        events.append({'name': span.name, 'cat': span.category, 'ph': 'X',
+                       'pid': pid, 'tid': span.env[0],
+                       'ts': int((span.start - _t0) * 1e6),
+                       'dur': int((span.end - span.start) * 1e6),
+                       'args': {'subprocesses': span.nproc,
+                                'subprocess_time': span.proctime}})
+    return events
+
+
+def _write_results():
+    print(Report())
+    path = os.path.join(_topdir or os.getcwd(), _trace_file)
+    try:
+        tfile = open(path, 'w')
+        try:
+            json.dump({'traceEvents': TraceEvents()}, tfile)
+        finally:
+            tfile.close()
+        print("eol_scons trace written to %s" % (path))
+    except (IOError, OSError) as ex:
+        print("Failed to write eol_scons trace %s: %s" % (path, str(ex)))
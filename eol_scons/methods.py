@@ -1,7 +1,7 @@
 # -*- python -*-
 # Copyright 2007 UCAR, NCAR, All Rights Reserved
 
-import os, re, glob
+import os, re, glob, fnmatch
 
 import SCons.Util
 from SCons.Util import NodeList
@@ -11,11 +11,18 @@ from SCons.Script.SConscript import global_exports
 
 import variables as es_vars
 import tool as es_tool
+import eol_scons.toolfiles as es_toolfiles
+import eol_scons.toolmanifest as es_manifest
+import eol_scons.instrument as es_instrument
 import eol_scons.debug as esd
 import chdir
 
 _global_targets = {}
+# The ToolFileIndex of tool_*.py files in the source tree.
 _tool_matches = None
+_tool_index_file = "#/toolfiles.cache"
+# FindPackagePath() matches for each absolute glob pattern in this process.
+_package_globs = {}
 
 """ Custom methods for the SCons Environment class.
 
@@ -40,11 +47,13 @@ def _Require(env, tools):
     applied = []
     if not isinstance(tools, type([])):
         tools = [tools]
-    env.LogDebug("eol_scons.Require[%s]" % ",".join([str(x) for x in tools]))
-    for t in tools:
-        tool = env.Tool(t)
-        if tool:
-            applied.append(tool)
+    names = ",".join([_tool_label(x) for x in tools])
+    env.LogDebug("eol_scons.Require[%s]" % names)
+    with es_instrument.Span('require', names, env):
+        for t in tools:
+            tool = env.Tool(t)
+            if tool:
+                applied.append(tool)
     return applied
 
 
@@ -153,6 +162,63 @@ def _AppendSharedLibrary(env, name, path=None):
     env.AppendUnique(LIBPATH=[path])
     env.AppendUnique(RPATH=[path])
 
+def _glob_dirs(pattern):
+    """
+    Return the list of directories matching glob @p pattern, and the list
+    of directories which were listed to find them.  Matches can only be
+    added or removed by changing one of the listed directories, so their
+    modification times validate the matches.
+    """
+    (dirname, basename) = os.path.split(pattern)
+    if glob.has_magic(dirname):
+        (parents, listed) = _glob_dirs(dirname)
+    else:
+        (parents, listed) = ([dirname], [])
+    matches = []
+    for parent in parents:
+        listed.append(parent or os.curdir)
+        if not glob.has_magic(basename):
+            if os.path.isdir(os.path.join(parent, basename)):
+                matches.append(os.path.join(parent, basename))
+            continue
+        try:
+            names = os.listdir(parent or os.curdir)
+        except OSError:
+            names = []
+        if not basename.startswith('.'):
+            names = [n for n in names if not n.startswith('.')]
+        for name in fnmatch.filter(names, basename):
+            path = os.path.join(parent, name)
+            if os.path.isdir(path):
+                matches.append(path)
+    return (matches, listed)
+
+
+def _find_package_dirs(env, pattern):
+    """
+    Return the directories matching @p pattern in reverse sorted order.
+    The matches are kept for the rest of the process, and they are stored
+    in the tool settings cache with the modification times of the
+    directories which were listed, so later runs only need to stat those
+    directories instead of listing them and stat'ing every match, which
+    can be slow on network filesystems.
+    """
+    key = os.path.join(os.getcwd(), pattern)
+    dirs = _package_globs.get(key)
+    if dirs is not None:
+        return dirs
+    cache = es_vars.ToolCacheVariables(env)
+    name = "FindPackagePath:" + key
+    dirs = cache.lookup(env, name)
+    if dirs is None:
+        (dirs, listed) = _glob_dirs(pattern)
+        dirs.sort()
+        dirs.reverse()
+        cache.store(env, name, dirs, listed)
+    _package_globs[key] = dirs
+    return dirs
+
+
 def _FindPackagePath(env, optvar, globspec, defaultpath=None):
     """Check for a package installation path matching globspec."""
     options = es_vars.GlobalVariables()
@@ -163,13 +229,10 @@ def _FindPackagePath(env, optvar, globspec, defaultpath=None):
         if not env:
             env = DefaultEnvironment()
         options.Update(env)
-        dirs = glob.glob(env.subst(globspec))
-        dirs.sort()
-        dirs.reverse()
-        for d in dirs:
-            if os.path.isdir(d):
-                pdir = d
-                break
+        with es_instrument.Span('glob', globspec, env):
+            dirs = _find_package_dirs(env, env.subst(globspec))
+        if dirs:
+            pdir = dirs[0]
     return pdir
 
 
@@ -205,41 +268,19 @@ def _GlobalTools(env):
 
 def _findToolFile(env, name):
     global _tool_matches
-    # Need to know if the cache is enabled or not.
-    es_vars._update_variables(env)
-    cache = es_vars.ToolCacheVariables(env)
-    toolcache = cache.getPath()
-    if _tool_matches == None:
-        cvalue = cache.lookup(env, '_tool_matches')
-        if cvalue:
-            _tool_matches = cvalue.split("\n")
-            print("Using %d cached tool filenames from %s" % 
-                  (len(_tool_matches), toolcache))
-
     if _tool_matches == None:
-        print("Searching for tool_*.py files...")
-        # Get a list of all files named "tool_<tool>.py" under the
-        # top directory.
-        toolpattern = re.compile(r"^tool_.*\.py")
-        def addMatches(matchList, dirname, contents):
-            matchList.extend([os.path.join(dirname, file) 
-                              for file in
-                              filter(toolpattern.match, contents)])
-            if '.svn' in contents:
-                contents.remove('.svn')
-            if 'site_scons' in contents:
-                contents.remove('site_scons')
-            if 'apidocs' in contents:
-                contents.remove('apidocs')
-        _tool_matches = []
-        os.path.walk(env.Dir('#').get_abspath(), addMatches, _tool_matches)
-        # Update the cache
-        cache.store(env, '_tool_matches', "\n".join(_tool_matches))
-        print("Found %d tool files in source tree, cached in %s" %
-              (len(_tool_matches), toolcache))
-
-    toolFileName = "tool_" + name + ".py"
-    return filter(lambda f: toolFileName == os.path.basename(f), _tool_matches)
+        topdir = env.Dir('#').get_abspath()
+        indexpath = env.File(_tool_index_file).get_abspath()
+        _tool_matches = es_toolfiles.ToolFileIndex(topdir, indexpath)
+        if _tool_matches.update():
+            print("Found %d tool files in source tree "
+                  "(scanned %d directories), cached in %s" %
+                  (_tool_matches.numToolFiles(), _tool_matches.scanned,
+                   indexpath))
+        else:
+            print("Using %d cached tool filenames from %s" %
+                  (_tool_matches.numToolFiles(), indexpath))
+    return _tool_matches.findToolFiles(name)
 
 
 def _loadToolFile(env, name):
@@ -268,6 +309,25 @@ def _loadToolFile(env, name):
     return tool
 
 
+def _loadExportedTool(env, name, toolpath):
+    """
+    Look up @p name in the tool manifest, and if it is exported by a tool
+    module, import that module without applying it and return the exported
+    tool.
+    """
+    if not es_vars._bool_setting(env, 'eolsconsmanifest', True):
+        return None
+    module = es_manifest.GetToolManifest(env).exportingModule(name)
+    if not module:
+        return None
+    env.LogDebug("Importing tool module %s to get tool %s" % (module, name))
+    if toolpath is None:
+        toolpath = env.get('toolpath', [])
+    toolpath = map(env._find_toolpath_dir, toolpath)
+    SCons.Tool.Tool(module, toolpath)
+    return global_exports.get(name)
+
+
 # This serves as a cache for certain kinds of tools which only need to be
 # loaded and instantiated once.  The name is mapped to the resolved python
 # function.  For example, tool_<name>.py files only need to be loaded once
@@ -279,7 +339,19 @@ def _loadToolFile(env, name):
 # they are still cached in the tool dictionary as before.
 tool_dict = {}
 
+def _tool_label(tool):
+    "Return a name for @p tool, which may be a name or a tool function."
+    if SCons.Util.is_String(tool):
+        return tool
+    return getattr(tool, '__name__', str(tool))
+
+
 def _Tool(env, tool, toolpath=None, **kw):
+    with es_instrument.Span('tool', _tool_label(tool), env):
+        return _apply_tool(env, tool, toolpath, **kw)
+
+
+def _apply_tool(env, tool, toolpath=None, **kw):
     env.LogDebug("eol_scons.Tool(%s,%s,kw=%s)" % (env.Dir('.'), tool, str(kw)))
     name = str(tool)
     env.LogDebug("...before applying tool %s: %s" % (name, esd.Watches(env)))
@@ -327,8 +399,18 @@ def _Tool(env, tool, toolpath=None, **kw):
             env.LogDebug("Loading tool: %s" % name)
             if toolpath is None:
                 toolpath = env.get('toolpath', [])
-            toolpath = map(env._find_toolpath_dir, toolpath)
-            tool = apply(SCons.Tool.Tool, (name, toolpath), kw)
+            searchpath = map(env._find_toolpath_dir, toolpath)
+            try:
+                tool = apply(SCons.Tool.Tool, (name, searchpath), kw)
+            except SCons.Errors.EnvironmentError as ex:
+                # If the tool is a sub-tool exported by one of the
+                # eol_scons tool modules, import just that module to
+                # define it.  This comes after the toolpath search, so a
+                # tool module with the same name takes precedence.
+                tool = _loadExportedTool(env, name, toolpath)
+                if not tool:
+                    raise ex
+                tool_dict[name] = tool
             env.LogDebug("Tool loaded: %s" % name)
             # If the tool is not specialized with keywords, then we can 
             # stash this particular instance and avoid reloading it.
@@ -353,13 +435,16 @@ def _Tool(env, tool, toolpath=None, **kw):
     #
     return tool
 
-def _SetHelp(env, text=None):
+def _SetHelp(env, text=None, alltools=False):
     """
     Override the SConsEnvironment Help method to first erase any previous
     help text.  This can help if multiple SConstruct files in a project
     each try to generate the help text all at once.  If @p text is None,
     then generate the help text from the global variables.  To clear the
-    help text to an empty string, pass "" in @p text.
+    help text to an empty string, pass "" in @p text.  If @p alltools is
+    True, the generated help text also lists the variables declared by the
+    eol_scons tools which have not been loaded, taken from the tool
+    manifest, so the tools do not need to be loaded just to document them.
     """
     import SCons.Script
     SCons.Script.help_text = None
@@ -367,6 +452,9 @@ def _SetHelp(env, text=None):
         variables = env.GlobalVariables()
         variables.Update(env)
         text = variables.GenerateHelpText(env)
+        if alltools:
+            manifest = es_manifest.GetToolManifest(env)
+            text += manifest.HelpText(variables.keys())
 
     # It doesn't work to call the real Help() function because it performs
     # a substitution on the text.  There is already lots of variable help
@@ -0,0 +1,128 @@
+# -*- python -*-
+# Copyright 2007 UCAR, NCAR, All Rights Reserved
+
+"""
+Run the python function actions of scons targets from a ninja build file.
+
+When the ninja tool translates a node built by a python function, such as
+the headers from the gitinfo and svninfo tools or the source files from
+text2cc, it saves a specification of the call in a stubs file next to the
+ninja file: the module and name of the function, the target and source
+paths, the contents of any Value sources, and the construction variables
+the action depends on.  The ninja build statement runs this module as a
+script with the stubs file and the key of the specification:
+
+  python ninja_stub.py build.ninja.stubs <key>
+
+The script recreates the target and source nodes and a minimal
+Environment, and calls the function just like scons would, without reading
+any SConscript files.  The key is a hash of the specification, so ninja
+runs the function again whenever the specification changes.  If the
+function fails, the script runs the scons command in the specification to
+build the targets with scons instead.
+"""
+
+import os
+import sys
+import imp
+import subprocess
+import traceback
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+_stubs_version = 1
+
+
+def SourceFile(path):
+    "Return the absolute path to the python source for module file @p path."
+    path = os.path.abspath(path)
+    if path.endswith('.pyc') or path.endswith('.pyo'):
+        path = path[:-1]
+    return path
+
+
+def WriteStubs(path, stubs):
+    """
+    Write the dictionary @p stubs of specifications by key to @p path,
+    along with the python path needed to import SCons and eol_scons.
+    """
+    import SCons
+    pythonpath = [os.path.dirname(os.path.dirname(SourceFile(SCons.__file__))),
+                  os.path.dirname(os.path.dirname(SourceFile(__file__)))]
+    tmppath = "%s.%d" % (path, os.getpid())
+    sfile = open(tmppath, 'wb')
+    try:
+        pickle.dump({'version': _stubs_version, 'path': pythonpath,
+                     'stubs': stubs}, sfile, 2)
+    finally:
+        sfile.close()
+    os.rename(tmppath, path)
+
+
+def _load_function(spec):
+    "Import the module of the function in @p spec and return the function."
+    module = sys.modules.get(spec['module'])
+    if module is None:
+        try:
+            __import__(spec['module'])
+            module = sys.modules[spec['module']]
+        except ImportError:
+            module = imp.load_source(spec['module'], spec['file'])
+    return getattr(module, spec['function'])
+
+
+def _call_function(spec):
+    "Call the function in @p spec and return its status."
+    import SCons.Environment
+    import SCons.Node.FS
+    import SCons.Node.Python
+    # Tool modules can refer to the default filesystem when loaded.
+    SCons.Node.FS.get_default_fs()
+    env = SCons.Environment.Base(tools=[])
+    function = _load_function(spec)
+    env.Replace(**spec['env'])
+    env['ENV'] = spec['ENV']
+    targets = [env.File(t) for t in spec['targets']]
+    sources = []
+    for (stype, value) in spec['sources']:
+        if stype == 'value':
+            sources.append(SCons.Node.Python.Value(value))
+        else:
+            sources.append(env.File(value))
+    return function(target=targets, source=sources, env=env)
+
+
+def RunStub(path, key):
+    "Run the function action with @p key in stubs file @p path."
+    sfile = open(path, 'rb')
+    try:
+        data = pickle.load(sfile)
+    finally:
+        sfile.close()
+    if data.get('version') != _stubs_version:
+        raise RuntimeError("%s: unknown stubs file version" % (path))
+    spec = data['stubs'][key]
+    sys.path[0:0] = data['path']
+    try:
+        status = _call_function(spec)
+    except Exception:
+        if not spec.get('scons'):
+            raise
+        traceback.print_exc()
+        status = 1
+    if status and spec.get('scons'):
+        sys.stderr.write("%s failed, building %s with scons instead.\n" %
+                         (spec['function'], ' '.join(spec['targets'])))
+        sys.stderr.flush()
+        status = subprocess.call(spec['scons'], cwd=spec.get('cwd'))
+    return status
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.stderr.write("usage: %s <stubs file> <key>\n" % (sys.argv[0]))
+        sys.exit(2)
+    sys.exit(RunStub(sys.argv[1], sys.argv[2]) or 0)
@@ -3,13 +3,23 @@
 
 import os
 import re
+import atexit
+import threading
 
 import subprocess as sp
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 _debug = False
 
 import SCons.Util
 
+import eol_scons.variables as esv
+import eol_scons.instrument as instrument
+
 is_String = SCons.Util.is_String
 is_List = SCons.Util.is_List
 
@@ -37,24 +47,320 @@ def _string_env(env):
     return new_env
 
 
-def _extract_results(text):
-    # The string result and integer returncode are coded in the cached
-    # string as '<returncode>,<resultstring>'.  Sometimes the result
-    # strings have more than one line, so we must be careful to extract the
-    # rest of the string, including any newlines.
-    m = re.match(r"^([-+]?\d+),", text)
-    if m:
-        return (int(m.group(1)), text[m.end():])
+# The construction and process environment variables which can change the
+# output of a config script, and which therefore are part of the key for
+# results cached across builds.
+_fingerprint_vars = ['PATH', 'PKG_CONFIG_PATH', 'PKG_CONFIG_LIBDIR',
+                     'PKG_CONFIG_SYSROOT_DIR', 'LD_LIBRARY_PATH']
+
+_config_cache_file = "#/config.cache"
+_config_cache_version = 1
+_persistent_cache = None
+
+# The maximum number of config scripts run at once by PrefetchConfig().
+_prefetch_jobs = 8
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class ConfigScriptCache(object):
+    """
+    A file-backed store of config script results which persists across
+    scons runs, so that a warm startup does not need to run any config
+    scripts at all.
+
+    Each result is keyed by the query itself: the real path of the config
+    script, the arguments, and the values of the variables in
+    _fingerprint_vars as passed to the script.  Each result also carries
+    validation info: the modification time of the script and, for
+    pkg-config queries, the modification times of the pkg-config search
+    directories and of the .pc files for the packages named in the query
+    and for the packages they require.  A cached result is only used if
+    the validation info still matches the filesystem, otherwise the script
+    is run again and the entry replaced.
+
+    The file is read once, on the first lookup, and written once at exit,
+    only if some entry changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+        self.dirty = False
+        atexit.register(self.flush)
+
+    def getPath(self):
+        return self.path
+
+    def _load(self):
+        self.entries = {}
+        try:
+            cfile = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            try:
+                data = pickle.load(cfile)
+            except Exception:
+                print("Ignoring unreadable config script cache: %s" %
+                      (self.path))
+                return
+        finally:
+            cfile.close()
+        if data.get('version') == _config_cache_version:
+            self.entries = data['entries']
+
+    def lookup(self, key, validation):
+        """
+        Return the cached (returncode, output) tuple for @p key, or None if
+        there is no entry or it no longer matches @p validation.
+        """
+        if self.entries is None:
+            self._load()
+        entry = self.entries.get(key)
+        if entry and entry[0] == validation:
+            return entry[1]
+        return None
+
+    def store(self, key, validation, result):
+        if self.entries is None:
+            self._load()
+        self.entries[key] = (validation, result)
+        self.dirty = True
+
+    def flush(self):
+        "Write the cache file if anything changed since it was loaded."
+        if not self.dirty:
+            return
+        tmppath = "%s.%d" % (self.path, os.getpid())
+        try:
+            cfile = open(tmppath, 'wb')
+            try:
+                pickle.dump({'version': _config_cache_version,
+                             'entries': self.entries}, cfile, 2)
+            finally:
+                cfile.close()
+            os.rename(tmppath, self.path)
+            self.dirty = False
+        except (IOError, OSError) as ex:
+            print("Failed to write config script cache %s: %s" %
+                  (self.path, str(ex)))
+
+
+def PersistentConfigCache(env):
+    """
+    Return the ConfigScriptCache singleton, or None if the persistent
+    cache has been disabled with eolsconsconfigcache=0.
+    """
+    global _persistent_cache
+    if not esv._bool_setting(env, 'eolsconsconfigcache', True):
+        return None
+    if _persistent_cache is None:
+        cfile = env.File(_config_cache_file).get_abspath()
+        _persistent_cache = ConfigScriptCache(cfile)
+        print("Config script cache: %s" % (_persistent_cache.getPath()))
+    return _persistent_cache
+
+
+_rx_pc_requires = re.compile(r"^Requires(\.private)?\s*:(.*)$", re.MULTILINE)
+_rx_pc_version = re.compile(r"(<=|>=|!=|=|<|>)\s*\S+")
+
+
+def _pc_requires(pcfile):
+    """
+    Return the names of the packages listed in the Requires and
+    Requires.private fields of the .pc file @p pcfile, without their
+    version constraints.
+    """
+    try:
+        pfile = open(pcfile)
+    except IOError:
+        return []
+    try:
+        text = pfile.read()
+    finally:
+        pfile.close()
+    names = []
+    for match in _rx_pc_requires.finditer(text):
+        value = _rx_pc_version.sub(' ', match.group(2))
+        names.extend([n for n in re.split(r"[,\s]+", value) if n])
+    return names
+
+
+def _pkgconfig_validation(env, config, args, psenv):
+    """
+    Return the modification times of the pkg-config search directories
+    and of the .pc files resolved for the packages named in @p args and
+    for all the packages they require, directly or indirectly.  The
+    search directories are included so that adding or replacing .pc files
+    anywhere on the search path invalidates the cached results, and the
+    required packages so that upgrading a dependency in place does too.
+    """
+    dirs = []
+    for var in ['PKG_CONFIG_PATH', 'PKG_CONFIG_LIBDIR']:
+        if psenv.get(var):
+            dirs.extend(psenv[var].split(os.pathsep))
+    if not psenv.get('PKG_CONFIG_LIBDIR'):
+        # The default search path is compiled into pkg-config, and this
+        # query is itself cached like any other.
+        pcpath = _get_config(env, None, config,
+                             ['--variable=pc_path', 'pkg-config'])
+        if pcpath[0] == 0:
+            dirs.extend(pcpath[1].split(os.pathsep))
+    dirs = [d for d in dirs if d]
+    packages = [a for a in args if not a.startswith('-')]
+    mtimes = [(d, _mtime(d)) for d in dirs]
+    seen = set()
+    while packages:
+        pkg = packages.pop(0)
+        if pkg in seen:
+            continue
+        seen.add(pkg)
+        for d in dirs:
+            pcfile = os.path.join(d, pkg + ".pc")
+            pctime = _mtime(pcfile)
+            if pctime is not None:
+                mtimes.append((pcfile, pctime))
+                packages.extend(_pc_requires(pcfile))
+                break
+    return tuple(mtimes)
+
+
+def _persistent_key(env, config, args, psenv):
+    """
+    Return the (key, validation) pair under which the result of running
+    @p config with @p args is stored in the persistent cache, or None if
+    the script cannot be located.
+    """
+    script = config
+    if not os.path.isabs(script):
+        script = env.WhereIs(config, psenv.get('PATH'))
+    if not script:
+        return None
+    script = os.path.realpath(script)
+    key = (script, tuple(args),
+           tuple([(v, psenv.get(v)) for v in _fingerprint_vars]))
+    validation = (_mtime(script),)
+    # The real path of pkg-config may be something else, like pkgconf.
+    pkgconfig = [os.path.basename(p) for p in [config, script]
+                 if 'pkg-config' in os.path.basename(p) or
+                 'pkgconf' in os.path.basename(p)]
+    if pkgconfig and args != ['--variable=pc_path', 'pkg-config']:
+        validation += _pkgconfig_validation(env, config, args, psenv)
+    return (key, validation)
+
+
+class ConfigResultStore(object):
+    """
+    The process-wide store of config script results, shared by all
+    Environments.
+
+    Results are keyed by the script, the search paths, the arguments, and
+    the string-converted ENV actually passed to the script, so the same
+    query made from any number of Environments with equivalent ENV
+    settings, such as clones, runs once and is stored once.  Each distinct
+    ENV is stored once and referred to by a small integer in the result
+    keys.  The hit and miss counters can be used to verify the reuse, see
+    ConfigResultStats().
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.envs = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, psenv, config_script, search_paths, args):
+        envkey = tuple(sorted(psenv.items()))
+        envid = self.envs.setdefault(envkey, len(self.envs))
+        return (envid, config_script, tuple(search_paths or []), tuple(args))
+
+    def lookup(self, key):
+        result = self.results.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def contains(self, key):
+        "Return true if @p key has a result, without counting a hit or miss."
+        return key in self.results
+
+    def store(self, key, result):
+        self.results[key] = result
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'results': len(self.results), 'environments': len(self.envs)}
+
+
+_config_results = ConfigResultStore()
+
+
+def ConfigResultStats():
+    """
+    Return a dictionary with the hits and misses counted by the config
+    result store, and the number of results and distinct ENV settings
+    stored in it.
+    """
+    return _config_results.stats()
+
+
+def _locate_config(env, search_paths, config_script):
+    """
+    Return the config script to run, either the path found on
+    @p search_paths, or the script name as given if there are no search
+    paths.  Return None if the script is not found on the search paths.
+    """
+    if search_paths:
+        search_paths = [ p for p in search_paths if os.path.exists(p) ]
+        env.LogDebug("Checking for %s in %s" % 
+                     (config_script, ",".join(search_paths)))
+        config = env.WhereIs(config_script, search_paths)
     else:
-        return (-1, text)
+        config = config_script
+    env.LogDebug("Found: %s" % config)
+    return config
 
 
-def getConfigCache(env):
-    cache = env.get("_config_cache")
-    if cache is None:
-        cache = {}
-        env["_config_cache"] = cache
-    return cache
+def _lookup_persistent(env, config, args, psenv):
+    """
+    Return a (result, pkey) tuple, where result is the result cached in the
+    persistent cache or None, and pkey is the (key, validation) pair to
+    store a new result, or None if the persistent cache is not used.
+    """
+    result = None
+    pkey = None
+    pcache = PersistentConfigCache(env)
+    if pcache:
+        pkey = _persistent_key(env, config, args, psenv)
+    if pkey:
+        result = pcache.lookup(pkey[0], pkey[1])
+        if result and _debug:
+            print("  persistent cache: %s" % (str(result)))
+    return (result, pkey)
+
+
+def _store_persistent(env, pkey, result):
+    if pkey:
+        PersistentConfigCache(env).store(pkey[0], pkey[1], result)
+
+
+def _run_config(config, args, psenv):
+    "Run the config script and return the (returncode, output) tuple."
+    if _debug:
+        print("calling Popen([%s])" % ",".join([config]+args))
+        print("\n".join(["%s=%s" % (k,v) for k,v in psenv.items()]))
+    with instrument.Process():
+        child = sp.Popen([config] + args, stdout=sp.PIPE, env=psenv)
+        output = child.communicate()[0].strip()
+    return (child.returncode, output)
 
 
 def _get_config(env, search_paths, config_script, args):
@@ -67,55 +373,130 @@ def _get_config(env, search_paths, config_script, args):
     If there is a non-zero return code from the config script command, then
     tools can continue with other methods of configuring the tool.
 
-    The config results are cached in the calling Environment, so the
-    command does not need to be run every time a tool needs to run the same
-    config script.  However, the results are specific to the Environment,
-    since the results can change depending upon the Environment running
-    them.  For example, PKG_CONFIG_PATH might be different for different
-    environments, and cross-build environments will return different
-    results.  The goal is to avoid redundant runs of the same config script
-    when called for the same environment, such as redundant applications of
-    the same tool.
+    The config results are cached in a store shared by all Environments,
+    so the command does not need to be run every time a tool needs to run
+    the same config script.  However, the results are specific to the ENV
+    of the Environment, since the results can change depending upon the
+    Environment running them.  For example, PKG_CONFIG_PATH might be
+    different for different environments, and cross-build environments
+    will return different results.  So the ENV passed to the script is part
+    of the cache key.  The goal is to avoid redundant runs of the same
+    config script when called for equivalent environments, such as
+    redundant applications of the same tool or clones of the same
+    Environment.
+
+    Results are also kept across builds in the persistent cache returned
+    by PersistentConfigCache(), keyed and validated as described in
+    ConfigScriptCache, so that the script only runs again when one of its
+    inputs changes.
     """
     result = None
     if _debug: print("_get_config(%s,%s): " % (config_script, ",".join(args)))
+    # The env dictionary must be converted to strings or else execve()
+    # complains.  The converted dictionary is also part of the cache key.
+    psenv = _string_env(env['ENV'])
+    if False:
+        # This is not done by default because it violates the scons
+        # principle of precisely controlling the build environment.
+        PassPkgConfigPath(env, psenv)
     # See if the output for this config script call has already been cached.
-    name = re.sub(r'[^\w]', '_', config_script + " ".join(args))
-    cache = getConfigCache(env)
-    result = cache.get(name)
+    key = _config_results.key(psenv, config_script, search_paths, args)
+    result = _config_results.lookup(key)
     if result:
-        if _debug: print("  cached: %s" % (result))
-        return _extract_results(result)
-    if not result:
-        if search_paths:
-            search_paths = [ p for p in search_paths if os.path.exists(p) ]
-            env.LogDebug("Checking for %s in %s" % 
-                         (config_script, ",".join(search_paths)))
-            config = env.WhereIs(config_script, search_paths)
-        else:
-            config = config_script
-        env.LogDebug("Found: %s" % config)
-    if not result and config:
-        # The env dictionary must be converted to strings or else
-        # execve() complains.
-        psenv = _string_env(env['ENV'])
-        if False:
-            # This is not done by default because it violates the scons
-            # principle of precisely controlling the build environment.
-            PassPkgConfigPath(env, psenv)
-        if _debug:
-            print("calling Popen([%s])" % ",".join([config]+args))
-            print("\n".join(["%s=%s" % (k,v) for k,v in psenv.items()]))
-        child = sp.Popen([config] + args, stdout=sp.PIPE, env=psenv)
-        result = child.communicate()[0].strip()
-        cache[name] = "%s,%s" % (child.returncode, result)
-        result = (child.returncode, result)
+        if _debug: print("  cached: %s" % (str(result)))
+        return result
+    with instrument.Span('config', " ".join([config_script] + args), env):
+        config = _locate_config(env, search_paths, config_script)
+        if config:
+            (result, pkey) = _lookup_persistent(env, config, args, psenv)
+            if not result:
+                result = _run_config(config, args, psenv)
+                _store_persistent(env, pkey, result)
+            _config_results.store(key, result)
     if not result:
         result = (-1, "")
     if _debug: print("   command: %s" % (str(result)))
     return result
 
 
+def _run_concurrently(queries, psenv):
+    """
+    Run each (key, config, args) query in @p queries using a pool of at
+    most _prefetch_jobs threads, and return a dictionary mapping each key
+    to its (returncode, output) result.  Queries whose script cannot be
+    run are left out of the results.
+    """
+    results = {}
+    queue = list(queries)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not queue:
+                    return
+                (key, config, args) = queue.pop(0)
+            finally:
+                lock.release()
+            try:
+                results[key] = _run_config(config, args, psenv)
+            except OSError:
+                pass
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(_prefetch_jobs, len(queue)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def PrefetchConfig(env, commands, search_paths=None):
+    """
+    Run a batch of config script commands concurrently and cache their
+    results for the Environment, so that subsequent RunConfig(),
+    CheckConfig(), ParseConfig() and ParseConfigPrefix() calls for the same
+    commands do not need to run anything.  A tool which needs several
+    config script queries can declare them all up front, so that its
+    startup time depends on the slowest query rather than the sum of all
+    of them.  Commands whose results are already cached are skipped.  If
+    @p search_paths is given, the config scripts are located there as in
+    ParseConfigPrefix().
+
+    Nothing is returned, and failures are not reported here.  A command
+    which fails will fail the same way when it is requested again, except
+    the result will come from the cache.
+    """
+    psenv = _string_env(env['ENV'])
+    queries = []
+    keys = set()
+    for command in commands:
+        args = command.split()
+        key = _config_results.key(psenv, args[0], search_paths, args[1:])
+        if key in keys or _config_results.contains(key):
+            continue
+        keys.add(key)
+        config = _locate_config(env, search_paths, args[0])
+        if not config:
+            continue
+        (result, pkey) = _lookup_persistent(env, config, args[1:], psenv)
+        if result:
+            _config_results.store(key, result)
+        else:
+            queries.append((key, config, args[1:], pkey))
+    if _debug:
+        print("PrefetchConfig: running %d of %d commands" %
+              (len(queries), len(commands)))
+    with instrument.Span('config', "PrefetchConfig(%d)" % len(queries), env):
+        results = _run_concurrently([q[:3] for q in queries], psenv)
+    for (key, config, args, pkey) in queries:
+        if key in results:
+            _store_persistent(env, pkey, results[key])
+            _config_results.store(key, results[key])
+
+
 def PassPkgConfigPath(env, psenv=None):
     """
     Propagate PKG_CONFIG_PATH to the scons process environment (ENV) if
@@ -150,8 +531,9 @@ def CheckConfig(env, command):
     """
     Return True if the pkg-config-like command succeeds (returns 0).
 
-    The output is cached in the environment, so subsequent requests for the
-    same config command will not need to execute the command again.
+    The output is cached, so subsequent requests for the same config
+    command from this or an equivalent environment will not need to
+    execute the command again.
     """
     args = command.split()
     config_script = args[0]
@@ -162,7 +544,7 @@ def CheckConfig(env, command):
 def ParseConfig(env, command, function=None, unique=True):
     """
     Like Environment.ParseConfig, except do not raise OSError if the
-    command fails, and the config script results are cached in the
+    command fails, and the config script results are cached for the
     Environment.  If the command succeeds, then merge the results flags
     into the Environment and return True.  Otherwise return False.
     """
@@ -196,6 +578,10 @@ def ParseConfigPrefix(env, config_script, search_prefixes,
     if env['PLATFORM'] == 'win32':    
         return prefix
 
+    if apply_config:
+        PrefetchConfig(env, [config_script + " " + args for args in
+                             ['--prefix', '--cppflags --ldflags --libs',
+                              '--ldflags']], search_paths)
     prefix = _get_config(env, search_paths, config_script, ['--prefix'])[1]
     if apply_config:
         flags = _get_config(env, search_paths, config_script,
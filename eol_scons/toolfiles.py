@@ -0,0 +1,172 @@
+# -*- python -*-
+# Copyright 2007 UCAR, NCAR, All Rights Reserved
+
+"""
+An index of the tool_<name>.py files in a source tree, so that tool files
+can be found by name without walking the whole tree on every scons run.
+
+The index records each directory in the tree with its modification time,
+the tool files in it, and its subdirectories.  The index is kept in a file
+between runs, and on each run it is validated against the tree: every
+directory is still stat'ed, but only directories whose modification time
+changed are listed and scanned again.  Adding, removing, or renaming a
+tool file or a subdirectory changes the modification time of the directory
+which contains it, so the index never misses a tool file the way the old
+tools.cache list of tool files could.
+
+A directory whose modification time is very recent when it is scanned is
+not trusted on the next run, since a change in the same clock tick would
+not change the time.
+"""
+
+import os
+import re
+import stat
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+_toolpattern = re.compile(r"^tool_(.*)\.py$")
+
+# Directories which are never searched for tool files.
+_prune = ['.svn', '.git', 'site_scons', 'apidocs']
+
+_index_version = 1
+
+
+class ToolFileIndex(object):
+    """
+    Map tool names to the tool_<name>.py files under a top directory.
+    """
+
+    def __init__(self, topdir, path=None):
+        self.topdir = topdir
+        self.path = path
+        # Map directory path to (mtime, toolfiles, subdirs).
+        self.dirs = {}
+        # Map tool name to the list of matching tool file paths.
+        self.tools = None
+        self.scanned = 0
+
+    def getPath(self):
+        return self.path
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            ifile = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            try:
+                data = pickle.load(ifile)
+            except Exception:
+                print("Ignoring unreadable tool file index: %s" % (self.path))
+                return
+        finally:
+            ifile.close()
+        if (data.get('version') == _index_version and
+            data.get('topdir') == self.topdir):
+            self.dirs = data['dirs']
+
+    def _save(self):
+        if not self.path:
+            return
+        tmppath = "%s.%d" % (self.path, os.getpid())
+        try:
+            ifile = open(tmppath, 'wb')
+            try:
+                pickle.dump({'version': _index_version,
+                             'topdir': self.topdir,
+                             'dirs': self.dirs}, ifile, 2)
+            finally:
+                ifile.close()
+            os.rename(tmppath, self.path)
+        except (IOError, OSError) as ex:
+            print("Failed to write tool file index %s: %s" %
+                  (self.path, str(ex)))
+
+    def _scan(self, dirpath, mtime):
+        "List the directory and return its new index entry."
+        self.scanned += 1
+        try:
+            names = os.listdir(dirpath)
+        except OSError:
+            names = []
+        names.sort()
+        toolfiles = [n for n in names if _toolpattern.match(n)]
+        subdirs = []
+        for n in names:
+            if n in _prune:
+                continue
+            try:
+                st = os.lstat(os.path.join(dirpath, n))
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(n)
+        # Do not trust a modification time which could still change
+        # without a visible difference.
+        if mtime is not None and time.time() - mtime < 2:
+            mtime = None
+        return (mtime, toolfiles, subdirs)
+
+    def update(self):
+        """
+        Load the index and validate it against the directory tree, scanning
+        only the directories which have changed.  Return True if any tool
+        files or directories were added or removed.
+        """
+        self._load()
+        olddirs = self.dirs
+        self.dirs = {}
+        self.scanned = 0
+        save = False
+        stack = [self.topdir]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                mtime = os.lstat(dirpath).st_mtime
+            except OSError:
+                continue
+            entry = olddirs.get(dirpath)
+            if entry is None or entry[0] is None or entry[0] != mtime:
+                entry = self._scan(dirpath, mtime)
+            self.dirs[dirpath] = entry
+            stack.extend([os.path.join(dirpath, d)
+                          for d in reversed(entry[2])])
+        # Writing the index file changes the modification time of its own
+        # directory, so a new time for that directory alone is not worth
+        # saving, it just means that directory will be listed again.
+        changed = False
+        indexdir = self.path and os.path.dirname(self.path)
+        for dirpath, entry in self.dirs.items():
+            oldentry = olddirs.get(dirpath)
+            if oldentry is None or oldentry[1:] != entry[1:]:
+                changed = True
+                break
+            if oldentry[0] != entry[0] and dirpath != indexdir:
+                save = True
+        changed = changed or len(self.dirs) != len(olddirs)
+        self.tools = {}
+        for dirpath in sorted(self.dirs.keys()):
+            for toolfile in self.dirs[dirpath][1]:
+                name = _toolpattern.match(toolfile).group(1)
+                self.tools.setdefault(name, []).append(
+                    os.path.join(dirpath, toolfile))
+        if changed or save:
+            self._save()
+        return changed
+
+    def numToolFiles(self):
+        return sum([len(paths) for paths in self.tools.values()])
+
+    def findToolFiles(self, name):
+        "Return the list of tool files for tool @p name."
+        if self.tools is None:
+            self.update()
+        return self.tools.get(name, [])
@@ -0,0 +1,268 @@
+# -*- python -*-
+# Copyright 2007 UCAR, NCAR, All Rights Reserved
+
+"""
+A manifest of the tool modules in the eol_scons tools directory, generated
+by parsing the tool sources rather than importing them.
+
+For each tool module the manifest records the module file and its
+modification time, the names of the sub-tools the module exports when it
+is imported (like 'gtest' and 'gtest_main' from the testing tool), and the
+names and help text of the variables it declares.  The Qt4 module tools
+defined by eol_scons.tool.DefineQt4Tools() are recorded as sub-tools of
+the qt4 tool.
+
+The manifest lets _Tool() resolve an exported sub-tool by importing only
+the module which exports it, so the exporting tool no longer has to be
+required first, and it lets SetHelp() list the variables of tools which
+have not been loaded.  Variables whose name or help is not a literal
+string in the source are not recorded.
+
+The manifest is cached in a file in the top directory of the source tree,
+and on each run only the tool modules whose modification time changed are
+parsed again.  Run this module as a script to print the manifest:
+
+  python toolmanifest.py [tools_dir]
+"""
+
+import os
+import sys
+import ast
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+_manifest_version = 1
+_manifest = None
+_manifest_file = "#/toolmanifest.cache"
+
+
+def _literal_string(node):
+    "Return the value of @p node if it is a literal string, else None."
+    try:
+        value = ast.literal_eval(node)
+    except (ValueError, SyntaxError, TypeError):
+        return None
+    if isinstance(value, str):
+        return value
+    return None
+
+
+def _call_name(node):
+    "Return the function or method name called by Call @p node."
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    return None
+
+
+def _variable_decl(args):
+    """
+    Return the (name, help) tuple declared by the arguments to a
+    Variables.Add() call, a tuple passed to AddVariables(), or a call to
+    one of the *Variable() functions.  Return None if there is no literal
+    name.
+    """
+    if len(args) == 1 and isinstance(args[0], ast.Tuple):
+        args = args[0].elts
+    elif (len(args) == 1 and isinstance(args[0], ast.Call) and
+          (_call_name(args[0]) or '').endswith('Variable')):
+        args = args[0].args
+    if not args:
+        return None
+    name = _literal_string(args[0])
+    if not name:
+        return None
+    helptext = None
+    if len(args) > 1:
+        helptext = _literal_string(args[1])
+    return (name, helptext)
+
+
+def ParseToolModule(path):
+    """
+    Parse the tool module at @p path and return a tuple of the list of
+    exported tool names and the list of (name, help) variables it declares.
+    """
+    tfile = open(path)
+    try:
+        tree = ast.parse(tfile.read(), path)
+    finally:
+        tfile.close()
+    exports = []
+    variables = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        fname = _call_name(node)
+        if fname == 'Export':
+            exports.extend([s for s in map(_literal_string, node.args) if s])
+            exports.extend([k.arg for k in node.keywords])
+        elif fname == 'Add':
+            decl = _variable_decl(node.args)
+            if decl:
+                variables.append(decl)
+        elif fname == 'AddVariables':
+            for arg in node.args:
+                decl = _variable_decl([arg])
+                if decl:
+                    variables.append(decl)
+    return (exports, variables)
+
+
+class ToolManifest(object):
+    """
+    The manifest of tool modules in a tools directory.  Each module entry
+    is a dictionary with keys 'file', 'mtime', 'exports', and 'variables'.
+    """
+
+    def __init__(self, tools_dir, path=None):
+        self.tools_dir = tools_dir
+        self.path = path
+        self.modules = {}
+        self.exports = {}
+        self.parsed = 0
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            mfile = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            try:
+                data = pickle.load(mfile)
+            except Exception:
+                print("Ignoring unreadable tool manifest: %s" % (self.path))
+                return
+        finally:
+            mfile.close()
+        if (data.get('version') == _manifest_version and
+            data.get('tools_dir') == self.tools_dir):
+            self.modules = data['modules']
+
+    def _save(self):
+        if not self.path:
+            return
+        tmppath = "%s.%d" % (self.path, os.getpid())
+        try:
+            mfile = open(tmppath, 'wb')
+            try:
+                pickle.dump({'version': _manifest_version,
+                             'tools_dir': self.tools_dir,
+                             'modules': self.modules}, mfile, 2)
+            finally:
+                mfile.close()
+            os.rename(tmppath, self.path)
+        except (IOError, OSError) as ex:
+            print("Failed to write tool manifest %s: %s" %
+                  (self.path, str(ex)))
+
+    def update(self):
+        """
+        Load the cached manifest, parse any tool modules which are new or
+        have changed, and save the manifest if anything changed.
+        """
+        self._load()
+        oldmodules = self.modules
+        self.modules = {}
+        self.parsed = 0
+        for filename in sorted(os.listdir(self.tools_dir)):
+            (name, ext) = os.path.splitext(filename)
+            if ext != '.py':
+                continue
+            path = os.path.join(self.tools_dir, filename)
+            mtime = os.stat(path).st_mtime
+            entry = oldmodules.get(name)
+            if not entry or entry['mtime'] != mtime:
+                self.parsed += 1
+                try:
+                    (exports, variables) = ParseToolModule(path)
+                except SyntaxError as ex:
+                    print("Cannot parse tool module %s: %s" % (path, str(ex)))
+                    (exports, variables) = ([], [])
+                entry = {'file': path, 'mtime': mtime,
+                         'exports': exports, 'variables': variables}
+            self.modules[name] = entry
+        try:
+            from eol_scons.tool import _qtmodules
+        except ImportError:
+            _qtmodules = []
+        if 'qt4' in self.modules:
+            qt4 = self.modules['qt4']
+            qt4['exports'] = sorted(set(qt4['exports'] +
+                                        [m[0].lower() for m in _qtmodules]))
+        self.exports = {}
+        for name, entry in self.modules.items():
+            for sub in entry['exports']:
+                self.exports.setdefault(sub, name)
+        if self.modules != oldmodules:
+            self._save()
+        return self
+
+    def toolNames(self):
+        "Return the sorted names of all the tool modules and sub-tools."
+        return sorted(set(list(self.modules.keys()) +
+                          list(self.exports.keys())))
+
+    def exportingModule(self, name):
+        """
+        Return the name of the tool module which exports sub-tool @p name,
+        or None if @p name is not an exported sub-tool.
+        """
+        module = self.exports.get(name)
+        if module == name:
+            return None
+        return module
+
+    def variables(self):
+        "Return a sorted list of (variable, tool, help) tuples."
+        result = []
+        for name, entry in self.modules.items():
+            for (vname, vhelp) in entry['variables']:
+                result.append((vname, name, vhelp))
+        result.sort()
+        return result
+
+    def HelpText(self, exclude=None):
+        """
+        Return help text listing the variables declared by tool modules,
+        leaving out the variable names in @p exclude, typically the
+        variables which have already been added to the global variables.
+        """
+        exclude = exclude or []
+        lines = []
+        for (vname, tool, vhelp) in self.variables():
+            if vname in exclude:
+                continue
+            lines.append("%s (%s tool): %s" %
+                         (vname, tool, (vhelp or "").strip()))
+        if not lines:
+            return ""
+        return ("\nVariables of tools which have not been loaded:\n\n" +
+                "\n".join(lines) + "\n")
+
+
+def GetToolManifest(env):
+    "Return the ToolManifest for the eol_scons tools directory."
+    global _manifest
+    if _manifest is None:
+        import eol_scons
+        path = env.File(_manifest_file).get_abspath()
+        _manifest = ToolManifest(eol_scons.tools_dir, path).update()
+        env.LogDebug("tool manifest %s: %d modules, %d parsed" %
+                     (path, len(_manifest.modules), _manifest.parsed))
+    return _manifest
+
+
+if __name__ == "__main__":
+    import pprint
+    tools_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "tools")
+    if len(sys.argv) > 1:
+        tools_dir = sys.argv[1]
+    pprint.pprint(ToolManifest(tools_dir).update().modules)
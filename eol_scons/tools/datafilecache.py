@@ -19,8 +19,8 @@ rsync from the remote specifier.  Once a file has been downloaded to the
 cache, it will not be synchronized with the remote source again.  The cache
 can be updated using the 'datasync' alias described below.
 
-This tool adds a scons variable called 'download', with one of three
-settings: force, auto, and off.  The default setting is 'auto'.
+This tool adds a scons variable called 'download', with one of four
+settings: force, auto, off, and verify.  The default setting is 'auto'.
 
    force: Files will be explicitly synchronized whenever required for a
           dependency, even if they already exist in the cache.
@@ -41,6 +41,13 @@ settings: force, auto, and off.  The default setting is 'auto'.
          it already exists locally, because scons has no record that the
          target file is current.
 
+   verify: Like off, files will never be synchronized, but the content of
+           each cached file is checked against the data file manifest,
+           so a cached file which was truncated or modified after it was
+           downloaded fails the build.  Only files whose size or
+           modification time changed since they were recorded in the
+           manifest are hashed again.
+
 Each cached data file is added to the 'datasync' alias.  Run 'scons
 datasync' to build all the cached data file targets, and set the 'download' option
 to choose whether the files should be synchronized.  For example, this will update 
@@ -48,21 +55,175 @@ all the data files in the cache:
 
    scons download=force datasync
 
+With download=force, datasync synchronizes all the data files with one
+batch of rsync processes for each remote host, sharing one ssh connection,
+rather than running rsync separately for each file.  Then the datasync
+targets only check that each file was synchronized, and any file which
+failed is tried again on its own.  If the DataFileCache has a remote
+manifest, then files which already match the remote manifest are not
+synchronized at all, so forcing a sync when nothing has changed only costs
+fetching the remote manifest.  Set the 'download_manifest' variable to the
+path of the manifest relative to the remote prefix, a file in md5sum
+format, or see DataFileCache.setRemoteManifest().
+
 This command will just check that all the files exist in the cache and fail
 if any do not:
 
    scons download=off datasync
+
+And this command checks that they all still match their manifest:
+
+   scons download=verify datasync
+
+Set the EOL_SCONS_DATACACHE environment variable to a directory to share
+one copy of the data files among all the source trees on a host, and set
+EOL_SCONS_DATACACHE_SIZE to limit the size of the shared cache, such as
+'50G'.  See the eol_scons.datafilecache module.  Files which already exist
+in the shared cache are linked into the source tree without downloading
+them, except with download=force.
+
+Set download_prefetch=1 to download the data files in the background while
+the rest of the build runs, rather than downloading each file only when
+its target is built.  Every registered data file which needs to be
+downloaded is queued for a small pool of worker threads.  That is every
+file with download=force, and every file missing from the cache with
+download=auto.  The workers start as soon as the first file is queued, so
+the downloads run while the rest of the SConscript files are read and
+while other targets build, and the workers keep taking files from the
+queue as more are registered.  Then the data file targets just wait for
+their background download to finish.  A file whose background download
+failed is tried again when its target is built.  The data file cache
+should be configured before the first data file is registered, since the
+downloads may start right away.  'scons download=force datasync' does not
+prefetch, since it already synchronizes all the files at once.
 """
 
+import os
+import threading
+from collections import deque
+
 import SCons
+import SCons.Script
+from SCons.Variables import BoolVariable
 from SCons.Variables import EnumVariable
 
+_sync_lock = threading.Lock()
+_synced_caches = set()
+
+_prefetch_workers = 4
+# Map (id(dfcache), filepath) to the _Prefetch of each file.
+_prefetch_jobs = {}
+_prefetch_queue = deque()
+_prefetch_running = 0
+_prefetch_lock = threading.Lock()
+
+
+class _Prefetch(object):
+    "The background download of one data file."
+
+    def __init__(self, dfcache, filepath):
+        self.dfcache = dfcache
+        self.filepath = filepath
+        self.result = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            try:
+                self.result = self.dfcache.download(self.filepath)
+            except Exception as ex:
+                print("*** Background download of %s failed: %s" %
+                      (self.filepath, str(ex)))
+        finally:
+            self.done.set()
+
+    def wait(self):
+        # Wait with a timeout so the wait can be interrupted.
+        while not self.done.is_set():
+            self.done.wait(1.0)
+        return self.result
+
+
+def _prefetch_worker():
+    "Download queued files until the queue is empty."
+    global _prefetch_running
+    while True:
+        _prefetch_lock.acquire()
+        try:
+            if not _prefetch_queue:
+                _prefetch_running -= 1
+                return
+            job = _prefetch_queue.popleft()
+        finally:
+            _prefetch_lock.release()
+        job.run()
+
+
+def _prefetch(env, dfcache, filepath):
+    """
+    Queue @p filepath for download in the background if it needs it, and
+    start another worker thread for the queue if fewer than
+    _prefetch_workers are running.  The workers start with the first file
+    queued, so the downloads run while the rest of the SConscript files are
+    read and then while other targets build.
+    """
+    global _prefetch_running
+    download = env.get('download', 'auto')
+    if (download not in ['auto', 'force'] or
+        env.GetOption('clean') or env.GetOption('help') or
+        env.GetOption('no_exec')):
+        return
+    if download == 'force' and 'datasync' in SCons.Script.COMMAND_LINE_TARGETS:
+        return
+    if download == 'auto' and os.path.exists(dfcache.getFile(filepath)):
+        return
+    key = (id(dfcache), filepath)
+    if key in _prefetch_jobs:
+        return
+    if not _prefetch_jobs:
+        print("Downloading data files in the background.")
+    job = _Prefetch(dfcache, filepath)
+    _prefetch_jobs[key] = job
+    _prefetch_lock.acquire()
+    try:
+        _prefetch_queue.append(job)
+        start = _prefetch_running < _prefetch_workers
+        if start:
+            _prefetch_running += 1
+    finally:
+        _prefetch_lock.release()
+    if start:
+        worker = threading.Thread(target=_prefetch_worker)
+        worker.daemon = True
+        worker.start()
+
+def _sync_all(dfcache):
+    """
+    Synchronize all the registered files of @p dfcache at once the first
+    time any of them is synchronized by 'scons download=force datasync'.
+    """
+    _sync_lock.acquire()
+    try:
+        if id(dfcache) not in _synced_caches:
+            _synced_caches.add(id(dfcache))
+            dfcache.sync()
+    finally:
+        _sync_lock.release()
+
 def _sync_file(target, source, env):
     dfcache = env.DataFileCache()
+    job = _prefetch_jobs.get((id(dfcache), str(source[0])))
+    if job and job.wait():
+        return None
+    if (env.get('download', 'auto') == 'force' and
+        'datasync' in SCons.Script.COMMAND_LINE_TARGETS):
+        _sync_all(dfcache)
     if dfcache.download(str(source[0])):
         return None
     msg = "datasync failed."
-    if not dfcache.downloadEnabled():
+    if env.get('download', 'auto') == 'verify':
+        msg = "datasync failed, cached file does not match manifest."
+    elif not dfcache.downloadEnabled():
         msg = "datasync failed, download disabled."
     raise SCons.Errors.StopError(msg)
 
@@ -73,10 +234,12 @@ def _download_data_file(env, filepath):
     # Create a scons builder which downloads the source file into the cache.
     dfcache = env.DataFileCache()
     dfcache.enableDownload(env.get('download', 'auto') in ['auto', 'force'])
+    dfcache.enableVerify(env.get('download', 'auto') == 'verify')
+    dfcache.forceSharedSync(env.get('download', 'auto') == 'force')
     syncfile = env.Action(_sync_file, _sync_file_message)
     target = env.Command(dfcache.getFile(filepath),
                          env.Value(filepath), syncfile)
-    if env.get('download', 'auto') == 'force':
+    if env.get('download', 'auto') in ['force', 'verify']:
         env.AlwaysBuild(target)
     # Do not allow scons to erase the data file before re-synchronizing it,
     # nor remove the file when cleaning.
@@ -92,6 +255,8 @@ def _download_data_file(env, filepath):
     # forced with AlwaysBuild().  Rather than force it here, rely on the
     # download setting above to force downloads.
     env.AlwaysBuild(env.Alias('datasync', target))
+    if env.get('download_prefetch'):
+        _prefetch(env, dfcache, filepath)
     if False and 'datasync' in SCons.Script.BUILD_TARGETS:
         env.AlwaysBuild(target)
     # Return just the single node rather than the list that a builder would
@@ -112,6 +277,16 @@ def _get_cache_instance(env):
         dfcache = datafilecache.DataFileCache()
         # Provide fallback cache directory for scons environments.
         dfcache.appendCachePath(path)
+        shared = os.environ.get('EOL_SCONS_DATACACHE')
+        if shared:
+            try:
+                dfcache.setSharedCache(
+                    shared, os.environ.get('EOL_SCONS_DATACACHE_SIZE'))
+            except ValueError as ex:
+                raise SCons.Errors.UserError(str(ex))
+        manifest = env.get('download_manifest')
+        if manifest:
+            dfcache.setRemoteManifest(manifest)
         env['DATA_FILE_CACHE'] = dfcache
         # No point downloading anything for clean and help options.
         if env.GetOption('clean') or env.GetOption('help'):
@@ -126,9 +301,18 @@ def generate(env):
         _options = env.GlobalVariables()
         _options.Add(EnumVariable('download',
                                   "Set whether data file downloading is forced, "
-                                  "automatic, or completely disabled.", 'auto',
-                                  allowed_values=('force', 'auto', 'off'),
+                                  "automatic, completely disabled, or disabled "
+                                  "but with cached files verified.", 'auto',
+                                  allowed_values=('force', 'auto', 'off',
+                                                  'verify'),
                                   ignorecase=2))
+        _options.Add(BoolVariable('download_prefetch',
+                                  "Download data files in the background "
+                                  "while building other targets.", False))
+        _options.Add('download_manifest',
+                     "Path relative to the remote prefix of an md5sum "
+                     "manifest of the remote data files, so files which "
+                     "match it are not synchronized again.", '')
     _options.Update(env)
     env.AddMethod(_get_cache_instance, "DataFileCache")
     env.AddMethod(_download_data_file, "DownloadDataFile")
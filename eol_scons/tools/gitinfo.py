@@ -53,7 +53,14 @@ Example generated header file text:
 #endif
 
 Notes:
-Git commands are used to extract the information.
+Git commands are used to extract the information, but only git describe and
+git log are run.  The top of the working directory, the branch, and the
+origin URL are read from the files in the .git directory.  The results are
+cached for each working directory in the file gitinfo.cache in the top
+directory of the scons source tree, along with the contents of HEAD and the
+branch ref it names and the modification times of packed-refs, refs/tags
+and config.  As long as those do not change, git is not run at all, and
+the header file is not regenerated since its contents have not changed.
 
 Useful hint: If a scons tool such as this (i.e contains exists() and
 generate()) is not located in the site_tools directory,
@@ -88,13 +95,130 @@ import re
 import string
 from subprocess import *
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 # Set to 1 to enable debugging output
 _debug = 0
 
+# The eol_scons.instrument module when running in scons.
+_instrument = None
+
+_cache_version = 1
+
 # Debugging print
 def pdebug(msg):
     if _debug: print(msg)
 
+def _read_file(path):
+    "Return the stripped contents of the file at path, or None."
+    try:
+        rfile = open(path)
+    except IOError:
+        return None
+    try:
+        return rfile.read().strip()
+    finally:
+        rfile.close()
+
+def _find_git_dir(workdir):
+    """
+    Return the tuple (topdir, gitdir, commondir) for the git working tree
+    containing workdir, found without running git, or None.  The gitdir
+    holds HEAD, while the commondir holds the refs and config, and they
+    differ for a worktree added with 'git worktree add'.
+    """
+    if 'GIT_DIR' in os.environ:
+        return None
+    path = os.path.realpath(workdir)
+    while True:
+        dotgit = os.path.join(path, '.git')
+        if os.path.isdir(dotgit):
+            gitdir = dotgit
+            break
+        if os.path.isfile(dotgit):
+            text = _read_file(dotgit) or ''
+            if not text.startswith('gitdir:'):
+                return None
+            gitdir = os.path.normpath(os.path.join(path, text[7:].strip()))
+            break
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    commondir = gitdir
+    common = _read_file(os.path.join(gitdir, 'commondir'))
+    if common:
+        commondir = os.path.normpath(os.path.join(gitdir, common))
+    return (path, gitdir, commondir)
+
+def _origin_url(config):
+    "Return the url of remote origin in the text of a git config file."
+    section = None
+    for line in config.splitlines():
+        line = line.strip()
+        if line.startswith('['):
+            section = line
+        elif section and re.match(r'\[remote\s+"origin"\]$', section):
+            (key, sep, value) = line.partition('=')
+            if sep and key.strip().lower() == 'url':
+                return value.strip().strip('"')
+    return None
+
+def _git_stamp(location):
+    """
+    Return the state of the git files which determine the repository info,
+    for comparison with the state when the info was cached.
+    """
+    (topdir, gitdir, commondir) = location
+    head = _read_file(os.path.join(gitdir, 'HEAD'))
+    ref = None
+    if head and head.startswith('ref:'):
+        ref = _read_file(os.path.join(commondir, head[4:].strip()))
+    stats = []
+    for path in [os.path.join(commondir, 'packed-refs'),
+                 os.path.join(commondir, 'refs', 'tags'),
+                 os.path.join(commondir, 'config')]:
+        try:
+            st = os.stat(path)
+            stats.append((st.st_mtime, st.st_size))
+        except OSError:
+            stats.append(None)
+    return (head, ref, tuple(stats))
+
+def _load_cache(path):
+    "Return the dictionary of cached git info by working directory."
+    try:
+        cfile = open(path, 'rb')
+    except IOError:
+        return {}
+    try:
+        try:
+            data = pickle.load(cfile)
+        except Exception:
+            print("Ignoring unreadable git info cache: %s" % (path))
+            return {}
+    finally:
+        cfile.close()
+    if data.get('version') != _cache_version:
+        return {}
+    return data['entries']
+
+def _save_cache(path, entries):
+    tmppath = "%s.%d" % (path, os.getpid())
+    try:
+        cfile = open(tmppath, 'wb')
+        try:
+            pickle.dump({'version': _cache_version, 'entries': entries},
+                        cfile, 2)
+        finally:
+            cfile.close()
+        os.rename(tmppath, path)
+    except (IOError, OSError) as ex:
+        print("Failed to write git info cache %s: %s" % (path, str(ex)))
+
 #####################################################################
 class GitInfo:
     """
@@ -110,12 +234,18 @@ class GitInfo:
                 If the tag points to the most recent commit, then commit
                 is '0'.
                   
+    git log --pretty=format:"%cd %H" -1: Get the date and hash of the last commit: Wed Nov 26 16:42:30 2014 -0700 3189d8e443a6cf5827fc9617ebe8b95ab83d8eaf
+
+    The repository URL, the top of the working directory, and the branch
+    are read from the .git config and HEAD files.  If the .git directory
+    cannot be found, because GIT_DIR is set for example, then these are
+    used instead:
+
     git config --get remote.origin.url: Get the repository URL that this branch was
                   fetched from.
-                  
-    git log --pretty=format:"%cd %H" -1: Get the date and hash of the last commit: Wed Nov 26 16:42:30 2014 -0700 3189d8e443a6cf5827fc9617ebe8b95ab83d8eaf
     
-    git rev-parse --show-toplevel: Find the top of the working diectory: /Users/martinc/git/aspen
+    git rev-parse --show-toplevel --abbrev-ref HEAD: Find the top of the working
+                  directory and the branch: /Users/martinc/git/aspen develop
     """
 
     # The repository info keys.
@@ -132,7 +262,12 @@ class GitInfo:
         'REPO_BRANCH'          : None
         }
 
-    def __init__(self, env):
+    def __init__(self, env, workdir=None, cachepath=None):
+        # The git commands run in workdir, and the results are cached in
+        # the cachepath file.
+        self.workdir = workdir
+        self.cachepath = cachepath
+
         # Specify the git command
         if 'GIT' in env:
             self.gitcmd = env['GIT']
@@ -147,13 +282,18 @@ class GitInfo:
             self.values[k] = "unknown"
         self.values['REPO_ERROR'] = ""
 
-    def _get_output(self, cmd):
+    def _get_output(self, cmd, cwd=None):
         "Get command output or stderr if it fails"
         output = ""
         try:
             pdebug("gitinfo: running '%s'" % (" ".join(cmd)))
-            child = Popen(cmd, stdout=PIPE,stderr=PIPE)
-            output = child.communicate()
+            if _instrument:
+                with _instrument.Process():
+                    child = Popen(cmd, stdout=PIPE,stderr=PIPE, cwd=cwd)
+                    output = child.communicate()
+            else:
+                child = Popen(cmd, stdout=PIPE,stderr=PIPE, cwd=cwd)
+                output = child.communicate()
             pdebug("gitinfo output: %s" % (output[0]))
             pdebug("gitinfo error: %s" % (output[1].strip()))
             pdebug("gitinfo returncode:" + str(child.returncode))
@@ -185,6 +325,27 @@ class GitInfo:
         return True
     
     def _git_info(self):
+        """
+        Return the dictionary of repository information from the cache if
+        the git state has not changed since it was cached, otherwise from
+        _run_git(), and cache it.
+        """
+        location = _find_git_dir(self.workdir or os.getcwd())
+        stamp = None
+        if location and self.cachepath:
+            stamp = _git_stamp(location)
+            entries = _load_cache(self.cachepath)
+            entry = entries.get(location[0])
+            if entry and entry['stamp'] == stamp:
+                pdebug("gitinfo: using cached info for %s" % (location[0]))
+                return dict(entry['values'])
+        git_dict = self._run_git(location)
+        if stamp is not None:
+            entries[location[0]] = {'stamp': stamp, 'values': git_dict}
+            _save_cache(self.cachepath, entries)
+        return git_dict
+
+    def _run_git(self, location):
         """
         Return a dictionary with entries keyed to git revision and repository information.
         
@@ -218,8 +379,12 @@ class GitInfo:
         branch       = None
         error        = []
 
+        cwd = self.workdir
+        if location:
+            cwd = location[0]
+
         # Run git describe, and extract the tag, number of commits, and object name
-        cmd_out = self._get_output([self.gitcmd, 'describe', '--match', self.match])
+        cmd_out = self._get_output([self.gitcmd, 'describe', '--match', self.match], cwd)
         if self._cmd_out_ok(cmd_out, error):
             describe = cmd_out.split('-')
             if len(describe) > 0:
@@ -229,15 +394,18 @@ class GitInfo:
                     if len(describe) > 2:
                         objname = describe[2]
 
-        # Run git config to fetch the URL
-        cmd_out = self._get_output([self.gitcmd, 'config', '--get', 'remote.origin.url'])
-        if self._cmd_out_ok(cmd_out, error):
+        # Read the URL from the config, or else run git config to fetch it
+        if location:
+            cmd_out = _origin_url(_read_file(os.path.join(location[2], 'config')) or '') or ''
+        else:
+            cmd_out = self._get_output([self.gitcmd, 'config', '--get', 'remote.origin.url'], cwd)
+        if cmd_out and self._cmd_out_ok(cmd_out, error):
             # Normalize URL.
             url = cmd_out
             url = url.replace('\\', '/').strip()
 
         # Run git log to fetch the date and hash of the last commit
-        cmd_out = self._get_output([self.gitcmd, 'log', '--pretty=format:%cd %H', '-1'])
+        cmd_out = self._get_output([self.gitcmd, 'log', '--pretty=format:%cd %H', '-1'], cwd)
         if self._cmd_out_ok(cmd_out, error):
             datehash = cmd_out.split(' ')
             pdebug(datehash)
@@ -249,17 +417,28 @@ class GitInfo:
                     else:
                         date = date + ' ' + s
 
-        # Run git rev-parse to fetch the top level working directory
-        cmd_out = self._get_output([self.gitcmd, 'rev-parse', '--show-toplevel'])
+        # Take the top level working directory and the branch from the .git
+        # location and HEAD, or else run git rev-parse to fetch them
+        if location:
+            cmd_out = location[0] + '\n'
+            head = _read_file(os.path.join(location[1], 'HEAD')) or ''
+            if head.startswith('ref:'):
+                ref = head[4:].strip()
+                if ref.startswith('refs/heads/'):
+                    ref = ref[len('refs/heads/'):]
+                cmd_out += ref
+            else:
+                cmd_out += 'HEAD'
+        else:
+            cmd_out = self._get_output([self.gitcmd, 'rev-parse', '--show-toplevel',
+                                        '--abbrev-ref', 'HEAD'], cwd)
         if self._cmd_out_ok(cmd_out, error):
-            dir = cmd_out
+            lines = cmd_out.split('\n')
+            dir = lines[0]
             # Normalize path.
             dir = dir.replace('\\', '/').strip()
-        
-        # Run git rev-parse to fetch the branch
-        cmd_out = self._get_output([self.gitcmd, 'rev-parse', '--abbrev-ref', 'HEAD'])
-        if self._cmd_out_ok(cmd_out, error):
-            branch = cmd_out
+            if len(lines) > 1:
+                branch = lines[1]
         
         # Use the collected git details to populate the dicitionary items
         gitrevision     = 'unknown'
@@ -396,6 +575,7 @@ else:
     from SCons.Node import FS
     from SCons.Node.Python import Value
     import SCons.Warnings
+    import eol_scons.instrument as _instrument
 
     def _get_workdir(env, source):
         """
@@ -422,6 +602,9 @@ else:
     
     # A dictionary used to cache a GitInfo instance for a given working directory.
     _gitinfomap = {}
+
+    # The file which caches the git info between runs.
+    _cache_file = "#/gitinfo.cache"
     
     def _load_gitinfo(env, workdir):
         """
@@ -437,7 +620,7 @@ else:
         
         # Create a new GitInfo instance, for this workdir
         pdebug("_load_gitinfo(%s): creating gitinfo" % (workdir))
-        ginfo = GitInfo(env)
+        ginfo = GitInfo(env, workdir, env.File(_cache_file).get_abspath())
         _gitinfomap[workdir] = ginfo.getRepoInfo()
         
         return ginfo
@@ -279,6 +279,9 @@ the system pkg-config.""" % (USE_PKG_CONFIG),
     env.AppendUnique(DEPLOY_SHARED_LIBS=nidas_libs)
 
     if env['NIDAS_PATH'] == USE_PKG_CONFIG:
+        pc.PrefetchConfig(env, ['pkg-config nidas',
+                                'pkg-config --cflags --libs nidas',
+                                'pkg-config --libs-only-L nidas'])
         try:
             # env['ENV'] may have PKG_CONFIG_PATH
             exists = pc.CheckConfig(env, 'pkg-config nidas')
@@ -8,11 +8,17 @@ testing, it is not currently used by this tool.
 The ideas in scons_to_ninja have been modified significantly for inclusion
 this tool.  Instead of overloading PRINT_CMD_LINE_FUNC and letting scons
 run with no_exec, this tool actually traverses the node tree and extracts
-command strings where possible.  Nodes with builders which do not translate
-to shell commands are built explicitly by scons after generating the ninja
-file.  For example, files like version info files which can only be built
-within scons are updated by scons.  After the ninja file has been generated
-by scons, it should be possible to run ninja to build the rest of the
+command strings where possible.  Each distinct command template, such as
+$CXXCOM, gets its own ninja rule named after the builder, and builders
+with several targets become a single build statement with all of the
+outputs.  Nodes built by a python function, like the version info headers
+from the gitinfo and svninfo tools and the sources from text2cc, are run
+from ninja by the eol_scons.ninja_stub module, using a specification of
+the call saved next to the ninja file in <ninjafile>.stubs.  If a stub
+fails, it runs scons to build its targets instead.  Nodes which cannot be
+translated either way are built explicitly by scons after generating the
+ninja file.  After the ninja file has been generated by
+scons, it should be possible to run ninja to build the rest of the
 targets.
 
 Alias nodes are translated to ninja phony rules.  Directory targets are not
@@ -63,31 +69,41 @@ and included explicitly in a single file.
 
 Issues:
 
-It may be necessary to build the whole project first to make sure certain
-source and header files are generated, such as Qt uic and moc output files,
-since include dependencies on those files do not yet translate into the
-ninja dependencies.
+C and C++ compile commands are generated with -MMD -MF <target>.d and the
+ninja depfile settings, when the compiler looks like gcc or clang, so ninja
+records the headers actually included by each source and rebuilds when any
+of them change, without regenerating the ninja file.  Pass
+ninja_depfiles=off to leave them out.  The depfiles only help once a
+source has been compiled, so the first build still relies on the include
+dependencies scanned by scons to order the generation of headers, such as
+Qt uic and moc output files, before the sources which include them.  It
+may be necessary to build the whole project first if those dependencies
+are incomplete.
 
 Some eol_scons targets have complicated dependencies and use Value nodes
-and Actions which run python function.  For example, many test targets do
-not yet translate to ninja.  Doxyfile targets in theory should be built
-from their Value nodes when scons is run, leaving just the doxygen commands
-to be run in ninja rules, but in practice that does not work yet.  There
-are extra dependencies which cause scons to build the documentation rather
-than just the Doxyfiles.  This is probably not a big disadvantage, since
-usually only the compile rules need to be run when doing interactive
-development, and ninja speeds up the edit/compile cycle by avoiding the
-scons startup time.  The developer must remember to re-run scons and
-re-generate the ninja build file as needed, such as whenever header
-dependencies or source file lists change, or when compiler flags need to
-change.
-
-Simple python function targets, like header files generated from the
-svninfo and gitinfo tools, and source files generated with the text2cc
-tool, work fine with ninja.  When generating a ninja file, SCons
-automatically builds those nodes (if they are dependencies of the
-command-line targets) to make sure they are updated.  Then the ninja rules
-have all they need to run.
+and Actions which run python functions.  A python function can only be run
+by the stub runner if it is a module-level function of its module, and if
+the construction variables it depends on (its varlist) are plain values
+like strings, numbers, lists, and dictionaries.  The contents of Value
+sources are saved with the specification, and the specification key is
+part of the ninja command, so ninja runs the function again when the
+Values change, but only after the ninja file has been generated again.
+
+The ninja file regenerates itself.  It contains a build statement for
+itself whose inputs are the SConstruct and SConscript files which were
+read, the python modules loaded from eol_scons and from the source tree,
+the config files of the global variables, and config.cache, the cache of
+config script results.  When any of those change, ninja first runs scons
+again with the same arguments to regenerate the ninja file.  Changes
+which do not touch any of those files, like a new package installed on
+the system, still require running scons explicitly.  Pass ninja_regen=off
+to leave out the regeneration rule.
+
+Generating the ninja file again is incremental: the substituted command
+of each node is saved in <ninjafile>.cache, keyed by a signature of the
+node's command template, targets, sources, and the construction variables
+the template refers to, so only the nodes whose signature changed are
+substituted again.  See CommandCache.
 
 It should be possible to define an alias in a project's SConstruct file
 which contains all the aliases and targets which work with ninja, while
@@ -113,9 +129,24 @@ options.
 """
 
 import os
+import re
+import sys
+import hashlib
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+from collections import deque
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 import SCons
 from SCons.Variables import BoolVariable
 import eol_scons.scons_to_ninja as sn
+import eol_scons.ninja_stub as stub
 
 variables = None
 
@@ -154,12 +185,59 @@ def GetRealNode(node):
   return node
 
 
+def _escape_path(path):
+    "Escape @p path for the build line of a ninja file."
+    return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+
+def _escape_value(value):
+    "Escape @p value for a ninja variable assignment."
+    return value.replace('$', '$$').replace('\n', ' ')
+
+
+def _is_plain(value):
+    "Return True if @p value can be passed to the stub runner as is."
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return True
+    if SCons.Util.is_String(value):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all([_is_plain(v) for v in value])
+    if isinstance(value, dict):
+        return all([SCons.Util.is_String(k) and _is_plain(v)
+                    for k, v in value.items()])
+    return False
+
+
 _ninja_header = """\
 # Generated by eol_scons/tools/ninja.py
 
-# Generic rule for handling any command.
-rule cmd
+"""
+
+_ninja_rule = """\
+rule %s
   command = $cmd
+  description = %s $out
+%s
+"""
+
+_ninja_depfile = """\
+  depfile = $out.d
+  deps = gcc
+"""
+
+# The compile commands which get depfiles, and their compiler variables.
+_compile_commands = {'CCCOM': 'CC', 'CXXCOM': 'CXX',
+                     'SHCCCOM': 'SHCC', 'SHCXXCOM': 'SHCXX'}
+
+# Compilers which accept -MMD -MF, possibly with a cross prefix or version.
+_gcc_compiler = re.compile(r'^(.*-)?(gcc|g\+\+|cc|c\+\+|clang|clang\+\+)'
+                           r'(-[0-9.]+)?$')
+
+_ninja_stub_rule = """\
+rule python_stub
+  command = %s %s %s $key
+  description = $desc
 
 """
 
@@ -168,7 +246,24 @@ build %s: phony %s
 """
 
 _ninja_cmd = """
-build %s: cmd %s
+build %s: %s %s
+  cmd = %s
+"""
+
+_ninja_stub = """
+build %s: python_stub %s
+  key = %s
+  desc = %s
+"""
+
+_ninja_regen = """
+rule regen
+  command = $cmd
+  description = Regenerating $out
+  generator = 1
+  pool = console
+
+build %s: regen %s
   cmd = %s
 """
 
@@ -219,67 +314,551 @@ class NinjaNode(object):
         "This is not as precise as it could be."
         return self.node.get_dir().get_path().startswith(".sconf_temp")
 
-    def getRule(self):
+    def getTargets(self):
         """
-        Create the ninja rule for this node by converting actions to strings.
+        Return all the targets built by this node's executor, so a builder
+        with several outputs becomes a single ninja build statement.
         """
-        node = self.node
-        depnodes = node.all_children()
-        if self.isAlias():
-            deps = [str(dep) for dep in depnodes]
-            return _ninja_alias % (node.name, ' '.join(deps))
+        executor = self.node.get_executor()
+        targets = [t for t in executor.get_all_targets()
+                   if not isinstance(t, SCons.Node.FS.Dir)]
+        return targets or [self.node]
+
+    def getDeps(self, targets):
+        """
+        Return the paths of the dependencies of @p targets.  Value nodes
+        are left out, since they are not files.  Their contents reach the
+        ninja file through the commands or the stub specification.
+        """
+        deps = []
+        seen = set()
+        for target in targets:
+            for dep in target.all_children():
+                if dep in seen or isinstance(dep, SCons.Node.Python.Value):
+                    continue
+                seen.add(dep)
+                deps.append(GetRealNode(dep).get_path())
+        return deps
+
+    def getFunction(self):
+        """
+        If this node is built by a single python function action, return
+        the action, otherwise None.
+        """
+        actions = self.node.get_executor().get_action_list()
+        if (len(actions) == 1 and
+            isinstance(actions[0], SCons.Action.FunctionAction)):
+            return actions[0]
+        return None
 
-        dest_path = node.get_path()
-        deps = [GetRealNode(dep).get_path() for dep in depnodes]
+    def getTemplate(self):
+        """
+        Return the unsubstituted command lines of this node's actions, which
+        identify the ninja rule for the node.
+        """
+        return tuple([cmd for cmd in str(self.node.get_executor()).splitlines()
+                      if not cmd.startswith('_checkMocIncluded')])
+
+    def getCompiler(self, template):
+        """
+        If @p template is one of the C or C++ compile commands of the build
+        environment, and the compiler accepts gcc dependency options, return
+        the compiler, otherwise None.
+        """
+        if len(template) != 1:
+            return None
+        env = self.node.get_executor().get_build_env()
+        for com, compiler in _compile_commands.items():
+            if env.get(com) == template[0]:
+                compiler = env.subst('$' + compiler)
+                if _gcc_compiler.match(os.path.basename(compiler)):
+                    return compiler
+        return None
+
+    def getCommands(self, template):
+        """
+        Substitute the command lines in @p template for this node, in the
+        build environment of the executor so builder overrides apply.  The
+        target and source lists are passed explicitly instead of the
+        executor, since the executor recomputes its whole source list for
+        every element of $SOURCES, which is quadratic for libraries and
+        programs with thousands of sources.
+        """
+        executor = self.node.get_executor()
+        env = executor.get_build_env()
+        targets = executor.get_all_targets()
+        sources = executor.get_all_sources()
+        return [env.subst(cmd, 0, target=targets, source=sources)
+                for cmd in template]
+
+    def getStubSpec(self, action, targets):
+        """
+        Return the specification for the stub runner to call the python
+        function of @p action, or None if the function cannot be called
+        outside of scons: it must be a module-level function, and the
+        construction variables it depends on must be plain values.
+        Variables which are not set are left out, rather than set to None
+        for the stub.  If the stub fails, it builds the targets with scons
+        instead.
+        """
+        function = action.execfunction
+        module = sys.modules.get(getattr(function, '__module__', None))
+        name = getattr(function, '__name__', None)
+        if (module is None or not name or
+            getattr(module, name, None) is not function or
+            not getattr(module, '__file__', None)):
+            return None
+        env = self.node.get_env()
+        values = {}
+        for var in action.get_varlist(targets, self.node.sources, env):
+            if var not in env:
+                continue
+            value = env.get(var)
+            if not _is_plain(value):
+                return None
+            values[var] = value
+        sources = []
+        for src in self.node.sources:
+            if isinstance(src, SCons.Node.Python.Value):
+                sources.append(('value', src.get_contents()))
+            else:
+                sources.append(('file', GetRealNode(src).get_path()))
+        return {'module': module.__name__,
+                'file': stub.SourceFile(module.__file__),
+                'function': name, 'targets': [t.get_path() for t in targets],
+                'sources': sources, 'env': values,
+                'ENV': dict(env['ENV']),
+                'scons': SconsCommand(targets),
+                'cwd': SCons.Script.GetLaunchDir()}
+
+
+_command_scan = None
+_identifier = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+_cache_version = 1
+
+
+class CommandCache(object):
+    """
+    Cache the substituted commands of each node between generations of a
+    ninja file, since substitution is the most expensive part of
+    generating the build statements.  A node's entry is keyed by a
+    signature of its command template, the paths of its targets and
+    sources, and the raw values of the construction variables the template
+    refers to, followed recursively through the values of those variables.
+    The variable values only need to be collected once for each
+    Environment and template, so for most nodes the signature is much
+    cheaper than the substitution.
+
+    The cache also replaces the scons scan of each command for the program
+    it runs, which scons adds as an implicit dependency, since that scan
+    substitutes the command again.  While the node tree is traversed the
+    scan is disabled by NoCommandScan(), and the program dependencies are
+    found from the first word of the cached commands instead.  The scans
+    made without the programs are discarded afterwards by ClearScans().
+    Values which are functions, like _concat, are only identified by name,
+    so a change in the code of such a function is not noticed.  The cache
+    only keeps the entries used by the last generation.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.used = {}
+        self.digests = {}
+        self.hits = 0
+        self.misses = 0
+        self.programs = {}
+        self._load()
+
+    def _load(self):
+        try:
+            cfile = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            try:
+                data = pickle.load(cfile)
+            except Exception:
+                print("Ignoring unreadable ninja command cache: %s" %
+                      (self.path))
+                return
+        finally:
+            cfile.close()
+        if data.get('version') == _cache_version:
+            self.entries = data['entries']
+
+    def save(self):
+        tmppath = "%s.%d" % (self.path, os.getpid())
+        try:
+            cfile = open(tmppath, 'wb')
+            try:
+                pickle.dump({'version': _cache_version,
+                             'entries': self.used}, cfile, 2)
+            finally:
+                cfile.close()
+            os.rename(tmppath, self.path)
+        except (IOError, OSError) as ex:
+            print("Failed to write ninja command cache %s: %s" %
+                  (self.path, str(ex)))
+
+    def _flatten(self, env, value, seen, inputs):
+        "Return a text for @p value and collect the variables it refers to."
+        if SCons.Util.is_String(value):
+            self._collect(env, value, seen, inputs)
+            return str(value)
+        if isinstance(value, SCons.Node.Node):
+            return "node:" + value.get_path()
+        if SCons.Util.is_Sequence(value):
+            return "[%s]" % ",".join([self._flatten(env, v, seen, inputs)
+                                      for v in value])
+        if SCons.Util.is_Dict(value):
+            return "{%s}" % ",".join(
+                ["%s:%s" % (k, self._flatten(env, value[k], seen, inputs))
+                 for k in sorted(value.keys())])
+        if callable(value):
+            return "callable:" + getattr(value, '__name__',
+                                         type(value).__name__)
+        return repr(value)
+
+    def _collect(self, env, text, seen, inputs):
+        for name in _identifier.findall(text):
+            if name in seen:
+                continue
+            seen.add(name)
+            value = env.get(name)
+            if value is not None:
+                inputs.append((name, self._flatten(env, value, seen, inputs)))
+
+    def envDigest(self, env, template):
+        """
+        Return a digest of the values of the variables referred to by
+        @p template in @p env.
+        """
+        key = (id(env), template)
+        entry = self.digests.get(key)
+        if entry is None:
+            inputs = []
+            for line in template:
+                self._collect(env, line, set(), inputs)
+            # Keep a reference to the Environment so its id is not reused.
+            entry = (env, hashlib.md5(repr(inputs).encode('utf-8'))
+                     .hexdigest())
+            self.digests[key] = entry
+        return entry[1]
+
+    def getCommands(self, nn, template):
+        "Return the substituted commands for NinjaNode @p nn."
+        executor = nn.getNode().get_executor()
+        env = executor.get_build_env()
+        signature = repr((template, env['ENV'].get('PATH'),
+                          [str(t) for t in executor.get_all_targets()],
+                          [str(s) for s in executor.get_all_sources()],
+                          self.envDigest(env, template)))
+        key = hashlib.md5(signature.encode('utf-8')).hexdigest()
+        cmds = self.entries.get(key)
+        if cmds is None:
+            self.misses += 1
+            cmds = nn.getCommands(template)
+        else:
+            self.hits += 1
+        self.used[key] = cmds
+        return list(cmds)
+
+    def getCommandDeps(self, nn, cmds):
+        """
+        Return the paths of the programs run by @p cmds, the dependencies
+        which the scons command scan would have added for NinjaNode @p nn.
+        """
+        env = nn.getNode().get_executor().get_build_env()
+        icd = env.get('IMPLICIT_COMMAND_DEPENDENCIES', True)
+        if SCons.Util.is_String(icd) and icd[:1] == '$':
+            icd = env.subst(icd)
+        if not icd or icd in ('0', 'None'):
+            return []
+        path = env['ENV'].get('PATH')
+        deps = []
+        for cmd in cmds:
+            words = cmd.split(None, 1)
+            if not words:
+                continue
+            program = words[0].strip('"')
+            key = (program, path)
+            if key not in self.programs:
+                self.programs[key] = env.WhereIs(program)
+            if self.programs[key]:
+                deps.append(self.programs[key])
+        return deps
+
+
+class NinjaFile(object):
+    """
+    Accumulate the rules and build statements for a ninja file.  Each
+    distinct command template, like the unsubstituted $CXXCOM, gets its own
+    rule named after the builder, and the build statements pass the
+    substituted command in the cmd variable.  If @p depfiles is True, C and
+    C++ compile commands write a gcc depfile, so ninja tracks the headers
+    included by each source itself.  Nodes built by python
+    functions are run by the eol_scons.ninja_stub module, from the
+    specifications saved in a file next to the ninja file.  The
+    substituted commands are kept in a CommandCache in another file next
+    to the ninja file.
+    """
+
+    def __init__(self, path, depfiles=True):
+        self.path = path
+        self.depfiles = depfiles
+        self.stubpath = path + '.stubs'
+        self.commands = CommandCache(path + '.cache')
+        self.rules = {}
+        self.rulenames = set()
+        self.ruletext = []
+        self.builds = []
+        self.stubs = {}
+        self.regen = ''
+
+    def _rule(self, node, template, depfile=False):
+        rule = self.rules.get((template, depfile))
+        if rule:
+            return rule
+        name = 'cmd'
+        if node.has_builder():
+            name = node.builder.get_name(node.get_env()) or name
+        # Builders not in BUILDERS, like those of Command(), are named
+        # after their class, which is no use as a rule name.
+        if not re.match(r'^\w+$', name):
+            name = 'cmd'
+        rule = name
+        i = 1
+        while rule in self.rulenames:
+            i += 1
+            rule = "%s_%d" % (name, i)
+        self.rules[(template, depfile)] = rule
+        self.rulenames.add(rule)
+        self.ruletext.append(_ninja_rule % (rule, name,
+                                            depfile and _ninja_depfile or ''))
+        return rule
+
+    def addAlias(self, nn):
+        deps = [_escape_path(str(dep)) for dep in nn.getNode().all_children()]
+        self.builds.append(_ninja_alias %
+                           (_escape_path(nn.getNode().name), ' '.join(deps)))
+
+    def addCommand(self, nn, targets):
+        template = nn.getTemplate()
+        depfile = (self.depfiles and len(targets) == 1 and
+                   nn.getCompiler(template) is not None)
+        rule = self._rule(nn.getNode(), template, depfile)
+        outputs = ' '.join([_escape_path(t.get_path()) for t in targets])
+        deps = nn.getDeps(targets)
+        cmds = self.commands.getCommands(nn, template)
+        for program in self.commands.getCommandDeps(nn, cmds):
+            program = nn.getNode().fs.File(program).get_path()
+            if program not in deps:
+                deps.append(program)
+        deps = ' '.join([_escape_path(d) for d in deps])
+        if depfile:
+            cmds[0] += " -MMD -MF %s.d" % (targets[0].get_path())
+        self.builds.append(_ninja_cmd % (outputs, rule, deps,
+                                         _escape_value(' && '.join(cmds))))
+
+    def addStub(self, nn, targets, spec):
+        key = hashlib.md5(pickle.dumps(spec, 2)).hexdigest()
+        self.stubs[key] = spec
+        outputs = ' '.join([_escape_path(t.get_path()) for t in targets])
+        deps = ' '.join([_escape_path(d) for d in nn.getDeps(targets)])
+        desc = "%s %s" % (spec['function'], ' '.join(spec['targets']))
+        self.builds.append(_ninja_stub % (outputs, deps, key,
+                                          _escape_value(desc)))
+
+    def addRegen(self, inputs, command):
+        """
+        Add the build statement which regenerates the ninja file by running
+        @p command whenever any of the @p inputs change.  Ninja runs it
+        before anything else when the ninja file is out of date.
+        """
+        output = os.path.relpath(os.path.abspath(self.path))
+        self.regen = _ninja_regen % (
+            _escape_path(output), ' '.join([_escape_path(i) for i in inputs]),
+            _escape_value(command))
+
+    def write(self):
+        "Write the ninja file and the stub specifications atomically."
+        text = [_ninja_header]
+        text.extend(self.ruletext)
+        if self.stubs:
+            stub.WriteStubs(self.stubpath, self.stubs)
+            text.append(_ninja_stub_rule %
+                        (_escape_value(sys.executable),
+                         _escape_value(stub.SourceFile(stub.__file__)),
+                         _escape_value(os.path.abspath(self.stubpath))))
+        text.extend(self.builds)
+        text.append(self.regen)
+        dest_temp = '%s.tmp' % self.path
+        ninja_fh = open(dest_temp, 'w')
+        try:
+            ninja_fh.write(''.join(text))
+        finally:
+            ninja_fh.close()
+        # Make the result file visible atomically.
+        os.rename(dest_temp, self.path)
+        self.commands.save()
+        print("ninja command cache %s: %d hits, %d misses" %
+              (self.commands.path, self.commands.hits, self.commands.misses))
+
+
+def WriteFile(dest_file, node_list, depfiles=True):
+    "Write the ninja file @p dest_file for the nodes in @p node_list."
+    nfile = NinjaFile(dest_file, depfiles)
+    sconsnodes = []
+    AddNodes(nfile, node_list, sconsnodes)
+    nfile.write()
+    return sconsnodes
+
+
+def AddNodes(nfile, node_list, sconsnodes):
+    """
+    Add build statements for the nodes in @p node_list to NinjaFile
+    @p nfile.  Nodes which cannot be translated are appended to
+    @p sconsnodes.  A node which shares its executor with a node already
+    added is skipped, since its build statement lists all the targets.
+    """
+    executors = set()
+    for node in node_list:
+        nn = NinjaNode(node)
+        if nn.isAlias():
+            nfile.addAlias(nn)
+            continue
         executor = node.get_executor()
         if executor is None:
             print("ignoring node without executor: %s" % (str(node)))
-            return ""
-        actions = executor.get_action_list()
-        env = node.get_env()
-        from SCons.Subst import SUBST_RAW
-        cmds = [env.subst(cmd, 0, executor=executor)
-                for cmd in str(executor).splitlines()
-                if not cmd.startswith('_checkMocIncluded')]
-        return _ninja_cmd % (dest_path, ' '.join(deps), ' && '.join(cmds))
+            continue
+        if id(executor) in executors:
+            continue
+        executors.add(id(executor))
+        targets = nn.getTargets()
+        action = nn.getFunction()
+        if action is None:
+            nfile.addCommand(nn, targets)
+            continue
+        spec = nn.getStubSpec(action, targets)
+        if spec:
+            nfile.addStub(nn, targets, spec)
+        else:
+            print("building function node with scons: %s" % (str(node)))
+            sconsnodes.append(node)
 
 
-def WriteFile(dest_file, node_list):
-    dest_temp = '%s.tmp' % dest_file
-    ninja_fh = open(dest_temp, 'w')
-    ninja_fh.write(_ninja_header)
+def RegenInputs(env):
+    """
+    Return the paths of the files which the ninja file depends on: the
+    SConstruct and SConscript files read, the python modules loaded from the
+    eol_scons package or from the source tree, like tools and tool files,
+    the config files of the global variables, and the cache of config
+    script results.  Files outside the top directory are absolute.
+    """
+    import eol_scons
+    import eol_scons.parseconfig
+    topdir = env.Dir('#').get_abspath()
+    paths = [node.get_abspath() for node in eol_scons.SConscriptFiles()]
+    for module in list(sys.modules.values()):
+        modfile = getattr(module, '__file__', None)
+        if modfile:
+            modfile = stub.SourceFile(modfile)
+            if (modfile.startswith(eol_scons._eolsconsdir + os.sep) or
+                modfile.startswith(topdir + os.sep)):
+                paths.append(modfile)
+    paths.extend(variables.files)
+    paths.append(env.File(eol_scons.parseconfig._config_cache_file)
+                 .get_abspath())
+    inputs = set()
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        if path.startswith(topdir + os.sep):
+            path = path[len(topdir) + 1:]
+        inputs.add(path)
+    return sorted(inputs)
 
-    for node in node_list:
-        nn = NinjaNode(node)
-        ninja_fh.write(nn.getRule())
 
-    # Make the result file visible atomically.
-    os.rename(dest_temp, dest_file)
+def RegenCommand(ninjapath):
+    """
+    Return the command to regenerate the ninja file by running scons again
+    with the same arguments from the same directory.  Running scons can
+    update cache files which are inputs to the ninja file, so the command
+    finishes by touching the ninja file to make it newer than its inputs.
+    """
+    scons = [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:]
+    return "cd %s && %s && touch %s" % (
+        quote(SCons.Script.GetLaunchDir()), ' '.join(map(quote, scons)),
+        quote(os.path.abspath(ninjapath)))
+
+
+def SconsCommand(targets):
+    """
+    Return the command to build @p targets by running scons again with the
+    same options and variables, except the ninja setting, from the same
+    directory, for the stub runner to fall back on.
+    """
+    skip = set(SCons.Script.COMMAND_LINE_TARGETS)
+    args = [arg for arg in sys.argv[1:]
+            if arg not in skip and not arg.startswith('ninja=')]
+    return ([sys.executable, os.path.abspath(sys.argv[0])] + args +
+            [t.get_abspath() for t in targets])
+
+
+def NoCommandScan(disable):
+    """
+    Disable the scons scan of commands for the programs they run if
+    @p disable is True, otherwise restore it.  See CommandCache.
+    """
+    global _command_scan
+    if disable and _command_scan is None:
+        _command_scan = SCons.Action.CommandAction.get_implicit_deps
+        SCons.Action.CommandAction.get_implicit_deps = \
+            lambda self, target, source, env, executor=None: []
+    elif not disable and _command_scan is not None:
+        SCons.Action.CommandAction.get_implicit_deps = _command_scan
+        _command_scan = None
+
+
+def ClearScans(nodes):
+    """
+    Discard the implicit dependencies found for @p nodes, and for the other
+    targets built with them, while the command scan was disabled, so scons
+    scans them again, including the programs, if it builds any of them.
+    """
+    for node in nodes:
+        executor = node.get_executor()
+        targets = executor and executor.get_all_targets() or [node]
+        for target in targets:
+            target.implicit = None
+            target.clear_memoized_values()
 
 
-def SeparateNodes(env, targets, ninjanodes, sconsnodes):
+def SeparateNodes(env, targets, ninjanodes, sconsnodes, scanned=None):
     """
     Starting with the root targets, traverse the tree of dependency nodes
     separating them into filesystem nodes which can be built by ninja and
-    those which can only be built within scons.
-
-    Maybe this should be replaced with SCons.Node.Walker.
+    those which can only be built within scons.  Nodes built by python
+    functions go to ninja as well, where they are run by the stub runner
+    if possible.  The nodes traversed are appended to @p scanned if it is
+    not None.
     """
-    tree = targets[:]
+    visited = set(ninjanodes) | set(sconsnodes)
+    tree = deque(targets)
     while tree:
-        node = tree[0]
-        del tree[0]
-        nn = NinjaNode(node)
-        if not node.has_builder() or node in ninjanodes or node in sconsnodes:
+        node = tree.popleft()
+        if node in visited or not node.has_builder():
             continue
+        visited.add(node)
+        if scanned is not None:
+            scanned.append(node)
+        nn = NinjaNode(node)
         depnodes = node.all_children()
         tree.extend(depnodes)
-        # print("separating node %s with children: %s" %
-        #       (str(node), " ".join([str(n) for n in depnodes])))
         if nn.isAlias():
             # Explicitly add Aliases to ninja nodes; they will be handled
             # specially in WriteFile()
-            print("adding Alias node to ninja: %s" % (str(node)))
             ninjanodes.append(nn.getNode())
         elif nn.isDirectory():
             # Directory nodes have an implicit function builder, MkdirFunc,
@@ -288,21 +867,14 @@ def SeparateNodes(env, targets, ninjanodes, sconsnodes):
             # directory name as a kind of alias for all targets underneath
             # it.  If that's needed, then add an explicit Alias() for that
             # directory in scons, eg, env.Alias('dox', env.Dir("apidocs")).
-            
-            # print("traversing Directory node: %s" % (str(node)))
-            # ninjanodes.append(node)
             pass
         elif nn.isConfNode():
             pass
         elif nn.isValue():
             print("building Value node with scons: %s" % (str(node)))
             sconsnodes.append(node)
-        elif isinstance(node.builder.action, SCons.Action.FunctionAction):
-            print("building function node with scons: %s" % (str(node))) 
-            sconsnodes.append(node)
         else:
             ninjanodes.append(node)
-    # print("SeparateNodes() finished.")
     return ninjanodes, sconsnodes
 
 
@@ -310,8 +882,14 @@ def generate(env):
     global variables
     if variables is None:
         variables = env.GlobalVariables()
-        variables.AddVariables((
-            'ninja', 'Write ninja build rules into the given file.', None))
+        variables.AddVariables(
+            ('ninja', 'Write ninja build rules into the given file.', None),
+            BoolVariable('ninja_depfiles',
+                         'Add -MMD depfiles to the C and C++ compile '
+                         'commands in the ninja file.', True),
+            BoolVariable('ninja_regen',
+                         'Add a rule to the ninja file to regenerate it '
+                         'when the SConscript files change.', True))
     env.AddMethod(NinjaCheck)
 
 
@@ -327,11 +905,22 @@ def NinjaCheck(env):
     targets = SCons.Script.BUILD_TARGETS
     fs = SCons.Node.FS.get_default_fs()
     nodes = [_f for _f in map(lambda x: Entry(x, fs), targets) if _f]
-    # nodes = [_f for _f in map(fs.Entry, targets) if _f]
 
-    ninjanodes, sconsnodes = SeparateNodes(env, nodes, [], [])
-    SCons.Script.BUILD_TARGETS[:] = sconsnodes
-    WriteFile(ninjapath, ninjanodes)
+    nfile = NinjaFile(ninjapath, env.get('ninja_depfiles', True))
+    scanned = []
+    NoCommandScan(True)
+    try:
+        ninjanodes, sconsnodes = SeparateNodes(env, nodes, [], [], scanned)
+        AddNodes(nfile, ninjanodes, sconsnodes)
+    finally:
+        NoCommandScan(False)
+        ClearScans(scanned)
+    if env.get('ninja_regen', True):
+        nfile.addRegen(RegenInputs(env), RegenCommand(ninjapath))
+    nfile.write()
+    # Leave scons something to check when everything goes to ninja, so it
+    # does not stop with an error about missing targets.
+    SCons.Script.BUILD_TARGETS[:] = sconsnodes or [env.File(ninjapath)]
 
   
 # def generate(env):
@@ -369,5 +958,44 @@ def NinjaCheck(env):
   
 
 def exists(env):
-    return true
+    return True
+
+
 
+# Run this test like so:
+#
+# env PYTHONPATH=/usr/lib/scons py.test -v ninja.py
+
+def test_stub_textfile(tmpdir):
+    import subprocess
+    import SCons.Environment
+    env = SCons.Environment.Environment(tools=['textfile'])
+    tmpdir.join('sub.in').write('x=@X@\n')
+    nodes = (env.Textfile(str(tmpdir.join('out.txt')), ['a', 'b']) +
+             env.Substfile(str(tmpdir.join('sub.txt')),
+                           str(tmpdir.join('sub.in')),
+                           SUBST_DICT={'@X@': 'value'}))
+    stubs = {}
+    for node in nodes:
+        nn = NinjaNode(node)
+        spec = nn.getStubSpec(nn.getFunction(), nn.getTargets())
+        # Fail rather than fall back on scons.
+        spec['scons'] = None
+        stubs[os.path.basename(str(node))] = spec
+    # Unset variables of the function, like SUBST_DICT, are left out.
+    assert 'SUBST_DICT' not in stubs['out.txt']['env']
+    assert stubs['sub.txt']['env']['SUBST_DICT'] == {'@X@': 'value'}
+    # A failing stub falls back on the scons command.
+    stubs['fail'] = dict(stubs['out.txt'])
+    stubs['fail']['env'] = dict(stubs['out.txt']['env'], SUBST_DICT=None)
+    stubs['fail']['scons'] = [sys.executable, '-c',
+                              'open("fallback.txt", "w").write("scons")']
+    stubs['fail']['cwd'] = str(tmpdir)
+    path = str(tmpdir.join('build.ninja.stubs'))
+    stub.WriteStubs(path, stubs)
+    for key in ('out.txt', 'sub.txt', 'fail'):
+        assert subprocess.call([sys.executable, stub.__file__,
+                                path, key]) == 0
+    assert tmpdir.join('out.txt').read() == 'a\nb'
+    assert tmpdir.join('sub.txt').read() == 'x=value\n'
+    assert tmpdir.join('fallback.txt').read() == 'scons'
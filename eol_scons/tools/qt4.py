@@ -200,10 +200,15 @@ AutomocShared = _Automoc('SharedObject')
 AutomocStatic = _Automoc('StaticObject')
 
 def _locateQt4Command(env, command) :
-    # Check the cache
+    # Check the cache.  The result depends on the QT4DIR setting and on
+    # the paths searched for the command, and the cached result is only
+    # valid as long as the command itself has not changed.
     cache = env.CacheVariables()
     key = "qt4_" + command
-    result = cache.lookup(env, key)
+    settings = {'QT4DIR': env.get('QT4DIR'),
+                'PATH': env['ENV'].get('PATH'),
+                'PKG_CONFIG_PATH': env['ENV'].get('PKG_CONFIG_PATH')}
+    result = cache.lookup(env, key, settings)
     if result:
         return result
 
@@ -249,7 +254,7 @@ def _locateQt4Command(env, command) :
         msg += " not in $PATH"
         raise SCons.Errors.StopError, msg
 
-    cache.store(env, key, result)
+    cache.store(env, key, result, [env.WhereIs(result) or result], settings)
     return result
 
 
@@ -480,6 +485,15 @@ def enable_modules(self, modules, debug=False) :
 
         if debug:
             modules = [module + "_debug" for module in modules]
+        if (self['QT4DIR'] == USE_PKG_CONFIG):
+            # Run all the pkg-config queries needed below at once.
+            queries = ['pkg-config --variable=headerdir Qt',
+                       'pkg-config --variable=prefix QtCore']
+            for module in modules:
+                queries.extend(['pkg-config --exists ' + module,
+                                'pkg-config --cflags ' + module,
+                                'pkg-config --libs ' + module])
+            pc.PrefetchConfig(self, queries)
         for module in modules:
             if (self['QT4DIR'] == USE_PKG_CONFIG):
                 Debug("enabling module %s through pkg-config" % (module), self)
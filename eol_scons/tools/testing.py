@@ -38,6 +38,57 @@ valgrind output parser could extract information from the output and pass
 through only the errors.  Then the filters could be broken down into types
 of output, such as boost tests, logx Checker tests, and valgrind checks.
 
+Tests can run in parallel with 'scons -j'.  Each test gets its own output
+spawner, so tests do not interfere with each other's Environment.  Tests
+which cannot run at the same time as certain other tests declare resource
+tags, either with the resources keyword or with the TEST_RESOURCES
+construction variable.  Tests which share a tag never run at the same
+time, and a test tagged 'exclusive' only runs when no other test is
+running.  For example, tests which each start a headless X server or a
+test database could be tagged like this:
+
+  env.TestLog('xtest', [testprog], actions, resources=['xvfb'])
+  env.TestLog('dbtest', [testprog, sql], dbactions, resources=['postgres'])
+
+A test waiting for a resource holds one of the scons jobs, so it can help
+to run with a few more jobs than processors.  At the end of the run a
+summary of the tests which ran is printed, with their run times, the sum
+of the test times and the wall time.
+
+The results of the tests which ran are written in JUnit XML to
+test-results.xml in the top directory, and added to the history of test
+results in test-results.json.  For each test run the history keeps the run
+time, exit status, output size, and the filtered output lines which report
+failures.  The test_results variable changes the base path of these files,
+or disables them when empty.  Tests added to the default 'test' alias are
+started longest first according to the history, and the summary flags
+tests whose run time is more than test_regression (default 1.5) times their
+median run time.
+
+With test_impact=1, each test which passes records a signature of its
+inputs in the history: the content signatures of everything the test
+depends on, like the test programs, the libraries and objects they are
+built from, and data files, along with the test actions.  A test is
+skipped on later runs as long as those inputs do not change.  Pass
+test_force=1 to run all the tests anyway.
+
+To spread the default tests over several machines, pass test_shard=K/N to
+run only the tests in shard K of N.  Tests are assigned to shards by a
+hash of their name, so every machine assigns the same shards.  To balance
+the shards by run time, pass test_shard_timings with the path to a copy of
+test-results.json, such as one saved from an earlier run and given to
+every machine.  Tests with timings in that file are then assigned longest
+first, each to the shard with the least total run time, and the others by
+the hash of their name.  The timings file is only read, so the partition
+does not change as tests run.  The test_manifest target writes the list of
+the default tests to test-manifest.json, with their targets, sources,
+resources, median run time, and shard.
+
+Test output is read in large chunks and filtered a chunk at a time, so
+tests which write a lot of output do not spend much time in the filter.
+Set the TEST_LOG_COMPRESS construction variable to write TestLog logs
+compressed with gzip, as <alias>.log.gz.
+
 All tests are cleaned by default.  In other words, when no targets are
 given on the command line with the clean option, the test targets are added
 to the default targets so they will be cleaned.  Run 'scons -c' to clean
@@ -53,10 +104,11 @@ This module defines extra test-related "sub-tools" which seem too small to
 warrant their own module.  The 'gtest' tool adds the gtest library for
 building google-test programs, while the 'gtest_main' tool also links
 against the 'gtest_main' library for programs which do not provide their
-own main().  These tools are not defined until this tool has been loaded,
-so the testing tool must always be required first:
+own main().  These tools are listed in the eol_scons tool manifest, so
+requiring them imports this module to define them, and it is not necessary
+to require the testing tool first:
 
-env = Environment(tools=['default', 'testing', 'gtest'])
+env = Environment(tools=['default', 'gtest'])
 """
 
 import subprocess
@@ -64,14 +116,25 @@ import io
 import sys
 import os
 import re
+import json
+import hashlib
+import gzip
+import time
+import atexit
 import difflib
+import threading
+from xml.sax.saxutils import escape, quoteattr
 
 import SCons
+import SCons.Errors
+import SCons.Node.FS
+import SCons.Scanner
 import SCons.Script
 from SCons.Script import DefaultEnvironment
 from SCons.Action import Action
 from SCons.Action import ListAction
 from SCons.Script import Builder
+from SCons.Variables import BoolVariable
 
 _echo_only = False
 
@@ -87,21 +150,56 @@ _rxpatterns = [ r'^\d+ checks\.',
                 ]
 
 
+# Size of the chunks read from the test output and of the log buffer.
+_chunk_size = 64 * 1024
+_log_buffer = 1024 * 1024
+
+# Filtered lines which report failures are kept in the test results.
+_rxfailure = re.compile(br'fail|error', re.IGNORECASE)
+_max_failure_lines = 100
+
+
+def _to_bytes(text):
+    if isinstance(text, (bytes, bytearray)):
+        return text
+    return text.encode('utf-8')
+
+
+def _write_stdout(data):
+    "Write the bytes in @p data to stdout."
+    out = getattr(sys.stdout, 'buffer', None)
+    if out is None:
+        sys.stdout.write(data)
+    else:
+        sys.stdout.flush()
+        out.write(data)
+        out.flush()
+
+
 class _SpawnerLogger:
+    """
+    Run a test command and pump its output into the log file and through
+    the output filter.  The output is read in large chunks as soon as it is
+    available, and the filter runs over all the complete lines in a chunk
+    at once, with the passing patterns combined into a single regular
+    expression.  A pattern is matched against the lines of a chunk in
+    multiline mode, so it should not match across the end of a line.  If
+    the log path ends in .gz, the log is compressed.
+    """
 
     def __init__(self):
         self.logpath = None
         self.logfile = None
         self._rxpass = None
+        self.flines = 0
+        self.nbytes = 0
+        self.failures = []
         self.setPassingPatterns(_rxpatterns)
 
     def _pass_filter(self, line):
         if self._rxpass is None:
             return True
-        for rx in self._rxpass:
-            if rx.search(line):
-                return True
-        return False
+        return bool(self._rxpass.search(_to_bytes(line)))
 
     def setPassingPatterns(self, rxpatterns):
         """
@@ -110,11 +208,23 @@ class _SpawnerLogger:
         """
         self._rxpass = None
         if rxpatterns:
-            self._rxpass = [ re.compile(rx) for rx in rxpatterns ]
+            rx = '|'.join(['(?:%s)' % (p) for p in rxpatterns])
+            # When every pattern is anchored at the start of the line,
+            # anchor the combination instead, so the regex engine tries
+            # the alternatives only at line starts.
+            if not [p for p in rxpatterns
+                    if not p.startswith('^') or '|' in p]:
+                rx = '^(?:%s)' % ('|'.join(['(?:%s)' % (p[1:])
+                                            for p in rxpatterns]))
+            self._rxpass = re.compile(_to_bytes(rx), re.MULTILINE)
 
     def open(self, logpath):
         self.logpath = logpath
-        self.logfile = open(self.logpath, "w")
+        if logpath.endswith('.gz'):
+            # Favor speed over size, test logs compress well anyway.
+            self.logfile = gzip.open(self.logpath, "wb", 1)
+        else:
+            self.logfile = open(self.logpath, "wb", _log_buffer)
         print("Writing test log '%s', filtering stdout and stderr." % 
               (self.logpath))
 
@@ -125,6 +235,44 @@ class _SpawnerLogger:
             self.logfile = None
             self.logpath = None
 
+    def _skip(self, nlines, out):
+        "Filter out @p nlines lines, with a dot for every 50 in a row."
+        dots = (self.flines + nlines) // 50 - self.flines // 50
+        if dots:
+            out.append(b'.' * dots)
+        self.flines += nlines
+
+    def _filter(self, text, final=False):
+        """
+        Write the lines in @p text which match the passing patterns to
+        stdout.  @p text must end at the end of a line unless @p final.
+        """
+        out = []
+        pos = 0
+        for match in self._rxpass.finditer(text):
+            start = text.rfind(b'\n', 0, match.start()) + 1
+            if start < pos:
+                # Another match in a line which already passed.
+                continue
+            end = text.find(b'\n', max(start, match.end() - 1))
+            end = len(text) if end < 0 else end + 1
+            self._skip(text.count(b'\n', pos, start), out)
+            if self.flines >= 50:
+                out.append(b'\n')
+            self.flines = 0
+            out.append(text[start:end])
+            if (len(self.failures) < _max_failure_lines and
+                _rxfailure.search(text, start, end)):
+                self.failures.append(text[start:end].rstrip().decode(
+                    'utf-8', 'replace'))
+            pos = end
+        nlines = text.count(b'\n', pos)
+        if final and pos < len(text) and not text.endswith(b'\n'):
+            nlines += 1
+        self._skip(nlines, out)
+        if out:
+            _write_stdout(b''.join(out))
+
     def spawn(self, sh, escape, cmd, args, env):
         cmd = [sh, '-c', ' '.join(args)]
         if _echo_only:
@@ -132,52 +280,602 @@ class _SpawnerLogger:
         pipe = subprocess.Popen(cmd, env=env,
                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE, 
                                 stderr=subprocess.STDOUT,
-                                bufsize=1, close_fds=True, shell=False)
+                                bufsize=0, close_fds=True, shell=False)
         pipe.stdin.close()
-        output = pipe.stdout.readline()
-        flines = 0
-        while output:
+        fd = pipe.stdout.fileno()
+        self.flines = 0
+        # The output since the last complete line.
+        partial = []
+        while True:
+            chunk = os.read(fd, _chunk_size)
+            if not chunk:
+                break
+            self.nbytes += len(chunk)
             if self.logfile:
-                self.logfile.write(output)
-            if self._pass_filter(output):
-                if flines >= 50:
-                    sys.stdout.write("\n")
-                sys.stdout.write(output)
-                flines = 0
-            else:
-                flines = flines + 1
-                if flines % 50 == 0:
-                    sys.stdout.write('.')
-            output = pipe.stdout.readline()
+                self.logfile.write(chunk)
+            if self._rxpass is None:
+                _write_stdout(chunk)
+                continue
+            nl = chunk.rfind(b'\n')
+            if nl < 0:
+                partial.append(chunk)
+                continue
+            partial.append(chunk[:nl+1])
+            self._filter(b''.join(partial))
+            partial = [chunk[nl+1:]]
+        if self._rxpass is not None:
+            self._filter(b''.join(partial), final=True)
+        pipe.stdout.close()
         pipe.wait()
-        if flines >= 50:
-            sys.stdout.write("\n")
+        if self.flines >= 50:
+            _write_stdout(b"\n")
         return pipe.returncode
 
 
+class _TestScheduler(object):
+    """
+    Keep tests which share resources from running at the same time when
+    scons runs tests in parallel, and keep the results for the summary.
+    A test waits in acquire() until none of its resources are in use by a
+    running test.  An 'exclusive' test waits until no tests are running,
+    and while it waits no other tests start, so it is not starved.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.running = []
+        self.exclusive_waiting = 0
+        self.results = []
+        self.skipped = []
+        self.start = None
+
+    def _started(self):
+        if self.start is None:
+            self.start = time.time()
+            atexit.register(self.summary)
+
+    def _compatible(self, resources):
+        if 'exclusive' in resources:
+            return not self.running
+        if self.exclusive_waiting:
+            return False
+        for running in self.running:
+            if 'exclusive' in running or running & resources:
+                return False
+        return True
+
+    def acquire(self, resources):
+        self.cond.acquire()
+        try:
+            exclusive = 'exclusive' in resources
+            if exclusive:
+                self.exclusive_waiting += 1
+            try:
+                while not self._compatible(resources):
+                    self.cond.wait()
+            finally:
+                if exclusive:
+                    self.exclusive_waiting -= 1
+            self.running.append(resources)
+            self._started()
+        finally:
+            self.cond.release()
+
+    def release(self, resources, result):
+        self.cond.acquire()
+        try:
+            self.running.remove(resources)
+            self.results.append(result)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def skip(self, name):
+        "Record that test @p name was skipped because it was unchanged."
+        self.cond.acquire()
+        try:
+            self.skipped.append(name)
+            self._started()
+        finally:
+            self.cond.release()
+
+    def summary(self):
+        """
+        Print the summary of the tests which ran, and write the results to
+        the test history.
+        """
+        if self.skipped:
+            print("Skipped %d tests whose inputs did not change." %
+                  (len(self.skipped)))
+        if not self.results:
+            return
+        wall = time.time() - self.start
+        _history.add(self.results)
+        failed = [r for r in self.results if r['status']]
+        total = sum([r['elapsed'] for r in self.results])
+        print("Test summary: %d tests, %d passed, %d failed, "
+              "%.1f s of tests in %.1f s with %d jobs." %
+              (len(self.results), len(self.results) - len(failed),
+               len(failed), total, wall,
+               SCons.Script.GetOption('num_jobs')))
+        for r in sorted(self.results, key=lambda r: -r['elapsed']):
+            slower = ""
+            if r.get('regressed'):
+                slower = "  (slower, usually %.1f s)" % (r['median'])
+            print("  %-8s %7.1f s  %s%s" %
+                  (r['status'] and "FAILED" or "passed", r['elapsed'],
+                   r['name'], slower))
+        _history.write(self.results)
+
+
+class _TestHistory(object):
+    """
+    The results of past test runs, kept in a JSON file, and the JUnit XML
+    file for the tests of the latest run.  Each test keeps its last few
+    runs, with the start time, run time, exit status, size of the output,
+    and the filtered output lines which report failures.  The history is
+    used to start the longest tests first, and to flag tests whose run
+    time regressed.  The JSON file is the path plus @p suffix.
+    """
+
+    def __init__(self, suffix='.json'):
+        self.suffix = suffix
+        self.path = None
+        self.tests = None
+        self.threshold = 1.5
+        self.keep = 20
+
+    def setPath(self, path):
+        """
+        Set the base path of the results files, without the suffix and the
+        .xml extension, or None to not keep results.
+        """
+        if path != self.path:
+            self.path = path
+            self.tests = None
+
+    def _load(self):
+        if self.tests is not None:
+            return self.tests
+        self.tests = {}
+        if not self.path:
+            return self.tests
+        try:
+            hfile = open(self.path + self.suffix)
+        except IOError:
+            return self.tests
+        try:
+            try:
+                data = json.load(hfile)
+            except ValueError:
+                print("Ignoring unreadable test results: %s%s" %
+                      (self.path, self.suffix))
+                return self.tests
+        finally:
+            hfile.close()
+        if data.get('version') == _history_version:
+            self.tests = data['tests']
+        return self.tests
+
+    def median(self, name):
+        """
+        Return the median run time of the passing runs of test @p name, or
+        of all its runs if none passed, or None if there is no history for
+        the test.
+        """
+        runs = self._load().get(name, {}).get('runs', [])
+        times = sorted([run['elapsed'] for run in runs if not run['status']])
+        if not times:
+            times = sorted([run['elapsed'] for run in runs])
+        if not times:
+            return None
+        return times[len(times) // 2]
+
+    def add(self, results):
+        """
+        Add the @p results of this run to the history, and flag the results
+        which regressed: those which passed and took longer than the
+        threshold times the median, and at least a second longer.  A test
+        needs three passing runs before it can regress.
+        """
+        tests = self._load()
+        for result in results:
+            name = result['name']
+            runs = tests.setdefault(name, {}).setdefault('runs', [])
+            median = self.median(name)
+            npassed = len([run for run in runs if not run['status']])
+            result['median'] = median
+            result['regressed'] = bool(
+                not result['status'] and npassed >= 3 and
+                result['elapsed'] > self.threshold * median and
+                result['elapsed'] - median > 1.0)
+            runs.append(dict([(k, v) for k, v in result.items()
+                              if k not in ('name', 'inputs')]))
+            del runs[:-self.keep]
+            tests[name]['inputs'] = None
+            if not result['status']:
+                tests[name]['inputs'] = result.get('inputs')
+
+    def unchanged(self, name, inputs):
+        """
+        Return True if test @p name passed the last time it ran and the
+        signature of its inputs then was @p inputs.
+        """
+        return bool(self.path and inputs and
+                    self._load().get(name, {}).get('inputs') == inputs)
+
+    def write(self, results):
+        "Write the history and the JUnit XML for @p results."
+        if not self.path:
+            return
+        self._write(self.path + '.json', self._json())
+        self._write(self.path + '.xml', self._junit(results))
+        print("Test results written to %s.xml and %s.json" %
+              (self.path, self.path))
+
+    def _write(self, path, text):
+        tmppath = "%s.%d" % (path, os.getpid())
+        try:
+            rfile = io.open(tmppath, 'w', encoding='utf-8')
+            try:
+                rfile.write(text)
+            finally:
+                rfile.close()
+            os.rename(tmppath, path)
+        except (IOError, OSError) as ex:
+            print("Failed to write test results %s: %s" % (path, str(ex)))
+
+    def _json(self):
+        text = json.dumps({'version': _history_version, 'tests': self.tests},
+                          indent=1, sort_keys=True, ensure_ascii=False)
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        return text
+
+    def _junit(self, results):
+        failed = [r for r in results if r['status']]
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<testsuite name="scons" tests="%d" failures="%d" '
+                 'time="%.3f" timestamp=%s>' %
+                 (len(results), len(failed),
+                  sum([r['elapsed'] for r in results]),
+                  quoteattr(time.strftime('%Y-%m-%dT%H:%M:%S',
+                                          time.localtime(
+                                              min([r['start']
+                                                   for r in results])))))]
+        for r in sorted(results, key=lambda r: r['start']):
+            (classname, name) = os.path.split(r['name'])
+            lines.append('  <testcase classname=%s name=%s time="%.3f">' %
+                         (quoteattr(classname.replace(os.sep, '.') or '.'),
+                          quoteattr(name), r['elapsed']))
+            if r['status']:
+                lines.append('    <failure message=%s>%s</failure>' %
+                             (quoteattr("exit status %s" % (r['status'])),
+                              escape(u"\n".join(r['failures']))))
+            out = "%d bytes of output" % (r['output_bytes'])
+            if r['log']:
+                out += " in %s" % (r['log'])
+            if r.get('regressed'):
+                out += ", slower than the usual %.1f s" % (r['median'])
+            lines.append('    <system-out>%s</system-out>' % (escape(out)))
+            lines.append('  </testcase>')
+        lines.append('</testsuite>')
+        return u"\n".join(lines) + u"\n"
+
+
+_history_version = 1
+_history = _TestHistory()
+# The read-only history used to assign shards.
+_timings = _TestHistory(suffix='')
+_scheduler = _TestScheduler()
+
+
+# Run these tests like so:
+#
+# env PYTHONPATH=/usr/lib/scons py.test -v testing.py
+
+def _test_result(name, elapsed, status=0, start=0.0):
+    return {'name': name, 'start': start, 'end': start + elapsed,
+            'elapsed': elapsed, 'status': status, 'output_bytes': 10,
+            'log': None, 'failures': status and ['FAILED: check'] or [],
+            'inputs': 'sig'}
+
+
+def test_history_median():
+    history = _TestHistory()
+    history.tests = {}
+    assert history.median('t1') is None
+    history.tests['t1'] = {'runs': [{'elapsed': 3.0, 'status': 0},
+                                    {'elapsed': 1.0, 'status': 0},
+                                    {'elapsed': 9.0, 'status': 1},
+                                    {'elapsed': 2.0, 'status': 0}]}
+    # Only the passing runs count when there are any.
+    assert history.median('t1') == 2.0
+    history.tests['t2'] = {'runs': [{'elapsed': 4.0, 'status': 1},
+                                    {'elapsed': 5.0, 'status': 2}]}
+    assert history.median('t2') == 5.0
+
+
+def test_history_add():
+    history = _TestHistory()
+    history.tests = {}
+    history.keep = 4
+    for elapsed in (1.0, 1.1, 0.9):
+        history.add([_test_result('t1', elapsed)])
+    # Slower, but still within a second of the median.
+    result = _test_result('t1', 1.8)
+    history.add([result])
+    assert result['median'] == 1.0
+    assert not result['regressed']
+    result = _test_result('t1', 3.0)
+    history.add([result])
+    assert result['median'] == 1.1
+    assert result['regressed']
+    assert len(history.tests['t1']['runs']) == 4
+    assert 'name' not in history.tests['t1']['runs'][0]
+    assert history.tests['t1']['inputs'] == 'sig'
+    # A failure is never a regression, and clears the inputs signature.
+    result = _test_result('t1', 30.0, status=1)
+    history.add([result])
+    assert not result['regressed']
+    assert history.tests['t1']['inputs'] is None
+    history.path = '/tmp/test-results'
+    assert not history.unchanged('t1', 'sig')
+    history.add([_test_result('t1', 1.0)])
+    assert history.unchanged('t1', 'sig')
+    # Two passing runs are not enough history to regress.
+    result = _test_result('t2', 1.0)
+    history.add([result, _test_result('t2', 1.0)])
+    result = _test_result('t2', 10.0)
+    history.add([result])
+    assert not result['regressed']
+
+
+def test_history_junit():
+    history = _TestHistory()
+    history.tests = {}
+    passed = _test_result(os.path.join('src', 'tests', 'xtest'), 2.5,
+                          start=100.0)
+    passed['log'] = 'xtest.log'
+    passed['regressed'] = True
+    passed['median'] = 1.0
+    failed = _test_result('a<b', 0.5, status=3, start=50.0)
+    text = history._junit([passed, failed])
+    lines = text.splitlines()
+    assert lines[0] == '<?xml version="1.0" encoding="UTF-8"?>'
+    assert lines[1].startswith('<testsuite name="scons" tests="2" '
+                               'failures="1" time="3.000" timestamp=')
+    # Test cases are in the order they started.
+    assert lines[2] == ('  <testcase classname="." name="a&lt;b" '
+                        'time="0.500">')
+    assert lines[3] == ('    <failure message="exit status 3">'
+                        'FAILED: check</failure>')
+    assert lines[4] == '    <system-out>10 bytes of output</system-out>'
+    assert lines[6] == ('  <testcase classname="src.tests" name="xtest" '
+                        'time="2.500">')
+    assert lines[7] == ('    <system-out>10 bytes of output in xtest.log, '
+                        'slower than the usual 1.0 s</system-out>')
+    assert lines[-1] == '</testsuite>'
+
+
+def test_spawner_chunks(tmpdir, monkeypatch):
+    noise = ''.join(['noise line %d\n' % (i) for i in range(60)])
+    text = ('Running 2 test cases...\n' + noise +
+            '*** Skipping test xtest\n' +
+            'error count passed, passed\n' +
+            'end passed')
+    tmpdir.join('output').write(text)
+    logpath = str(tmpdir.join('xtest.log'))
+    anchored = [r'^Running \d+ test cases\.\.\.', r'^\*\*\* Skipping test.*']
+    unanchored = [r'passed', r'^Running \d+']
+    cases = [
+        (anchored, b'Running 2 test cases...\n.\n*** Skipping test xtest\n',
+         []),
+        (unanchored, b'Running 2 test cases...\n.\n'
+         b'error count passed, passed\nend passed',
+         ['error count passed, passed'])]
+    # Small odd-sized chunks split lines and the matches in them, and
+    # should pass the same lines as whole chunks.
+    for chunk_size in (7, _chunk_size):
+        monkeypatch.setitem(globals(), '_chunk_size', chunk_size)
+        for (patterns, stdout, failures) in cases:
+            out = []
+            monkeypatch.setitem(globals(), '_write_stdout', out.append)
+            spawner = _SpawnerLogger()
+            spawner.open(logpath)
+            spawner.setPassingPatterns(patterns)
+            try:
+                status = spawner.spawn('/bin/sh', None, None,
+                                       ['cat', str(tmpdir.join('output'))],
+                                       dict(os.environ))
+            finally:
+                spawner.close()
+            assert status == 0
+            assert b''.join(out) == stdout
+            assert spawner.failures == failures
+            assert spawner.nbytes == len(text)
+            logfile = open(logpath, 'rb')
+            try:
+                assert logfile.read() == _to_bytes(text)
+            finally:
+                logfile.close()
+
+
+
+def _test_scheduler():
+    scheduler = _TestScheduler()
+    # Keep the summary from being registered to run at exit.
+    scheduler.start = time.time()
+    return scheduler
+
+
+def _wait_until(predicate, timeout=5.0):
+    end = time.time() + timeout
+    while not predicate() and time.time() < end:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_scheduler_resources():
+    scheduler = _test_scheduler()
+    lock = threading.Lock()
+    running = []
+    overlaps = []
+    most = [0]
+
+    def run(resources):
+        scheduler.acquire(resources)
+        lock.acquire()
+        try:
+            for other in running:
+                if other & resources:
+                    overlaps.append((other, resources))
+            running.append(resources)
+            most[0] = max(most[0], len(running))
+        finally:
+            lock.release()
+        time.sleep(0.1)
+        lock.acquire()
+        try:
+            running.remove(resources)
+        finally:
+            lock.release()
+        scheduler.release(resources, {'name': str(sorted(resources))})
+
+    tests = [frozenset(['db']), frozenset(['db']), frozenset(['net']),
+             frozenset(['db', 'net']), frozenset(['net']), frozenset()]
+    threads = [threading.Thread(target=run, args=(resources,))
+               for resources in tests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not overlaps
+    # Tests without a tag in common still run at the same time.
+    assert most[0] >= 2
+    assert len(scheduler.results) == len(tests)
+    assert not scheduler.running
+
+
+def test_scheduler_exclusive():
+    scheduler = _test_scheduler()
+    db = frozenset(['db'])
+    net = frozenset(['net'])
+    exclusive = frozenset(['exclusive'])
+    started = []
+
+    def run(name, resources):
+        scheduler.acquire(resources)
+        started.append(name)
+
+    scheduler.acquire(db)
+    xthread = threading.Thread(target=run, args=('exclusive', exclusive))
+    xthread.start()
+    assert _wait_until(lambda: scheduler.exclusive_waiting == 1)
+    # The net test does not share a tag with the running test, but it
+    # must not start while the exclusive test waits.
+    nthread = threading.Thread(target=run, args=('net', net))
+    nthread.start()
+    time.sleep(0.2)
+    assert not started
+    scheduler.release(db, {'name': 'db'})
+    xthread.join(5.0)
+    assert started == ['exclusive']
+    assert scheduler.running == [exclusive]
+    # Nothing starts while the exclusive test runs.
+    time.sleep(0.2)
+    assert 'net' not in started
+    scheduler.release(exclusive, {'name': 'exclusive'})
+    nthread.join(5.0)
+    assert started == ['exclusive', 'net']
+    assert scheduler.running == [net]
+    assert scheduler.exclusive_waiting == 0
+
+
+def _input_signature(executor):
+    """
+    Return a signature of the test run by @p executor and its inputs: the
+    test actions and the content signatures of all the dependencies of the
+    test, like the test programs, the libraries and objects they are built
+    from, and data files, all the way down to the sources.  Directories
+    are left out, since their contents are dependencies of their own.
+    """
+    sigs = []
+    seen = set()
+    stack = []
+    for node in executor.get_all_targets():
+        stack.extend(node.children())
+    while stack:
+        node = stack.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        if isinstance(node, SCons.Node.FS.Dir):
+            continue
+        stack.extend(node.children())
+        sigs.append((str(node), node.get_csig()))
+    sigs.sort()
+    md5 = hashlib.md5()
+    md5.update(_to_bytes(executor.get_contents()))
+    md5.update(_to_bytes(repr(sigs)))
+    return md5.hexdigest()
+
+
 class LogAction(ListAction):
 
-    def __init__(self, actionlist, logpath=None, patterns=_rxpatterns):
+    def __init__(self, actionlist, logpath=None, patterns=_rxpatterns,
+                 resources=None):
         ListAction.__init__(self, actionlist)
         self.logpath = logpath
         self.patterns = patterns
+        self.resources = frozenset(resources or [])
         # Disable filtering when log file is disabled.
         if not logpath:
             self.patterns = None
 
     def __call__(self, target, source, env, **kw):
-        # Replace the SPAWN variable with our own instance of _SpawnerLogger.
+        # Run the actions in an override Environment with our own instance
+        # of _SpawnerLogger as SPAWN, so parallel tests never share or
+        # modify the SPAWN of the Environment.
+        if not SCons.Action.execute_actions:
+            return ListAction.__call__(self, target, source, env, **kw)
+        # The executor calls actions with empty target and source lists.
+        executor = kw.get('executor')
+        if executor:
+            target = executor.get_all_targets()
+        name = str(target[0])
+        inputs = None
+        if env.get('test_impact') and executor:
+            inputs = _input_signature(executor)
+            if not env.get('test_force') and _history.unchanged(name, inputs):
+                print("Skipping test %s, its inputs did not change." % (name))
+                _scheduler.skip(name)
+                return 0
+        resources = self.resources | frozenset(env.get('TEST_RESOURCES', []))
+        _scheduler.acquire(resources)
+        start = time.time()
+        status = 1
         spawner = _SpawnerLogger()
-        if self.logpath:
-            spawner.open(self.logpath)
-        spawner.setPassingPatterns(self.patterns)
-        spawnsave = env['SPAWN']
-        env['SPAWN'] = spawner.spawn
         try:
-            status = ListAction.__call__(self, target, source, env, **kw)
+            if self.logpath:
+                spawner.open(self.logpath)
+            spawner.setPassingPatterns(self.patterns)
+            try:
+                status = ListAction.__call__(
+                    self, target, source,
+                    env.Override({'SPAWN': spawner.spawn}), **kw)
+            finally:
+                spawner.close()
         finally:
-            spawner.close()
-            env['SPAWN'] = spawnsave
+            end = time.time()
+            exitstatus = status
+            if not isinstance(status, int):
+                exitstatus = getattr(status, 'status', 1)
+            _scheduler.release(resources, {
+                'name': name, 'start': start, 'end': end,
+                'elapsed': end - start, 'status': exitstatus,
+                'output_bytes': spawner.nbytes, 'log': self.logpath,
+                'failures': spawner.failures, 'inputs': inputs})
         return status
 
 
@@ -185,7 +883,81 @@ def _create_log_action(env, *args, **kw):
     return LogAction(*args, **kw)
 
 
-def _test_builder(env, alias, sources, actions, logfile=None):
+def test_log_action_spawn(tmpdir, monkeypatch):
+    from SCons.Environment import Environment
+    monkeypatch.setitem(globals(), '_scheduler', _test_scheduler())
+    env = Environment(tools=[])
+    spawn = env['SPAWN']
+    statuses = []
+
+    def run(name):
+        logpath = str(tmpdir.join(name + '.log'))
+        action = LogAction([Action('sleep 0.2; echo %s' % (name))], logpath)
+        target = env.File(str(tmpdir.join(name)))
+        statuses.append(action([target], [], env))
+
+    # Parallel tests in the same Environment each log their own output.
+    threads = [threading.Thread(target=run, args=(name,))
+               for name in ('xtest1', 'xtest2')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [0, 0]
+    assert env['SPAWN'] is spawn
+    assert tmpdir.join('xtest1.log').read() == 'xtest1\n'
+    assert tmpdir.join('xtest2.log').read() == 'xtest2\n'
+    assert len(_scheduler.results) == 2
+
+
+def test_test_impact(tmpdir, monkeypatch):
+    from SCons.Environment import Environment
+    monkeypatch.setitem(globals(), '_scheduler', _test_scheduler())
+    history = _TestHistory()
+    history.setPath(str(tmpdir.join('test-results')))
+    monkeypatch.setitem(globals(), '_history', history)
+    env = Environment(tools=[], test_impact=True)
+    data = env.File(str(tmpdir.join('data')))
+    tmpdir.join('data').write('1\n')
+
+    def xtest(name, command):
+        return env.Command(str(tmpdir.join(name)), data,
+                           LogAction([Action(command)]))[0]
+
+    def run(node, **kw):
+        "Run the test, then record its result like the summary does."
+        executor = node.get_executor()
+        nresults = len(_scheduler.results)
+        nskipped = len(_scheduler.skipped)
+        action = executor.get_action_list()[0]
+        assert action([], [], env.Override(kw), executor=executor) == 0
+        history.add(_scheduler.results[nresults:])
+        if len(_scheduler.skipped) > nskipped:
+            return 'skipped'
+        return 'ran'
+
+    node = xtest('xtest', 'cat $SOURCE')
+    inputs = _input_signature(node.get_executor())
+    # The signature is the same for the same action, but changes with
+    # the action.
+    assert _input_signature(xtest('xtest2', 'cat $SOURCE').get_executor()) \
+        == inputs
+    assert _input_signature(xtest('xtest3', 'cat -n $SOURCE').get_executor()) \
+        != inputs
+    assert run(node) == 'ran'
+    assert run(node) == 'skipped'
+    assert run(node, test_force=True) == 'ran'
+    # A change to the content of a dependency changes the signature.
+    # Each signature is only computed once in a build, so clear the node
+    # as a new build would.
+    tmpdir.join('data').write('2\n')
+    data.clear()
+    assert _input_signature(node.get_executor()) != inputs
+    assert run(node) == 'ran'
+    assert run(node) == 'skipped'
+
+
+def _test_builder(env, alias, sources, actions, logfile=None, resources=None):
     if not alias:
         alias = 'xtest'
     targets = [ env.File(alias) ]
@@ -196,7 +968,7 @@ def _test_builder(env, alias, sources, actions, logfile=None):
     # patterns either.
     if logfile:
         targets.append(logfile)
-    logaction = LogAction([Action(actions)], logfile)
+    logaction = LogAction([Action(actions)], logfile, resources=resources)
 
     xtest = env.Command(targets, sources, logaction)
 
@@ -238,25 +1010,187 @@ def _test_builder(env, alias, sources, actions, logfile=None):
     return xtest
 
 
-def _TestLog(env, alias, sources, actions):
-    "Wrap a pseudo-builder test with an output filter."
+def _TestLog(env, alias, sources, actions, resources=None):
+    """
+    Wrap a pseudo-builder test with an output filter.  @p resources is a
+    list of resource tags which the test needs to itself.
+    """
     if not alias:
         alias = 'xtest'
-    logfile = env.File(alias + '.log').get_abspath()
-    return _test_builder(env, alias, sources, actions, logfile)
+    logname = alias + '.log'
+    if env.get('TEST_LOG_COMPRESS'):
+        logname += '.gz'
+    logfile = env.File(logname).get_abspath()
+    return _test_builder(env, alias, sources, actions, logfile, resources)
 
 
-def _TestRun(env, alias, sources, actions):
+def _TestRun(env, alias, sources, actions, resources=None):
     "Run a test without piping the output into a log file."
-    return _test_builder(env, alias, sources, actions)
+    return _test_builder(env, alias, sources, actions, resources=resources)
+
+
+def _test_name(node):
+    "Return the name of the test which builds @p node."
+    if node.has_builder():
+        return str(node.get_executor().get_all_targets()[0])
+    return str(node)
+
+
+def _order_tests(nodes):
+    """
+    Return the test @p nodes ordered so the longest tests in the history
+    start first, which keeps long tests from starting last when running
+    tests in parallel.  Tests with no history are started before all the
+    others, since they could be long.
+    """
+    durations = {}
+    def key(node):
+        name = _test_name(node)
+        if name not in durations:
+            median = _history.median(name)
+            durations[name] = float('inf') if median is None else median
+        return -durations[name]
+    return sorted(nodes, key=key)
+
+
+def _assign_shards(names, nshards):
+    """
+    Partition the test @p names into @p nshards shards, numbered from 1,
+    and return a dictionary which maps each name to its shard.  Tests with
+    timings in the test_shard_timings file are assigned longest first,
+    each to the shard with the least total run time so far.  Other tests
+    are assigned by a hash of the name.  The partition only depends on the
+    names and the timings file, which no run modifies, so every machine
+    given the same file assigns the same shards.
+    """
+    shards = {}
+    timed = []
+    for name in names:
+        median = _timings.median(name)
+        if median is None:
+            digest = hashlib.md5(_to_bytes(name)).hexdigest()
+            shards[name] = int(digest, 16) % nshards + 1
+        else:
+            timed.append((-median, name))
+    loads = [0.0] * nshards
+    for (negmedian, name) in sorted(timed):
+        shard = loads.index(min(loads))
+        loads[shard] -= negmedian
+        shards[name] = shard + 1
+    return shards
+
+
+def _default_test_names():
+    "Return the names of the default tests in the order they were added."
+    names = []
+    seen = set()
+    for node in _default_tests:
+        name = _test_name(node)
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+
+def _select_shard(nodes):
+    "Return the test @p nodes in the current shard."
+    (shard, nshards) = _shard
+    shards = _assign_shards(_default_test_names(), nshards)
+    return [n for n in nodes if shards[_test_name(n)] == shard]
+
+
+def _scan_default_tests(node, env, path):
+    """
+    Return the default tests to run, as the dependencies of the node which
+    the 'test' alias runs them through.  Scons first scans that node when
+    it visits it in the build, once all the SConscript files have added
+    their tests, so the tests are selected and ordered then.  Scons scans
+    the node again as each test finishes, which gets the same list.
+    """
+    global _scheduled_tests
+    if _scheduled_tests is None:
+        nodes = _default_tests
+        if _shard:
+            nodes = _select_shard(nodes)
+        _scheduled_tests = _order_tests(nodes)
+    return _scheduled_tests
+
+
+def _run_default_tests(target, source, env):
+    "The default tests run as the dependencies of @p target."
+    return None
 
 
 def _DefaultTest(env, xtest):
     "Add target to the default test alias 'test'."
-    alias = env.Alias('test', xtest)
+    global _default_node
+    if _default_node is None:
+        builder = Builder(action=Action(_run_default_tests, None),
+                          target_scanner=SCons.Scanner.Base(
+                              _scan_default_tests, 'DefaultTests',
+                              node_class=None))
+        _default_node = builder(env, '#/.default-tests', [])
+        env.AlwaysBuild(_default_node)
+        env.Alias('test', _default_node)
+    for node in env.Flatten([xtest]):
+        if node not in _default_set:
+            _default_set.add(node)
+            _default_tests.append(node)
     return xtest
 
 
+def _write_manifest(target, source, env):
+    """
+    Write the JSON manifest of the default tests, with the targets, sources
+    and resources of each test, its median run time in the history, and
+    its shard when running a shard.
+    """
+    tests = []
+    shards = {}
+    if _shard:
+        shards = _assign_shards(_default_test_names(), _shard[1])
+    nodes = {}
+    for node in reversed(_default_tests):
+        nodes[_test_name(node)] = node
+    for name in _default_test_names():
+        node = nodes[name]
+        entry = {'name': name, 'median': _history.median(name),
+                 'targets': [], 'sources': [], 'resources': []}
+        if node.has_builder():
+            executor = node.get_executor()
+            resources = set(executor.get_build_env().get('TEST_RESOURCES',
+                                                         []))
+            for action in executor.get_action_list():
+                resources |= getattr(action, 'resources', set())
+            entry['targets'] = [str(t) for t in executor.get_all_targets()]
+            entry['sources'] = [str(n) for n in
+                                executor.get_all_sources() + node.depends]
+            entry['resources'] = sorted(resources)
+        if name in shards:
+            entry['shard'] = shards[name]
+        tests.append(entry)
+    text = json.dumps({'version': 1, 'shards': _shard and _shard[1] or 1,
+                       'tests': tests}, indent=1, sort_keys=True)
+    mfile = open(target[0].get_abspath(), 'w')
+    try:
+        mfile.write(text + "\n")
+    finally:
+        mfile.close()
+    return None
+
+
+# The nodes added to the default test alias, in the order they were added.
+_default_tests = []
+_default_set = set()
+# The node which runs the default tests for the 'test' alias, and the
+# tests it runs, once they have been selected and ordered.
+_default_node = None
+_scheduled_tests = None
+# The (shard, nshards) to run, or None to run all the default tests.
+_shard = None
+_manifest = None
+
+
 def _get_page_instance(env):
     from eol_scons.imagecomparisonpage import ImageComparisonPage
     page = env.get('IMAGE_COMPARISON_PAGE')
@@ -302,7 +1236,103 @@ def diff_emitter(target, source, env):
 diff_builder = Builder(action=[diff_files], emitter=diff_emitter)
 
 
+_variables = None
+
+def _setup_variables(env):
+    global _variables
+    if not _variables:
+        _variables = env.GlobalVariables()
+        _variables.AddVariables(
+            ('test_results',
+             'Base path of the JUnit XML and JSON test results files, '
+             'or empty to not keep test results.', '#/test-results'),
+            ('test_regression',
+             'Flag tests which take longer than this factor times their '
+             'median run time in the test results history.', '1.5'),
+            BoolVariable('test_impact',
+                         'Skip tests which passed the last time they ran '
+                         'when none of their inputs changed since.', False),
+            BoolVariable('test_force',
+                         'Run all tests, even those test_impact would '
+                         'skip.', False),
+            ('test_shard',
+             'Run only shard K of N of the default tests, given as K/N '
+             'with K from 1 to N.', ''),
+            ('test_shard_timings',
+             'Test results JSON file with the run times used to balance '
+             'the test shards.  It is only read, never updated.', ''))
+    _variables.Update(env)
+    path = env.get('test_results')
+    _history.setPath(path and env.File(path).get_abspath() or None)
+    try:
+        _history.threshold = float(env.get('test_regression'))
+    except (TypeError, ValueError):
+        raise SCons.Errors.UserError("test_regression must be a number: %s"
+                                     % (env.get('test_regression')))
+    global _shard
+    _shard = _parse_shard(env.get('test_shard'))
+    path = env.get('test_shard_timings')
+    _timings.setPath(path and env.File(path).get_abspath() or None)
+
+
+def _parse_shard(value):
+    "Parse the test_shard setting K/N into the tuple (K, N), or None."
+    if not value:
+        return None
+    match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise SCons.Errors.UserError("test_shard must be K/N with K from 1 "
+                                     "to N: %s" % (value))
+    return (int(match.group(1)), int(match.group(2)))
+
+
+def test_parse_shard():
+    assert _parse_shard('') is None
+    assert _parse_shard(None) is None
+    assert _parse_shard('1/4') == (1, 4)
+    assert _parse_shard(' 4 / 4 ') == (4, 4)
+    for value in ('0/4', '5/4', '1', '1/', 'a/b', '-1/4', '1/4/2'):
+        try:
+            _parse_shard(value)
+        except SCons.Errors.UserError:
+            continue
+        assert False, "accepted test_shard=%s" % (value)
+
+
+def test_assign_shards(tmpdir):
+    names = ['test%d' % (i) for i in range(40)]
+    _timings.setPath(None)
+    shards = _assign_shards(names, 4)
+    assert sorted(shards.keys()) == sorted(names)
+    assert set(shards.values()) == set([1, 2, 3, 4])
+    # Without timings each test keeps its shard however the tests change.
+    assert _assign_shards(list(reversed(names[5:])), 4) == \
+        dict([(name, shards[name]) for name in names[5:]])
+    assert _assign_shards(names, 1) == dict([(n, 1) for n in names])
+    timings = tmpdir.join('timings.json')
+    runs = {'long': 10.0, 'mid1': 6.0, 'mid2': 5.0, 'short': 4.0}
+    timings.write(json.dumps({'version': _history_version, 'tests': dict([
+        (name, {'runs': [{'elapsed': elapsed, 'status': 0}]})
+        for (name, elapsed) in runs.items()])}))
+    _timings.setPath(str(timings))
+    try:
+        shards = _assign_shards(['short', 'new', 'mid2', 'long', 'mid1'], 2)
+    finally:
+        _timings.setPath(None)
+    assert shards['long'] == 1
+    assert shards['mid1'] == 2
+    assert shards['mid2'] == 2
+    assert shards['short'] == 1
+    assert shards['new'] == _assign_shards(['new'], 2)['new']
+
+
 def generate(env):
+    global _manifest
+    _setup_variables(env)
+    if _manifest is None:
+        _manifest = env.Command('#/test-manifest.json', [], _write_manifest)
+        env.AlwaysBuild(_manifest)
+        env.Alias('test_manifest', _manifest)
     env.Append(BUILDERS = {'Diff':diff_builder})
     env.AddMethod(_TestLog, "TestLog")
     env.AddMethod(_TestRun, "TestRun")
@@ -51,10 +51,56 @@ forcing it with a command-line setting:
 The ValgrindLog() builder parses the output from valgrind and fails the
 build if there are excessive errors.  It can be used separately to test a
 valgrind log file rather than through the Valgrind() method.
+
+Valgrind can also write its errors in XML, which describes each error
+context with its kind and stack, so the errors can be checked against a
+baseline of known errors.  Set VALGRIND_XML to 'on', either in the
+environment or as a keyword to Valgrind(), to add --xml=yes and
+--xml-file=<target>.vg.xml to the valgrind command and to analyze the XML
+file instead of the text log.  The XML file is parsed incrementally, so
+even gigabyte helgrind logs are parsed in constant memory.  The errors are
+aggregated by kind and by context, where a context is the error kind and
+the function names of its stack.
+
+ValgrindLog() writes a JSON summary of the analysis to its target, with
+the totals, the aggregates for each kind of error, and the count of each
+context.  When VALGRIND_BASELINE names a summary file from an earlier run,
+the analysis fails only if the XML has contexts which are not in the
+baseline, regardless of the error and leak thresholds:
+
+    memcheck = env.Valgrind('memcheck', [test_program, sfile],
+                            "cd ${SOURCE.dir} && "
+                            "${VALGRIND_COMMAND} ./${SOURCE.file}",
+                            VALGRIND_XML='on',
+                            VALGRIND_BASELINE='#/tests/memcheck.baseline')
+
+To accept the current errors as the baseline, copy the summary, in this
+case memcheck.vg.xml-analyze, to the baseline file.
+
+Valgrind slows a test program down many times, so a google test program
+can be split into shards which run under valgrind in parallel.  Set
+VALGRIND_SHARDS to the number of shards, in the environment or as a
+keyword to Valgrind().  Each shard runs the actions with
+GTEST_TOTAL_SHARDS and GTEST_SHARD_INDEX set in the ENV, with the targets
+and log files named with a .shard<index> suffix.  Then ValgrindLog()
+merges the logs of all the shards into one verdict and writes the summary
+to the same -analyze file as without shards, memcheck.vg.xml-analyze in
+the example above.  Run scons with -j to run the shards at the same
+time:
+
+    memcheck = env.Valgrind('memcheck', [test_program, sfile],
+                            "cd ${SOURCE.dir} && "
+                            "${VALGRIND_COMMAND} ./${SOURCE.file}",
+                            VALGRIND_DEFAULT='on', VALGRIND_SHARDS=8)
 """
 
 import os
 import re
+import json
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 import SCons
 from SCons.Builder import Builder
 from SCons.Action import Action
@@ -118,7 +164,11 @@ def _parseValgrindOutput(log):
         return None
     results['tool'] = match.group(1)
     while line:
-        l = line.strip()
+        # Only the summary lines are of interest, so skip the regular
+        # expressions for all the other lines.
+        if 'lost:' not in line and 'ERROR SUMMARY' not in line:
+            line = log.readline()
+            continue
         for vname, rx in rxmap.items():
             match = rx.search(line)
             if match:
@@ -194,11 +244,268 @@ def test_parsevalgrind():
     assert results['nerrors'] == 17
 
 
+_leak_kinds = { 'Leak_DefinitelyLost' : 'dlost',
+                'Leak_PossiblyLost' : 'plost',
+                'Leak_IndirectlyLost' : 'ilost' }
+
+# The elements handled while parsing valgrind XML output.
+_xml_tags = set(['tool', 'error', 'pair', 'errorcounts', 'suppcounts',
+                 'status', 'announcethread'])
+
+
+def _errorContext(error):
+    """
+    Return the context key of an error element: the kind of error and the
+    function names of its first stack, or the file or object name for
+    frames without a function name.  Addresses and line numbers are left
+    out, so the context stays the same when code moves around.
+    """
+    frames = []
+    stack = error.find('stack')
+    if stack is not None:
+        for frame in stack.findall('frame'):
+            name = (frame.findtext('fn') or frame.findtext('file') or
+                    os.path.basename(frame.findtext('obj') or '') or '???')
+            frames.append(name)
+    return "%s: %s" % (error.findtext('kind'), " < ".join(frames))
+
+
+def _parseValgrindXml(log):
+    """
+    Parse the valgrind XML output in @p log, a path or file object, and
+    return the results, or None if it is not valgrind XML output.  Like
+    _parseValgrindOutput(), the results include the tool name, the total
+    number of errors, and the bytes lost in each kind of leak.  The
+    'contexts' dictionary maps each error context to its kind, count, and
+    description, and the 'kinds' dictionary has the number of contexts,
+    the count, and the leaked bytes for each kind of error.
+
+    The counts of the errors other than leaks come from the error counts
+    at the end of the output.  An error without a count there, as when the
+    output is truncated, is counted once.  The elements are discarded as
+    soon as they are parsed, so the memory used only grows with the number
+    of distinct errors.
+    """
+    results = { 'nerrors' : 0, 'dlost' : 0, 'plost' : 0, 'ilost' : 0,
+                'contexts' : {}, 'kinds' : {} }
+    contexts = results['contexts']
+    # Map the unique id of each error to its context, and keep the ids of
+    # the errors other than leaks which have no count yet.
+    uniques = {}
+    uncounted = set()
+    root = None
+    events = ElementTree.iterparse(log, ('start', 'end'))
+    try:
+        (event, root) = next(events)
+        if root.tag != 'valgrindoutput':
+            return None
+        for (event, elem) in events:
+            # Most elements are frames and their fields, which are only
+            # looked at as part of their error.
+            tag = elem.tag
+            if event == 'start' or tag not in _xml_tags:
+                continue
+            if tag == 'error':
+                key = _errorContext(elem)
+                kind = elem.findtext('kind')
+                what = elem.findtext('what') or elem.findtext('xwhat/text')
+                leaked = int(elem.findtext('xwhat/leakedbytes') or 0)
+                context = contexts.setdefault(key, { 'kind' : kind,
+                                                     'count' : 0,
+                                                     'what' : what })
+                unique = elem.findtext('unique')
+                uniques[unique] = key
+                # Leak errors are not in the error counts.
+                if kind in _leak_kinds:
+                    context['count'] += 1
+                    results[_leak_kinds[kind]] += leaked
+                else:
+                    uncounted.add(unique)
+                kinds = results['kinds'].setdefault(
+                    kind, { 'contexts' : 0, 'count' : 0, 'leakedbytes' : 0 })
+                kinds['leakedbytes'] += leaked
+                root.clear()
+            elif tag == 'pair':
+                unique = elem.findtext('unique')
+                key = uniques.get(unique)
+                if key:
+                    contexts[key]['count'] += int(elem.findtext('count'))
+                    uncounted.discard(unique)
+                elem.clear()
+            elif tag == 'tool':
+                results.setdefault('tool', elem.text.strip().capitalize())
+            else:
+                root.clear()
+    except SyntaxError:
+        # ParseError is a SyntaxError.  A truncated file from a program
+        # which crashed is still worth reporting.
+        if root is None:
+            return None
+        print("ValgrindLog: XML output is incomplete or corrupt.")
+    if 'tool' not in results:
+        return None
+    for unique in uncounted:
+        contexts[uniques[unique]]['count'] += 1
+    for context in contexts.values():
+        kinds = results['kinds'][context['kind']]
+        kinds['contexts'] += 1
+        kinds['count'] += context['count']
+        results['nerrors'] += context['count']
+    return results
+
+
+def _parseValgrindLog(path):
+    "Parse the valgrind log file at @p path, whether text or XML."
+    log = open(path, "rb")
+    try:
+        xml = log.read(64).lstrip().startswith(b'<?xml')
+        log.seek(0)
+        if xml:
+            return _parseValgrindXml(log)
+    finally:
+        log.close()
+    log = open(path, "r")
+    try:
+        return _parseValgrindOutput(log)
+    finally:
+        log.close()
+
+
+_valgrind_xml_example = b"""\
+<?xml version="1.0"?>
+<valgrindoutput>
+<protocolversion>4</protocolversion>
+<protocoltool>memcheck</protocoltool>
+<preamble><line>Memcheck, a memory error detector</line></preamble>
+<pid>9158</pid>
+<tool>memcheck</tool>
+<status><state>RUNNING</state><time>00:00:00:00.045 </time></status>
+<error>
+  <unique>0x0</unique>
+  <tid>1</tid>
+  <kind>InvalidRead</kind>
+  <what>Invalid read of size 4</what>
+  <stack>
+    <frame><ip>0x4005A4</ip><obj>/tmp/tcore</obj><fn>parse</fn>
+      <file>parse.cc</file><line>12</line></frame>
+    <frame><ip>0x4005C8</ip><obj>/tmp/tcore</obj><fn>main</fn>
+      <file>tcore.cc</file><line>5</line></frame>
+  </stack>
+</error>
+<error>
+  <unique>0x1</unique>
+  <tid>1</tid>
+  <kind>Leak_DefinitelyLost</kind>
+  <xwhat>
+    <text>408 bytes in 1 blocks are definitely lost</text>
+    <leakedbytes>408</leakedbytes>
+    <leakedblocks>1</leakedblocks>
+  </xwhat>
+  <stack>
+    <frame><ip>0x4C2AB80</ip><obj>/usr/lib/vgpreload_memcheck.so</obj>
+      <fn>malloc</fn></frame>
+    <frame><ip>0x4005D0</ip><obj>/tmp/tcore</obj><fn>main</fn>
+      <file>tcore.cc</file><line>7</line></frame>
+  </stack>
+</error>
+<errorcounts>
+  <pair><count>15</count><unique>0x0</unique></pair>
+</errorcounts>
+<suppcounts>
+</suppcounts>
+</valgrindoutput>
+"""
+
+
+def test_parsevalgrindxml():
+    import io
+    results = _parseValgrindXml(io.BytesIO(_valgrind_xml_example))
+    assert results['tool'] == 'Memcheck'
+    assert results['nerrors'] == 16
+    assert results['dlost'] == 408
+    assert results['plost'] == 0
+    contexts = results['contexts']
+    assert contexts['InvalidRead: parse < main']['count'] == 15
+    assert contexts['Leak_DefinitelyLost: malloc < main']['count'] == 1
+    assert results['kinds']['InvalidRead']['contexts'] == 1
+    assert _parseValgrindXml(io.BytesIO(b"<?xml version='1.0'?><a/>")) is None
+    merged = _mergeResults(results,
+                           _parseValgrindXml(io.BytesIO(_valgrind_xml_example)))
+    assert merged['nerrors'] == 32
+    assert merged['dlost'] == 816
+    assert merged['contexts']['InvalidRead: parse < main']['count'] == 30
+    assert merged['kinds']['Leak_DefinitelyLost']['leakedbytes'] == 816
+    assert merged['kinds']['InvalidRead']['contexts'] == 1
+    # Errors are still counted when the output stops before the counts.
+    truncated = _valgrind_xml_example[
+        :_valgrind_xml_example.index(b'<errorcounts>') + 20]
+    results = _parseValgrindXml(io.BytesIO(truncated))
+    assert results['nerrors'] == 2
+    assert results['contexts']['InvalidRead: parse < main']['count'] == 1
+    assert results['kinds']['InvalidRead']['count'] == 1
+
+
+def _mergeResults(results, more):
+    """
+    Merge the valgrind results @p more into @p results, as when the logs
+    are from shards of the same test program, and return the merged
+    results.  Either may be None.  Contexts are only merged when both
+    results have them.
+    """
+    if not results or not more:
+        return results or more
+    for key in ('nerrors', 'dlost', 'plost', 'ilost'):
+        if key in results or key in more:
+            results[key] = results.get(key, 0) + more.get(key, 0)
+    if results.get('contexts') is None or more.get('contexts') is None:
+        results.pop('contexts', None)
+        results.pop('kinds', None)
+        return results
+    for key, context in more['contexts'].items():
+        if key in results['contexts']:
+            results['contexts'][key]['count'] += context['count']
+        else:
+            results['contexts'][key] = context
+    kinds = {}
+    for context in results['contexts'].values():
+        agg = kinds.setdefault(context['kind'], { 'contexts' : 0,
+                                                  'count' : 0,
+                                                  'leakedbytes' : 0 })
+        agg['contexts'] += 1
+        agg['count'] += context['count']
+    for kind, agg in kinds.items():
+        for leaks in (results['kinds'], more['kinds']):
+            agg['leakedbytes'] += leaks.get(kind, {}).get('leakedbytes', 0)
+    results['kinds'] = kinds
+    return results
+
+
+def _loadBaseline(path):
+    "Return the set of error contexts in the baseline summary at @p path."
+    bfile = open(path)
+    try:
+        return set(json.load(bfile).get('contexts', {}).keys())
+    finally:
+        bfile.close()
+
+
+def _writeSummary(path, results):
+    sfile = open(path, "w")
+    try:
+        json.dump(results, sfile, indent=1, sort_keys=True)
+        sfile.write("\n")
+    finally:
+        sfile.close()
+
+
 def ValgrindLog_emit(target, source, env):
     # If the target is a default, generate a target from the source.
     if target and str(target[0]) == str(source[0]):
         target = [str(source[0]) + '-vglog']
     # env.AlwaysBuild(source)
+    baseline = env.get('VALGRIND_BASELINE')
+    if baseline:
+        env.Depends(target, env.File(baseline))
     return target, source
 
 
@@ -207,15 +514,32 @@ def ValgrindLog(target, source, env):
     # can be very very large, so stick with the file stream.
     results = None
     for s in source:
-        log = open(str(s), "r")
-        results = _parseValgrindOutput(log)
-        log.close()
-        if results:
-            break
+        results = _mergeResults(results, _parseValgrindLog(str(s)))
     if not results:
         msg = "No valgrind log file found from memcheck or helgrind tool."
         raise SCons.Errors.StopError, msg
 
+    _writeSummary(target[0].get_abspath(), results)
+    contexts = results.get('contexts')
+    if contexts is not None:
+        for kind, agg in sorted(results['kinds'].items()):
+            print("ValgrindLog: %s: %d errors from %d contexts, "
+                  "%d bytes leaked" % (kind, agg['count'], agg['contexts'],
+                                       agg['leakedbytes']))
+    baseline = env.get('VALGRIND_BASELINE')
+    if baseline and contexts is None:
+        print("ValgrindLog: Ignoring baseline for text log %s." %
+              (str(source[0])))
+    elif baseline:
+        known = _loadBaseline(env.File(baseline).get_abspath())
+        new = sorted([key for key in contexts if key not in known])
+        for key in new:
+            print("ValgrindLog: New error context (%d): %s" %
+                  (contexts[key]['count'], key))
+        if new:
+            return "ValgrindLog: %d new error contexts" % (len(new))
+        return None
+
     maxleaked = env.get('VALGRIND_LEAK_THRESHOLD', 0)
     maxerrors = env.get('VALGRIND_ERROR_THRESHOLD', 0)
     if results['nerrors'] > maxerrors:
@@ -256,25 +580,75 @@ def Valgrind(env, targets, sources, actions, **kw):
         output = env.Command(targets, sources, actions, **kw)
     else:
         env.LogDebug("Creating builder for %s, valgrind=on" % (str(targets[0])))
-        # Save off the valgrind output into a log file, without filtering
-        # anything, then parse the valgrind output.
-        logfile = str(targets[0])+'.vg.log'
-        logfile = kw.get('VALGRIND_LOG', logfile)
-        logfile = env.File(logfile)
-        logaction = env.LogAction([Action(actions)], logfile.get_abspath())
         if not vgcmd:
             vgcmd = env.get('VALGRIND_COMMAND')
         kw['VALGRIND_COMMAND'] = vgcmd + suppressions
-        targets.append(logfile)
-        # First run the command under valgrind, then analyze the log file,
-        # and the targets of both builders are returned as the output
-        # nodes for this pseudo-builder.
-        output = env.Command(targets, sources, logaction, **kw)
-        output.extend(env.ValgrindLog(str(logfile)+"-analyze", logfile))
+        xml = kw.pop('VALGRIND_XML', env.get('VALGRIND_XML'))
+        xml = str(xml).lower() in ('on', 'yes', 'true', '1')
+        baseline = kw.pop('VALGRIND_BASELINE', env.get('VALGRIND_BASELINE'))
+        nshards = int(kw.pop('VALGRIND_SHARDS',
+                             env.get('VALGRIND_SHARDS', 0)) or 0)
+        if nshards <= 1:
+            # First run the command under valgrind, then analyze the log
+            # file, and the targets of both builders are returned as the
+            # output nodes for this pseudo-builder.
+            logfile = str(targets[0])+'.vg.log'
+            logfile = kw.get('VALGRIND_LOG', logfile)
+            (output, analyze) = _valgrindCommand(env, targets, sources,
+                                                 actions, env.File(logfile),
+                                                 xml, kw)
+            output.extend(env.ValgrindLog(str(analyze)+"-analyze", analyze,
+                                          VALGRIND_BASELINE=baseline))
+        else:
+            # Run each shard of the gtest program under valgrind with its
+            # own targets and log files, so scons can run the shards in
+            # parallel, then analyze all the logs together into the
+            # summary named after the log of an unsharded run.
+            output = []
+            analyze = []
+            for index in range(nshards):
+                nodes = [env.File(t) for t in targets]
+                nodes = [n.dir.File("%s.shard%d" % (n.name, index))
+                         for n in nodes]
+                skw = dict(kw)
+                skw['ENV'] = dict(kw.get('ENV', env['ENV']))
+                skw['ENV']['GTEST_TOTAL_SHARDS'] = str(nshards)
+                skw['ENV']['GTEST_SHARD_INDEX'] = str(index)
+                logfile = nodes[0].dir.File(nodes[0].name+'.vg.log')
+                (shard, log) = _valgrindCommand(env, nodes, sources, actions,
+                                                logfile, xml, skw)
+                output.extend(shard)
+                analyze.append(log)
+            logfile = str(targets[0])+'.vg.log'
+            logfile = kw.get('VALGRIND_LOG', logfile)
+            if xml:
+                logfile = str(targets[0])+'.vg.xml'
+            output.extend(env.ValgrindLog(str(env.File(logfile))+"-analyze",
+                                          analyze,
+                                          VALGRIND_BASELINE=baseline))
 
     return output
 
 
+def _valgrindCommand(env, targets, sources, actions, logfile, xml, kw):
+    """
+    Return the nodes of a Command which runs the valgrind @p actions with
+    the output saved in @p logfile, and the log file to analyze, which is
+    an XML file if @p xml is true.
+    """
+    # Save off the valgrind output into a log file, without filtering
+    # anything, then parse the valgrind output.
+    targets = targets[:]
+    logaction = env.LogAction([Action(actions)], logfile.get_abspath())
+    targets.append(logfile)
+    analyze = logfile
+    if xml:
+        analyze = env.File(str(targets[0])+'.vg.xml')
+        kw = dict(kw)
+        kw['VALGRIND_COMMAND'] += (" --xml=yes --xml-file=%s" %
+                                   (analyze.get_abspath()))
+        targets.append(analyze)
+    return (env.Command(targets, sources, logaction, **kw), analyze)
 
 
 
@@ -15,19 +15,31 @@ called (via _update_variables) until global Variables have been added.
 
 import os
 import sys
+import atexit
+import copy
+import weakref
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import SCons.Errors
 import SCons.Variables
+import SCons.Script
 from SCons.Script import Variables
 from SCons.Script import DefaultEnvironment
 from SCons.Script import BoolVariable
 
 import eol_scons.debug
+import eol_scons.instrument
 import traceback
 
 _global_variables = None
 _cache_variables = None
 _default_cfile = "#/config.py"
-_enable_cache = False
+_enable_cache = True
+_cache_version = 1
 
 def GlobalVariables(cfile=None, env=None):
     """Return the eol_scons global variables."""
@@ -38,15 +50,137 @@ def GlobalVariables(cfile=None, env=None):
         if not cfile:
             cfile = _default_cfile
         cfile = env.File(cfile).get_abspath()
-        _global_variables = Variables(cfile)
+        _global_variables = MemoVariables(cfile, SCons.Script.ARGUMENTS)
         eol_scons.debug.AddVariables(_global_variables)
         _global_variables.AddVariables(
             BoolVariable('eolsconscache',
-                         'Enable tools.cache optimization.',
-                         _enable_cache))
+                         'Enable the tools.cache store for tool settings.',
+                         _enable_cache),
+            BoolVariable('eolsconsconfigcache',
+                         'Cache config script results across builds '
+                         'in config.cache.',
+                         True),
+            BoolVariable('eolsconsmanifest',
+                         'Use the tool manifest to find the tool modules '
+                         'which export sub-tools.',
+                         True))
+        _global_variables.Add(
+            BoolVariable('eolsconsprofile',
+                         'Report the time spent applying tools, running '
+                         'config scripts, and updating variables, and '
+                         'write a trace to eolscons_trace.json.',
+                         False))
         print("Config files: %s" % (_global_variables.files))
     return _global_variables
 
+
+class MemoVariables(SCons.Variables.Variables):
+    """
+    The Variables class for the eol_scons global variables, which is
+    updated on nearly every tool application.  The SCons Update() re-reads
+    the config files, matches every argument against every variable, and
+    converts and validates every variable on every call, so with hundreds
+    of Environments and a hundred variables the work grows quadratically.
+
+    Here the config files are read once, and each Update() of an
+    Environment only applies the variables added since the last Update()
+    of that same Environment.  Those variables are passed to the SCons
+    Update() with the values from the config files in place of their
+    defaults, so the files are not read again.  Since variables are not
+    applied twice, a value which a tool sets in the Environment after the
+    variable has been applied is not reset by the next Update().  A Clone
+    is a different Environment, so its first Update() applies every
+    variable.  Passing an explicit @p args dictionary other than the
+    arguments given to the constructor applies every variable and reads
+    the config files again, like the SCons Update().
+    """
+
+    def __init__(self, files=None, args=None, is_global=1):
+        SCons.Variables.Variables.__init__(self, files, args, is_global)
+        # Map id(env) to a weak reference to the Environment and the number
+        # of variables applied to it.
+        self._applied = {}
+        self._file_values = None
+        self._files_read = None
+
+    def _read_files(self):
+        """
+        Return the values set by the config files, reading them only the
+        first time or if the list of files has changed.
+        """
+        files = tuple(self.files)
+        if self._file_values is not None and self._files_read == files:
+            return self._file_values
+        # Config files can refer to the defaults, so execute them with the
+        # defaults in scope and keep only the values they set.
+        defaults = {}
+        for option in self.options:
+            if option.default is not None:
+                defaults[option.key] = option.default
+        values = dict(defaults)
+        for filename in files:
+            if os.path.exists(filename):
+                fdir = os.path.split(os.path.abspath(filename))[0]
+                if fdir:
+                    sys.path.insert(0, fdir)
+                try:
+                    values['__name__'] = filename
+                    cfile = open(filename, 'r')
+                    try:
+                        contents = cfile.read()
+                    finally:
+                        cfile.close()
+                    exec(contents, {}, values)
+                finally:
+                    if fdir:
+                        sys.path.pop(0)
+                    del values['__name__']
+        self._file_values = {}
+        for key, value in values.items():
+            if key not in defaults or value is not defaults[key]:
+                self._file_values[key] = value
+        self._files_read = files
+        return self._file_values
+
+    def Update(self, env, args=None):
+        with eol_scons.instrument.Span('variables', 'GlobalVariables.Update',
+                                       env):
+            if args is not None and args is not self.args:
+                SCons.Variables.Variables.Update(self, env, args)
+                return
+            self._update_new(env)
+
+    def _update_new(self, env):
+        "Apply the variables not yet applied to @p env."
+        applied = 0
+        entry = self._applied.get(id(env))
+        if entry and entry[0]() is env:
+            applied = entry[1]
+        if applied >= len(self.options):
+            return
+        file_values = self._read_files()
+        options = self.options
+        files = self.files
+        self.options = []
+        for option in options[applied:]:
+            if option.key in file_values:
+                option = copy.copy(option)
+                option.default = copy.deepcopy(file_values[option.key])
+            self.options.append(option)
+        self.files = []
+        try:
+            SCons.Variables.Variables.Update(self, env)
+        finally:
+            self.options = options
+            self.files = files
+        # Arguments for the variables applied earlier were just recorded
+        # as unknown, so take them back out.
+        for option in options[:applied]:
+            for alias in list(option.aliases) + [option.key]:
+                self.unknown.pop(alias, None)
+        self._applied[id(env)] = (weakref.ref(env), len(options))
+
+
 def GlobalOptions(cfile=None, env=None):
     """
     GlobalOptions() has been replaced by GlobalVariables(). Generate an error
@@ -60,23 +194,38 @@ def GlobalOptions(cfile=None, env=None):
              "use eol_scons.GlobalVariables() instead"
     raise SCons.Errors.StopError, errmsg                       
 
-class VariableCache(SCons.Variables.Variables):
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class VariableCache(object):
     """
-    Add a file-backed cache store to Variables, originally to be used to
-    cache locations of tool files embedded in the source tree and to cache
-    output from expensive config scripts across builds.  The file store is
-    disabled by default now, since it can cause confusion when tool files
-    change in the tree but are not discovered because of the cache.  Also,
-    the results of config scripts will change depending upon the
-    environment running them.  For example, PKG_CONFIG_PATH might be
-    different for different environments, and cross-build environments will
-    return different results.  Therefore this cache is no longer used for
-    config script results, and it is only used for tool file locations if
-    explicitly enabled.
+    A file-backed key/value cache store, originally used to cache
+    locations of tool files embedded in the source tree and output from
+    expensive config scripts across builds.  It is now used for results
+    like the paths to the Qt4 commands and the FindPackagePath() glob
+    matches.  Config script results have their own cache in
+    eol_scons.parseconfig, and tool file locations are kept in the index
+    in eol_scons.toolfiles.
+
+    The file is read once per process, on the first lookup, and written
+    once at exit if any entries changed.  Each entry can carry validation
+    metadata, so the cache can be enabled by default without returning
+    stale results: a dictionary of the setting values the result was
+    computed from, which must equal the values passed to lookup(), and a
+    list of files whose modification times must not have changed since the
+    entry was stored.  An entry which fails validation is treated as
+    missing.
     """
     def __init__(self, path):
-        SCons.Variables.Variables.__init__(self, path)
         self.cfile = path
+        self.entries = None
+        self.dirty = False
+        if path:
+            atexit.register(self.flush)
 
     def getPath(self):
         return self.cfile
@@ -84,27 +233,79 @@ class VariableCache(SCons.Variables.Variables):
     def cacheKey(self, name):
         return "_vcache_" + name
 
-    def lookup(self, env, name):
+    def _load(self):
+        self.entries = {}
+        if not self.cfile:
+            return
+        try:
+            cfile = open(self.cfile, 'rb')
+        except IOError:
+            return
+        try:
+            try:
+                data = pickle.load(cfile)
+            except Exception:
+                print("Ignoring old or unreadable cache file: %s" %
+                      (self.cfile))
+                return
+        finally:
+            cfile.close()
+        if isinstance(data, dict) and data.get('version') == _cache_version:
+            self.entries = data['entries']
+
+    def lookup(self, env, name, values=None):
+        """
+        Return the value cached for @p name, or None if there is no valid
+        entry.  @p values is the dictionary of current settings which must
+        match the settings stored with the entry.
+        """
+        if self.entries is None:
+            self._load()
         key = self.cacheKey(name)
-        if not key in self.keys():
-            self.Add(key)
-        self.Update(env)
+        entry = self.entries.get(key)
         value = None
-        if env.has_key(key):
-            value = env[key]
-            env.LogDebug("returning %s cached value: %s" % (key, value))
-        else:
+        if not entry:
             env.LogDebug("no value cached for %s" % (key))
+        elif entry[2] != (values or {}):
+            env.LogDebug("cached value for %s is for different settings: %s" %
+                         (key, entry[2]))
+        elif [f for (f, mtime) in entry[1] if _mtime(f) != mtime]:
+            env.LogDebug("cached value for %s is out of date" % (key))
+        else:
+            value = entry[0]
+            env.LogDebug("returning %s cached value: %s" % (key, value))
         return value
-        
-    def store(self, env, name, value):
-        # Update the cache
+
+    def store(self, env, name, value, files=None, values=None):
+        """
+        Cache @p value for @p name, along with the settings @p values it
+        depends on and the modification times of the paths in @p files.
+        """
+        if self.entries is None:
+            self._load()
         key = self.cacheKey(name)
-        env[key] = value
-        if self.getPath():
-            self.Save(self.getPath(), env)
+        files = [(f, _mtime(f)) for f in (files or [])]
+        self.entries[key] = (value, files, values or {})
+        self.dirty = True
         env.LogDebug("Updated %s to value: %s" % (key, value))
 
+    def flush(self):
+        "Write the cache file if any entries changed."
+        if not self.dirty or not self.cfile:
+            return
+        tmppath = "%s.%d" % (self.cfile, os.getpid())
+        try:
+            cfile = open(tmppath, 'wb')
+            try:
+                pickle.dump({'version': _cache_version,
+                             'entries': self.entries}, cfile, 2)
+            finally:
+                cfile.close()
+            os.rename(tmppath, self.cfile)
+            self.dirty = False
+        except (IOError, OSError) as ex:
+            print("Failed to write cache file %s: %s" % (self.cfile, str(ex)))
+
 
 def ToolCacheVariables(env):
     global _cache_variables
@@ -119,9 +320,8 @@ def ToolCacheVariables(env):
             print("Tool settings cache: %s" % (_cache_variables.getPath()))
         else:
             _cache_variables = VariableCache(None)
-            print("Tool cache will not be used. "
-                  "(It is now disabled by default.) "
-                  "It can be enabled by setting eolsconscache=1")
+            print("Tool cache will not be used, "
+                  "since it was disabled by setting eolsconscache=0.")
     return _cache_variables
 
 
@@ -131,6 +331,21 @@ def PathToAbsolute(path, env):
     # print("Converting PREFIX=%s to %s" % (path, apath))
     return apath
 
+def _bool_setting(env, name, default):
+    """
+    Return the value of the eol_scons BoolVariable @p name for @p env.  The
+    global variables are not always applied to an Environment yet when
+    eol_scons needs a setting, so fall back to the command-line arguments
+    and then to @p default.
+    """
+    if env.has_key(name):
+        return env[name]
+    value = SCons.Script.ARGUMENTS.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('y', 'yes', 't', 'true', '1', 'on', 'all')
+
+
 def _update_variables(env):
     # Do not update the environment with global variables unless some
     # global variables have been created.